@@ -44,6 +44,8 @@ def update_host_rules():
 
 def clear_pid_file():
     for s in [FDSL_PID_FILE, ]:
+        # 工作进程退出时不能删除主进程的pid文件
+        if get_process_id(s) != os.getpid(): continue
         pid_path = "%s/%s" % (pid_dir, s)
         if os.path.isfile(pid_path):
             os.remove(pid_path)
@@ -61,8 +63,15 @@ class fdslight(dispatcher.dispatcher):
     __udp_proxy_sessions = {}
     __session_bind = {}
 
+    # 是否是主进程
+    __is_master = True
+    # 是否使用边沿触发模式
+    __edge_triggered = False
+
     def __init(self):
-        self.create_poll()
+        # 必须在创建poll之前创建工作进程,epoll不能在进程之间共享
+        self.__is_master = self.create_workers()
+        self.create_poll(edge_triggered=self.__edge_triggered)
         if self.__mode != "local": self.__raw_socket_fd = self.create_handler(-1, traffic_pass.traffic_send)
         # self.__raw6_socket_fd = self.create_handler(-1, traffic_pass.traffic_send, is_ipv6=True)
 
@@ -107,7 +116,7 @@ class fdslight(dispatcher.dispatcher):
         if self.__mode == "gateway": self.create_fn_gw()
         if self.__mode == "local": self.create_fn_local()
 
-        create_pid_file(FDSL_PID_FILE, os.getpid())
+        if self.__is_master: create_pid_file(FDSL_PID_FILE, os.getpid())
 
         return
 
@@ -234,6 +243,10 @@ class fdslight(dispatcher.dispatcher):
             raise ValueError("the mode must be gateway,server or local")
         self.__mode = mode
 
+    def set_edge_triggered(self, edge_triggered):
+        """设置是否使用边沿触发模式,必须在init_func之前调用"""
+        self.__edge_triggered = bool(edge_triggered)
+
     def check_ipv4_data(self, packet):
         """核对IPV4数据包是否合法"""
         size = len(packet)
@@ -250,6 +263,12 @@ class fdslight(dispatcher.dispatcher):
         """核对IPV6数据包是否合法"""
         return False
 
+    def create_workers(self):
+        """创建工作进程,需要多进程的模式重写这个方法
+        :return Boolean: True表示当前进程是主进程
+        """
+        return True
+
     def create_fn_server(self):
         """服务端重写这个方法"""
         pass
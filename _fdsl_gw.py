@@ -3,6 +3,7 @@ import _fdsl, os, sys, signal, socket
 import pywind.lib.timer as timer
 import freenet.lib.fdsl_ctl as fdsl_ctl
 import freenet.lib.file_parser as file_parser
+import freenet.lib.host_match as host_match
 import freenet.handler.dns_proxy as dns_proxy
 import fdslight_etc.fn_gw as fngw_config
 import freenet.handler.tunnelgw_tcp as tunnelc_tcp
@@ -21,6 +22,7 @@ class fdslightgw(_fdsl.fdslight):
     # 过滤器中需要删除的IP
     __routers = None
     __session_id = None
+    __rules_reloader = None
 
     __TUN_NAME = "fdslight"
     __ROUTER_TIMEOUT = 900
@@ -28,6 +30,7 @@ class fdslightgw(_fdsl.fdslight):
     def __init__(self):
         super(fdslightgw, self).__init__()
         self.set_mode("gateway")
+        self.set_edge_triggered(fngw_config.configs["edge_triggered"])
         self.__timer = timer.timer()
         self.__routers = {}
 
@@ -57,14 +60,18 @@ class fdslightgw(_fdsl.fdslight):
         host_rules = file_parser.parse_host_file("fdslight_etc/host_rules.txt")
 
         self.__tun_fd = self.create_handler(-1, tundev.tungw, self.__TUN_NAME)
+        self.get_handler(self.__tun_fd).set_write_queue(**fngw_config.configs["tun_write_queue"])
         self.__dns_fd = self.create_handler(-1, dns_proxy.dnsgw_proxy, self.__session_id, host_rules, debug=self.debug)
         self.get_handler(self.__dns_fd).set_dns_id_max(int(fngw_config.configs["max_dns_request"]))
+        self.get_handler(self.__dns_fd).set_dns_cache(**fngw_config.configs["dns_cache"])
 
+        # 规则很多时在后台线程中重新加载,不阻塞事件循环
+        self.__rules_reloader = host_match.rules_reloader("fdslight_etc/host_rules.txt",
+                                                          self.get_handler(self.__dns_fd).update_host_rules)
         signal.signal(signal.SIGUSR1, self.__update_host_rules)
 
     def __update_host_rules(self, signum, frame):
-        host_rules = file_parser.parse_host_file("fdslight_etc/host_rules.txt")
-        self.get_handler(self.__dns_fd).update_host_rules(host_rules)
+        self.__rules_reloader.reload()
 
     def open_tunnel(self):
         tunnel_type = fngw_config.configs["tunnel_type"].lower()
@@ -8,6 +8,7 @@ import freenet.handler.tunnellc_tcp as tunnellc_tcp
 import freenet.handler.tunnellc_udp as tunnellc_udp
 import freenet.lib.base_proto.utils as proto_utils
 import freenet.lib.file_parser as file_parser
+import freenet.lib.host_match as host_match
 import dns.resolver
 
 
@@ -16,6 +17,7 @@ class fdslightlc(_fdsl.fdslight):
 
     __dns_fd = None
     __nameserver = None
+    __rules_reloader = None
 
     # 隧道是否打开
     __tunnel_ok = False
@@ -36,6 +38,7 @@ class fdslightlc(_fdsl.fdslight):
     def __init__(self):
         super(fdslightlc, self).__init__()
         self.set_mode("local")
+        self.set_edge_triggered(fnlc_config.configs["edge_triggered"])
         self.__timer = timer.timer()
         self.__routers = {}
 
@@ -59,16 +62,20 @@ class fdslightlc(_fdsl.fdslight):
 
         self.__nameserver = socket.inet_aton(fnlc_config.configs["virtual_dns"])
         self.__dns_fd = self.create_handler(-1, dns_proxy.dnslc_proxy, *args, debug=self.debug)
-        self.__update_host_rules()
+        self.get_handler(self.__dns_fd).set_dns_cache(**fnlc_config.configs["dns_cache"])
+        host_rules = file_parser.parse_host_file("fdslight_etc/host_rules.txt")
+        self.get_handler(self.__dns_fd).update_host_rules(host_rules)
 
+        # 规则很多时在后台线程中重新加载,不阻塞事件循环
+        self.__rules_reloader = host_match.rules_reloader("fdslight_etc/host_rules.txt",
+                                                          self.get_handler(self.__dns_fd).update_host_rules)
         signal.signal(signal.SIGUSR1, self.__update_host_rules)
         # 设置DNS路由
         cmd = "route add -host %s dev %s" % (fnlc_config.configs["virtual_dns"], self.__TUN_NAME)
         os.system(cmd)
 
-    def __update_host_rules(self):
-        host_rules = file_parser.parse_host_file("fdslight_etc/host_rules.txt")
-        self.get_handler(self.__dns_fd).update_host_rules(host_rules)
+    def __update_host_rules(self, signum, frame):
+        self.__rules_reloader.reload()
 
     def __is_ipv4_dns_request(self, byte_data):
         if len(byte_data) < 28: return False
@@ -1,18 +1,186 @@
 #!/usr/bin/env python3
 
-import _fdsl,sys
+import _fdsl, sys, os, signal, socket, time
 import freenet.handler.dns_proxy as dns_proxy
 import freenet.handler.tunnels_tcp as tunnels_tcp
 import freenet.handler.tunnels_udp as tunnels_udp
+import freenet.handler.worker_ipc as worker_ipc
 import fdslight_etc.fn_server as fns_config
 import freenet.handler.tundev as tundev
 import freenet.lib.static_nat as static_nat
 
 
 class fdslightd(_fdsl.fdslight):
+    # 工作进程个数与当前工作进程的编号
+    # 多进程模式下主进程只负责管理工作进程,工作进程的编号为0到workers-1
+    __workers = 1
+    __worker_id = 0
+    # 工作进程,格式为 {pid:(worker_id,start_time),...}
+    __worker_pids = None
+    # 根据虚拟局域网地址找到分配该地址的工作进程,格式为 (network,mask,shift)
+    __addr_worker_info = None
+    # 主进程的pid,工作进程用来检查主进程是否退出
+    __master_pid = -1
+    __stopping = False
+
+    # 工作进程在启动之后这么多秒内退出时认为是配置或者环境错误,不再重新创建,而是关闭整个服务
+    __MIN_WORKER_UPTIME = 10
+    # 通知工作进程退出之后等待的最长时间,超时之后强制结束
+    __STOP_TIMEOUT = 10
+
+    __ipc_channels = None
+    __ipc_fd = -1
+
     def __init__(self):
         super(fdslightd, self).__init__()
         self.set_mode("server")
+        self.set_edge_triggered(fns_config.configs["edge_triggered"])
+
+    def create_workers(self):
+        self.__workers = int(fns_config.configs["workers"])
+        self.__worker_pids = {}
+
+        if self.__workers < 2: return True
+        if self.__workers & (self.__workers - 1):
+            raise ValueError("the workers must be power of 2")
+
+        # 通信通道由主进程一直持有,重新创建的工作进程仍然使用原来的通道
+        self.__ipc_channels = worker_ipc.create_channels(self.__workers)
+        self.__master_pid = os.getpid()
+
+        signal.signal(signal.SIGINT, self.__handle_stop_signal)
+        signal.signal(signal.SIGTERM, self.__handle_stop_signal)
+
+        for i in range(self.__workers):
+            if self.__fork_worker(i): return False
+
+        # 只有重新创建的工作进程会从这里返回
+        self.__supervise()
+
+        return False
+
+    def __fork_worker(self, worker_id):
+        """创建工作进程
+        :return Boolean: True表示当前进程是新的工作进程
+        """
+        pid = os.fork()
+        if pid:
+            self.__worker_pids[pid] = (worker_id, time.monotonic(),)
+            return False
+
+        self.__worker_id = worker_id
+        self.__worker_pids = {}
+        # 工作进程收到SIGINT或者SIGTERM时正常退出
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, self.__handle_stop_signal)
+
+        return True
+
+    def __handle_stop_signal(self, signum, frame):
+        raise KeyboardInterrupt
+
+    def __kill_workers(self, signum):
+        for pid in self.__worker_pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+            ''''''
+        return
+
+    def __stop_workers(self):
+        if self.__stopping: return
+        self.__stopping = True
+
+        self.__kill_workers(signal.SIGINT)
+        # 工作进程没有及时退出时强制结束
+        signal.signal(signal.SIGALRM, lambda signum, frame: self.__kill_workers(signal.SIGKILL))
+        signal.alarm(self.__STOP_TIMEOUT)
+
+    def __supervise(self):
+        """主进程等待工作进程退出,异常退出的工作进程会被重新创建,收到SIGINT或者SIGTERM时关闭所有工作进程
+        只有重新创建的工作进程会从这个函数返回
+        """
+        if not self.debug: _fdsl.create_pid_file(_fdsl.FDSL_PID_FILE, os.getpid())
+
+        while self.__worker_pids:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except KeyboardInterrupt:
+                self.__stop_workers()
+                continue
+            except ChildProcessError:
+                break
+
+            if pid not in self.__worker_pids: continue
+            worker_id, start_time = self.__worker_pids.pop(pid)
+            if self.__stopping: continue
+
+            if os.WIFSIGNALED(status):
+                reason = "killed by signal %s" % os.WTERMSIG(status)
+            else:
+                reason = "exit code %s" % os.WEXITSTATUS(status)
+            print("error:worker %s(pid %s) %s" % (worker_id, pid, reason,))
+            sys.stdout.flush()
+
+            if time.monotonic() - start_time < self.__MIN_WORKER_UPTIME:
+                print("error:worker %s exited too quickly,stop all workers" % worker_id)
+                sys.stdout.flush()
+                self.__stop_workers()
+                continue
+
+            if self.__fork_worker(worker_id): return
+        ''''''
+
+        signal.alarm(0)
+        _fdsl.clear_pid_file()
+        sys.exit(0)
+
+    def myloop(self):
+        # 主进程异常退出之后工作进程也退出,不留下无人管理的进程
+        if self.__workers > 1 and os.getppid() != self.__master_pid: raise KeyboardInterrupt
+
+    def __get_worker_subnet(self, subnet):
+        """把虚拟局域网平均分配给各个工作进程,每个工作进程只从自己的部分中分配地址,地址不会冲突"""
+        if self.__workers < 2: return subnet
+
+        ip, mask_size = subnet
+        new_mask_size = mask_size + self.__workers.bit_length() - 1
+
+        if new_mask_size > 30:
+            raise ValueError("the subnet is too small for %s workers" % self.__workers)
+
+        mask = (0xffffffff << (32 - mask_size)) & 0xffffffff
+        network = int.from_bytes(socket.inet_aton(ip), "big") & mask
+        self.__addr_worker_info = (network, mask, 32 - new_mask_size,)
+
+        i_ip = network + (self.__worker_id << (32 - new_mask_size))
+
+        return (socket.inet_ntoa(i_ip.to_bytes(4, "big")), new_mask_size,)
+
+    @property
+    def ipc_fd(self):
+        return self.__ipc_fd
+
+    @property
+    def worker_id(self):
+        return self.__worker_id
+
+    def get_addr_worker(self, byte_ip):
+        """获取分配虚拟局域网地址的工作进程编号,不在虚拟局域网中的地址属于当前工作进程"""
+        if self.__workers < 2: return self.__worker_id
+
+        network, mask, shift = self.__addr_worker_info
+        n = int.from_bytes(byte_ip, "big")
+        if n & mask != network: return self.__worker_id
+
+        return (n >> shift) & (self.__workers - 1)
+
+    def is_local_session(self, session_id):
+        """会话是否属于当前工作进程"""
+        if self.__workers < 2: return True
+
+        return worker_ipc.get_session_worker(session_id, self.__workers) == self.__worker_id
 
     def create_fn_server(self):
         name = "freenet.tunnels_auth.%s" % fns_config.configs["auth_module"]
@@ -27,22 +195,45 @@ class fdslightd(_fdsl.fdslight):
             sys.stderr = open(fns_config.configs["error_log"], "a+")
 
         subnet = fns_config.configs["subnet"]
-        nat = static_nat.nat(subnet)
+        nat_subnet = self.__get_worker_subnet(subnet)
+        nat_mode = fns_config.configs["nat_mode"]
 
-        subnet = fns_config.configs["subnet"]
+        if nat_mode == "static":
+            nat = static_nat.nat(nat_subnet, sticky=fns_config.configs["nat_sticky_addr"])
+        elif nat_mode == "napt":
+            nat = static_nat.napt(nat_subnet, timeouts=fns_config.configs["napt_timeouts"])
+        else:
+            raise ValueError("the nat_mode must be static or napt")
 
-        tun_fd = self.create_handler(-1, tundev.tuns, "fdslight", subnet, nat)
-        dns_fd = self.create_handler(-1, dns_proxy.dnsd_proxy, fns_config.configs["dns"])
+        # 多进程模式下每个工作进程打开同一个tun设备的一个队列,路由只需要添加一次
+        tun_fd = self.create_handler(-1, tundev.tuns, "fdslight", subnet, nat, add_route=self.__worker_id == 0,
+                                     multi_queue=self.__workers > 1)
+        self.get_handler(tun_fd).set_write_queue(**fns_config.configs["tun_write_queue"])
+        dns_fd = self.create_handler(-1, dns_proxy.dnsd_proxy, fns_config.configs["dns"], debug=self.debug,
+                                     **fns_config.configs["dns_upstream"])
         self.get_handler(dns_fd).set_dns_id_max(int(fns_config.configs["max_dns_request"]))
 
+        if self.__workers > 1:
+            self.__ipc_fd = self.create_handler(-1, worker_ipc.worker_ipc, self.__worker_id, self.__ipc_channels)
+            self.ctl_handler(-1, self.__ipc_fd, "set_listener", "tun", False, tun_fd)
+
         args = (tun_fd, -1, dns_fd, auth_module)
-        kwargs = {"debug": self.debug}
+        kwargs = {"debug": self.debug, "reuse_port": self.__workers > 1}
 
-        self.create_handler(-1, tunnels_udp.tunnels_udp_listener, *args, **kwargs)
-        self.create_handler(-1, tunnels_tcp.tunnel_tcp_listener, *args, **kwargs)
+        listeners = [
+            ("udp", False, self.create_handler(-1, tunnels_udp.tunnels_udp_listener, *args, **kwargs),),
+            ("tcp", False, self.create_handler(-1, tunnels_tcp.tunnel_tcp_listener, *args, **kwargs),),
+        ]
 
         if fns_config.configs["enable_ipv6_tunnel"]:
             kwargs["is_ipv6"] = True
-            self.create_handler(-1, tunnels_udp.tunnels_udp_listener, *args, **kwargs)
-            self.create_handler(-1, tunnels_tcp.tunnel_tcp_listener, *args, **kwargs)
+            listeners.append(
+                ("udp", True, self.create_handler(-1, tunnels_udp.tunnels_udp_listener, *args, **kwargs),))
+            listeners.append(
+                ("tcp", True, self.create_handler(-1, tunnels_tcp.tunnel_tcp_listener, *args, **kwargs),))
+
+        if self.__ipc_fd < 0: return
+        for proto, is_ipv6, fileno in listeners:
+            self.ctl_handler(-1, self.__ipc_fd, "set_listener", proto, is_ipv6, fileno)
+
         return
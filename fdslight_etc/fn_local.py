@@ -13,6 +13,7 @@ configs = {
     "tcp_crypto_module": {
         # 加密模块名
         # 注意,必须和加密模块的文件名字相同
+        # 可选的有aes_tcp,aes_gcm_tcp,chacha20_tcp,后两者为带认证的加密模块,服务端与客户端必须一致
         "name": "aes_tcp",
         # 加密模块配置
         "configs": {
@@ -20,10 +21,15 @@ configs = {
         },
     },
 
+    # TCP隧道是否请求使用v2格式,v2格式只发送很短的帧头,需要带认证的加密模块(aes_gcm_tcp,chacha20_tcp)
+    # 服务端不支持时继续使用原来的格式
+    "tcp_v2_framing": False,
+
     # UDP加密模块配置
     "udp_crypto_module": {
         # 加密模块名
         # 注意,必须和加密模块的文件名字相同
+        # 可选的有aes_udp,aes_gcm_udp,chacha20_udp,后两者为带认证的加密模块,服务端与客户端必须一致
         "name": "aes_udp",
         # 加密模块配置
         "configs": {
@@ -46,11 +52,40 @@ configs = {
     # 连接超时
     "timeout": 460,
 
+    # UDP隧道前向纠错(FEC),每k个数据包生成m个冗余包,一组中丢失不超过m个数据包时可以恢复
+    # 需要服务端支持,k为0表示关闭
+    "udp_fec": {
+        # 每组的数据包个数,最大16
+        "k": 0,
+        # 每组的冗余包个数,最大16
+        "m": 2,
+        # 最多同时等待恢复的组数
+        "window": 16,
+        # 组内不足k个数据包并且空闲这么多秒之后,为已经发送的数据包发送冗余包
+        "flush_time": 0.02,
+    },
+
     # 虚拟DNS地址,可以设置成任意地址,但是请不要设置成同局域网的地址
     # 注意:请不要把地址设置成与下面的remote_dns相同,并且在机器网络设置中把DNS改成虚拟DNS地址
     "virtual_dns": "223.5.5.5",
     # 远程DNS,即不经过隧道的实际DNS服务器,一般默认即可
     "remote_dns": "223.6.6.6",
+    # DNS响应缓存,按照响应中的TTL缓存,重复的查询直接在本地响应
+    "dns_cache": {
+        # 最多缓存的响应个数,0表示关闭缓存
+        "max_entries": 4096,
+        # 缓存的响应的最大总字节数,0表示不限制
+        "max_bytes": 4 * 1024 * 1024,
+        # 最长缓存时间,单位为秒
+        "max_ttl": 3600,
+        # 域名不存在或者没有记录的否定响应的最长缓存时间,单位为秒
+        "max_neg_ttl": 300,
+    },
+
+    # 是否使用epoll的边沿触发模式,只对linux有效
+    # 同一个事件只通知一次,可以减少大量空闲连接时的重复通知,读写不完整的处理者会重新激活描述符
+    "edge_triggered": False,
+
     # 访问日志
     "access_log": "/tmp/fdslight_access.log",
     # 故障日志
@@ -22,6 +22,22 @@ configs = {
         24
     ),
 
+    # NAT模式
+    # static:客户端局域网的每个主机映射到一个虚拟局域网地址,虚拟局域网的大小限制了客户端主机的个数
+    # napt:按照连接映射到虚拟局域网地址的端口,所有客户端主机共用少量地址,只支持TCP,UDP以及ICMP echo
+    "nat_mode": "static",
+
+    # static模式下,客户端重新连接之后是否尽可能分配与之前相同的虚拟局域网地址,减少NAT映射的变化
+    "nat_sticky_addr": True,
+
+    # napt模式下各个协议的空闲超时时间,单位为秒,tcp_closing为TCP连接收到FIN或者RST之后的超时时间
+    "napt_timeouts": {
+        "tcp": 900,
+        "tcp_closing": 120,
+        "udp": 180,
+        "icmp": 30,
+    },
+
     # IPV6版本的虚拟局域网
     # "subnet6":(),
 
@@ -29,6 +45,7 @@ configs = {
     "tcp_crypto_module": {
         # 加密模块名
         # 注意,必须和加密模块的文件名字相同
+        # 可选的有aes_tcp,aes_gcm_tcp,chacha20_tcp,后两者为带认证的加密模块,服务端与客户端必须一致
         "name": "aes_tcp",
         # 加密模块配置
         "configs": {
@@ -36,10 +53,14 @@ configs = {
         },
     },
 
+    # 是否接受客户端的TCP隧道v2格式请求,v2格式只发送很短的帧头,需要带认证的加密模块(aes_gcm_tcp,chacha20_tcp)
+    "tcp_v2_framing": True,
+
     # UDP加密模块配置
     "udp_crypto_module": {
         # 加密模块名
         # 注意,必须和加密模块的文件名字相同
+        # 可选的有aes_udp,aes_gcm_udp,chacha20_udp,后两者为带认证的加密模块,服务端与客户端必须一致
         "name": "aes_udp",
         # 加密模块配置
         "configs": {
@@ -47,6 +68,42 @@ configs = {
         }
     },
 
+    # 工作进程个数,必须是2的n次方,大于1时开启多进程模式
+    # 所有工作进程共用一个多队列tun设备(IFF_MULTI_QUEUE,需要linux 3.8以上),每个工作进程拥有一个队列
+    # 每个工作进程从虚拟局域网的一部分中分配地址,读取到其他工作进程的地址的数据包时转发给该进程
+    # 主进程只管理工作进程,异常退出的工作进程会被重新创建,启动之后很快退出时关闭整个服务
+    "workers": 1,
+
+    # 是否使用epoll的边沿触发模式,只对linux有效
+    # 同一个事件只通知一次,可以减少大量空闲连接时的重复通知,读写不完整的处理者会重新激活描述符
+    "edge_triggered": False,
+
+    # tun设备写队列配置,多进程模式下对每个工作进程的队列单独生效
+    "tun_write_queue": {
+        # 最大数据包个数
+        "max_size": 20,
+        # 最大字节数,0表示不限制
+        "max_bytes": 0,
+        # 队列满时的丢包策略,"head"丢弃最早的数据包,"tail"丢弃新的数据包
+        "drop_policy": "head",
+    },
+
+    # UDP隧道一次系统调用最多收发的数据包个数
+    "udp_io_batch": 32,
+
+    # UDP隧道前向纠错(FEC),每k个数据包生成m个冗余包,一组中丢失不超过m个数据包时可以恢复
+    # 服务端只对发送过冗余包的客户端开启,k为0表示关闭
+    "udp_fec": {
+        # 每组的数据包个数,最大16
+        "k": 8,
+        # 每组的冗余包个数,最大16
+        "m": 2,
+        # 最多同时等待恢复的组数
+        "window": 16,
+        # 组内不足k个数据包并且空闲这么多秒之后,为已经发送的数据包发送冗余包
+        "flush_time": 0.02,
+    },
+
     # 连接超时时间
     "timeout": 900,
 
@@ -59,10 +116,22 @@ configs = {
     # 访问日志
     "access_log": "/tmp/fdslight_access.log",
 
-    # 服务端的DNS代理服务器
-    "dns": "8.8.8.8",
+    # 服务端的DNS代理服务器,可以是一个地址或者多个地址的列表,需要指定端口时使用 ("8.8.8.8", 53)
+    "dns": ["8.8.8.8", "8.8.4.4"],
+    # 多个DNS服务器时的配置
+    "dns_upstream": {
+        # "race"同时向前两个可用的服务器发送请求,使用最快的响应
+        # "rtt"按照测量的响应时间加权随机选择一个服务器
+        "strategy": "race",
+        # 一个请求最多发送的次数,包括超时之后的重传
+        "max_tries": 3,
+        # 连续超时多少次之后降级服务器,降级期间只有在没有其他可用服务器时才使用
+        "max_failures": 3,
+    },
     # 最大TCP隧道连接数目
     "max_tcp_conns": 20,
+    # UDP隧道最多同时保存的客户端解析器个数,每个客户端地址一个,超过时删除最久没有使用的
+    "max_udp_parsers": 4096,
     # 最大DNS并发数目,最大只能是65535
     "max_dns_request": 2000,
 }
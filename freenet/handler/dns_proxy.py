@@ -1,191 +1,217 @@
 #!/usr/bin/env python3
 import pywind.evtframework.handler.udp_handler as udp_handler
 import pywind.lib.timer as timer
-import random, socket, sys
-import dns.message
+import socket, sys, time
 import fdslight_etc.fn_gw as fn_config
 import freenet.lib.utils as utils
-
-
-class _host_match(object):
-    """对域名进行匹配,以找到是否在符合的规则列表中
-    """
-    __rules = None
-
-    def __init__(self):
-        self.__rules = {}
-
-    def add_rule(self, host_rule):
-        host, flags = host_rule
-        tmplist = host.split(".")
-        tmplist.reverse()
-
-        if not tmplist: return
-
-        lsize = len(tmplist)
-        n = 0
-        tmpdict = self.__rules
-
-        old_name = ""
-        old_dict = tmpdict
-        while n < lsize:
-            name = tmplist[n]
-            if name not in tmpdict:
-                if name == "*" or n == lsize - 1:
-                    old_dict[old_name] = {name: flags}
-                    break
-                old_dict = tmpdict
-                tmpdict[name] = {}
-            if name == "*":
-                n += 1
-                continue
-            old_name = name
-            tmpdict = tmpdict[name]
-            n += 1
-
-        return
-
-    def match(self, host):
-        tmplist = host.split(".")
-        tmplist.reverse()
-        # 加一个空数据，用以匹配 xxx.xx这样的域名
-        tmplist.append("")
-
-        is_match = False
-        flags = 0
-
-        tmpdict = self.__rules
-        for name in tmplist:
-            if "*" in tmpdict:
-                is_match = True
-                flags = tmpdict["*"]
-                break
-            if name not in tmpdict: break
-            v = tmpdict[name]
-            if type(v) != dict:
-                is_match = True
-                flags = v
-                break
-            tmpdict = v
-
-        return (is_match, flags,)
-
-    def clear(self):
-        self.__rules = {}
+import freenet.lib.host_match as host_match
+import freenet.lib.dns_wire as dns_wire
+import freenet.lib.dns_cache as dns_cache
+import freenet.lib.dns_id_alloc as dns_id_alloc
+import freenet.lib.dns_upstream as dns_upstream
 
 
 class dns_base(udp_handler.udp_handler):
-    """DNS基本类"""
-    # 新的DNS ID映射到就的DNS ID
-    __dns_id_map = {}
+    """DNS基本类,每个处理者使用自己的DNS ID分配器"""
+    __dns_ids = None
 
-    # 空闲的dns ids
-    __empty_dns_ids = []
-    # 当前最大的DNS ID
-    __current_max_dns_id = 0
-    # 最大的DNS ID
-    __max_dns_id = 2000
+    def __init__(self):
+        super(dns_base, self).__init__()
+        self.__dns_ids = dns_id_alloc.dns_id_alloc()
 
     def set_dns_id_max(self, max_id):
+        """设置最大的同时进行的请求个数"""
         if max_id > 65535: max_id = 65535
-        if max_id < 0: max_id = self.__max_dns_id
-        self.__max_dns_id = max_id
-
-    def get_dns_id(self, old_dns_id):
-        if old_dns_id not in self.__dns_id_map: return old_dns_id
-
-        if not self.__empty_dns_ids:
-            n_dns_id = self.__empty_dns_ids.pop(0)
-        else:
-            self.__current_max_dns_id += 1
-            n_dns_id = self.__current_max_dns_id
-        return n_dns_id
-
-    def set_dns_id_map(self, dns_id, value):
-        self.__dns_id_map[dns_id] = value
+        if max_id < 1: return
+        self.__dns_ids.set_max_inflight(max_id)
+
+    def alloc_dns_id(self, value, timeout):
+        """分配新的DNS ID
+        :param value: 新的DNS ID对应的值
+        :param timeout: 等待响应的超时时间
+        :return int: 请求过多时返回None
+        """
+        return self.__dns_ids.get(value, timeout)
 
-    def del_dns_id_map(self, dns_id):
-        if dns_id in self.__dns_id_map:
-            self.__empty_dns_ids.append(dns_id)
-            del self.__dns_id_map[dns_id]
-        return
+    def free_dns_id(self, dns_id):
+        """回收DNS ID
+        :return: DNS ID对应的值,DNS ID不存在时返回None
+        """
+        return self.__dns_ids.put(dns_id)
 
     def get_dns_id_map(self, dns_id):
-        return self.__dns_id_map[dns_id]
-
-    def dns_id_map_exists(self, dns_id):
-        return dns_id in self.__dns_id_map
+        """:return: DNS ID对应的值,DNS ID不存在时返回None"""
+        return self.__dns_ids.get_value(dns_id)
 
-    def recyle_resource(self, dns_ids):
-        for dns_id in dns_ids: self.del_dns_id_map(dns_id)
-
-    def print_dns_id_map(self):
-        print(self.__dns_id_map)
+    def recycle_dns_ids(self):
+        """回收所有超时的DNS ID
+        :return list: 超时的DNS ID对应的值
+        """
+        return self.__dns_ids.recycle()
 
 
 class dnsd_proxy(dns_base):
-    """服务端的DNS代理"""
+    """服务端的DNS代理,支持多个上游服务器
+    请求的值的格式为 [原来的DNS ID,session_id,请求报文,{服务器序号:发送时间,...},{服务器序号:发送给这个服务器的次数,...},
+    是否已经响应,发送次数]
+    向同一个服务器重传过的请求无法确定响应对应哪一次发送,因此不测量响应时间(Karn算法,见RFC 6298)
+    重传超时之后才到达的响应在客户端还没有得到响应时仍然使用,但是不测量响应时间
+    收到第一个响应之后立即发送给客户端,等待其他服务器的响应或者超时之后再回收DNS ID,用于统计响应时间
+    """
     __TIMEOUT = 5
     __creator_fd = -1
-    __timer = None
 
-    def init_func(self, creator_fd, dns_server):
-        self.__timer = timer.timer()
+    __upstreams = None
+    __max_tries = 3
+    # 重传定时器
+    __retrans_timer = None
+    # 下一次调用udp_timeout的时间
+    __wakeup_time = 0
+
+    __debug = False
+    __STATS_INTERVAL = 60
+    __stats_time = 0
+
+    def init_func(self, creator_fd, dns_servers, strategy="race", max_tries=3, max_failures=3, debug=False):
+        """
+        :param dns_servers: 上游服务器,可以是一个地址或者多个地址的列表,见dns_upstream.upstreams
+        :param strategy: race或者rtt
+        :param max_tries: 一个请求最多发送的次数,包括重传
+        :param max_failures: 连续超时多少次之后降级服务器
+        """
         self.__creator_fd = creator_fd
+        self.__upstreams = dns_upstream.upstreams(dns_servers, strategy=strategy, max_failures=max_failures)
+        self.__max_tries = max_tries
+        self.__retrans_timer = timer.timer()
+        self.__debug = debug
+        self.__stats_time = time.monotonic()
 
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
         self.set_socket(s)
-        self.connect((dns_server, 53))
+        # 需要向多个服务器发送请求,因此不使用connect
+        self.bind(("0.0.0.0", 0))
         self.register(self.fileno)
         self.add_evt_read(self.fileno)
 
+        self.__wakeup_time = time.monotonic() + self.__TIMEOUT
         self.set_timeout(self.fileno, self.__TIMEOUT)
         return self.fileno
 
+    def __wakeup_after(self, seconds):
+        """保证在seconds秒之内调用udp_timeout"""
+        t = time.monotonic() + seconds
+        if t >= self.__wakeup_time: return
+
+        self.__wakeup_time = t
+        self.set_timeout(self.fileno, seconds)
+
+    def __send_request(self, dns_id, value):
+        """向选择的服务器发送请求并设置重传时间"""
+        upstreams = self.__upstreams
+        message, pending, tried = value[2:5]
+        now = time.monotonic()
+        rto = 0
+
+        for i in upstreams.select(exclude=tried):
+            pending[i] = now
+            tried[i] = tried.get(i, 0) + 1
+            upstreams.on_send(i)
+            rto = max(rto, upstreams.get_rto(i))
+            self.sendto(message, upstreams.get_address(i))
+        ''''''
+        value[6] += 1
+
+        self.add_evt_write(self.fileno)
+        self.__retrans_timer.set_timeout(dns_id, rto)
+        self.__wakeup_after(rto)
+
+    def __free(self, dns_id):
+        self.free_dns_id(dns_id)
+        if self.__retrans_timer.exists(dns_id): self.__retrans_timer.drop(dns_id)
+
+    def __handle_retrans_timeout(self):
+        upstreams = self.__upstreams
+
+        for dns_id in self.__retrans_timer.get_timeout_names():
+            if self.__retrans_timer.exists(dns_id): self.__retrans_timer.drop(dns_id)
+
+            value = self.get_dns_id_map(dns_id)
+            if not value: continue
+
+            pending = value[3]
+            for i in pending: upstreams.on_timeout(i)
+            pending.clear()
+
+            # 已经响应或者达到最大发送次数,客户端会自己重新请求
+            if value[5] or value[6] >= self.__max_tries:
+                self.free_dns_id(dns_id)
+                continue
+
+            self.__send_request(dns_id, value)
+        ''''''
+        return
+
     def udp_readable(self, message, address):
+        if len(message) < 12: return
+
+        i = self.__upstreams.get_index(address)
+        if i is None: return
+
         dns_id = (message[0] << 8) | message[1]
-        if not self.dns_id_map_exists(dns_id): return
-        n_dns_id, session_id = self.get_dns_id_map(dns_id)
-        L = list(message)
-        L[0:2] = (
-            (n_dns_id & 0xff00) >> 8,
-            n_dns_id & 0x00ff,
-        )
+        value = self.get_dns_id_map(dns_id)
+        # 丢弃没有发送过请求的服务器的响应
+        if not value or i not in value[4]: return
+
+        o_dns_id, session_id, _, pending, tried, answered, _ = value
+
+        # 只对还在等待并且只发送过一次的请求测量响应时间
+        send_time = pending.pop(i, None)
+        rtt = time.monotonic() - send_time if send_time is not None and tried[i] == 1 else None
+        self.__upstreams.on_answer(i, rtt)
+        if not pending: self.__free(dns_id)
+
+        if answered: return
+        value[5] = True
 
         if not self.dispatcher.is_bind_session(session_id): return
         fileno, _ = self.dispatcher.get_bind_session(session_id)
-        self.ctl_handler(self.fileno, fileno, "response_dns", session_id, bytes(L))
-        self.del_dns_id_map(dns_id)
-
-        if self.__timer.exists(dns_id): self.__timer.drop(dns_id)
+        self.ctl_handler(self.fileno, fileno, "response_dns", session_id, dns_wire.set_id(message, o_dns_id))
 
     def udp_writable(self):
         self.remove_evt_write(self.fileno)
 
     def udp_timeout(self):
-        dns_ids = self.__timer.get_timeout_names()
-        for dns_id in dns_ids:
-            if self.__timer.exists(dns_id): self.__timer.drop(dns_id)
+        self.__handle_retrans_timeout()
+        self.recycle_dns_ids()
 
-        self.recyle_resource(dns_ids)
-        self.set_timeout(self.fileno, self.__TIMEOUT)
+        now = time.monotonic()
+        if self.__debug and now - self.__stats_time >= self.__STATS_INTERVAL:
+            self.__stats_time = now
+            print("dns upstreams: %s" % self.__upstreams.get_stats())
+
+        seconds = self.__TIMEOUT
+        if not self.__retrans_timer.is_empty():
+            seconds = min(max(self.__retrans_timer.get_min_time(), 0.01), seconds)
+
+        self.__wakeup_time = now + seconds
+        self.set_timeout(self.fileno, seconds)
+
+    def get_upstream_stats(self):
+        return self.__upstreams.get_stats()
 
     def handler_ctl(self, from_fd, cmd, session_id, message):
         if cmd != "request_dns": return False
-        dns_id = (message[0] << 8) | message[1]
-        n_dns_id = self.get_dns_id(dns_id)
-        self.set_dns_id_map(n_dns_id, (dns_id, session_id,))
+        if len(message) < 12: return
 
-        L = list(message)
-        L[0:2] = (
-            (n_dns_id & 0xff00) >> 8,
-            n_dns_id & 0x00ff,
-        )
+        dns_id = (message[0] << 8) | message[1]
+        value = [dns_id, session_id, None, {}, {}, False, 0, ]
+        n_dns_id = self.alloc_dns_id(value, self.__TIMEOUT)
+        # 请求过多,丢弃请求
+        if n_dns_id is None: return
 
-        self.__timer.set_timeout(n_dns_id, self.__TIMEOUT)
-        self.add_evt_write(self.fileno)
-        self.send(bytes(L))
+        value[2] = dns_wire.set_id(message, n_dns_id)
+        self.__send_request(n_dns_id, value)
 
     def udp_error(self):
         self.delete_handler(self.fileno)
@@ -199,7 +225,6 @@ class dnsd_proxy(dns_base):
 class dnsgw_proxy(dns_base):
     """客户端的DNS代理"""
     __host_match = None
-    __timer = None
 
     __DNS_QUERY_TIMEOUT = 5
     __TIMEOUT = 10
@@ -208,26 +233,11 @@ class dnsgw_proxy(dns_base):
 
     __transparent_dns = None
 
-    # dns flags集合
-    __dns_flags = None
-
     __session_id = None
 
-    def __check_ipaddr(self, sts):
-        """检查是否是IP地址
-        :param sts:
-        :return:
-        """
-        tmplist = sts.split(".")
-        if len(tmplist) != 4:
-            return False
-
-        for i in tmplist:
-            try:
-                _ = int(i)
-            except ValueError:
-                return False
-        return True
+    # DNS响应缓存,为None表示关闭缓存
+    __cache = None
+    __cache_configs = None
 
     def __send_to_dns_server(self, server, message):
         self.add_evt_write(self.fileno)
@@ -235,18 +245,15 @@ class dnsgw_proxy(dns_base):
 
     def __send_to_client(self, message):
         dns_id = (message[0] << 8) | message[1]
-        if not self.dns_id_map_exists(dns_id): return
-        n_dns_id, dst_addr = self.get_dns_id_map(dns_id)
-        L = list(message)
-        L[0:2] = ((n_dns_id & 0xff00) >> 8, n_dns_id & 0x00ff,)
+        value = self.free_dns_id(dns_id)
+        if not value: return
 
-        new_pkt = bytes(L)
+        o_dns_id, dst_addr, _, key = value
+        # 只缓存问题与请求相同的响应,防止伪造的响应污染缓存
+        if self.__cache and key: self.__cache.put(message, key)
 
         self.add_evt_write(self.fileno)
-        self.sendto(new_pkt, dst_addr)
-        self.del_dns_id_map(dns_id)
-        if self.__timer.exists(dns_id): self.__timer.drop(dns_id)
-        if dns_id in self.__dns_flags: del self.__dns_flags[dns_id]
+        self.sendto(dns_wire.set_id(message, o_dns_id), dst_addr)
 
     def init_func(self, creator_fd, session_id, host_rules, debug=False):
         self.__transparent_dns = fn_config.configs["dns"]
@@ -261,9 +268,7 @@ class dnsgw_proxy(dns_base):
         self.bind((fn_config.configs["dns_bind"], 53))
         self.set_timeout(self.fileno, self.__TIMEOUT)
 
-        self.__host_match = _host_match()
-        self.__timer = timer.timer()
-        self.__dns_flags = {}
+        self.__host_match = host_match.host_match()
 
         for rule in host_rules: self.__host_match.add_rule(rule)
 
@@ -272,10 +277,50 @@ class dnsgw_proxy(dns_base):
 
         return self.fileno
 
+    def set_dns_cache(self, **kwargs):
+        """设置DNS缓存,参数见dns_cache.dns_cache,max_entries为0时关闭缓存"""
+        if kwargs.get("max_entries", 1) < 1:
+            self.__cache = None
+            self.__cache_configs = None
+            return
+
+        self.__cache_configs = kwargs
+        self.__cache = dns_cache.dns_cache(**kwargs)
+
+    def get_dns_cache_stats(self):
+        if not self.__cache: return None
+        return self.__cache.get_stats()
+
     def update_host_rules(self, host_rules):
-        """更新黑名单"""
-        self.__host_match.clear()
-        for rule in host_rules: self.__host_match.add_rule(rule)
+        """更新黑名单,先构建新的规则再替换,可以在后台线程中调用"""
+        match = host_match.host_match()
+        for rule in host_rules: match.add_rule(rule)
+        self.__host_match = match
+        # 规则改变之后缓存的响应可能来自不同的DNS服务器,替换为新的缓存
+        if self.__cache: self.__cache = dns_cache.dns_cache(**self.__cache_configs)
+
+    def __send_cached_response(self, message, query, address):
+        """从缓存中响应客户端
+        :return bool: 是否命中缓存
+        """
+        _, _, host, qtype, qclass = query
+        dns_id = (message[0] << 8) | message[1]
+
+        rs = self.__cache.get(host, qtype, qclass, dns_id)
+        if not rs: return False
+
+        response, ipv4s = rs
+        is_match, flags = self.__host_match.match(host)
+
+        # 与没有缓存时相同,匹配规则的域名都需要打开隧道,需要代理的域名仍然需要设置路由
+        if is_match and not self.dispatcher.is_bind_session(self.__session_id): self.dispatcher.open_tunnel()
+        if is_match and flags == 1:
+            for ip in ipv4s: self.dispatcher.set_router(ip)
+
+        self.add_evt_write(self.fileno)
+        self.sendto(response, address)
+
+        return True
 
     def udp_readable(self, message, address):
         # dns至少有12个字节
@@ -288,35 +333,28 @@ class dnsgw_proxy(dns_base):
             self.__send_to_client(message)
             return
 
-        dns_id = (message[0] << 8) | message[1]
-        n_dns_id = self.get_dns_id(dns_id)
-
-        self.set_dns_id_map(n_dns_id, (dns_id, address,))
-        L = list(message)
-        L[0:2] = ((n_dns_id & 0xff00) >> 8, n_dns_id & 0x00ff,)
-
-        # 设置资源超时,防止占用过多内存
-        self.__timer.set_timeout(n_dns_id, self.__TIMEOUT)
+        query = dns_wire.parse_query(message)
+        is_standard = query and query[0] == 0 and query[1] == 1
 
-        message = bytes(L)
-
-        msg = dns.message.from_wire(message)
-
-        questions = msg.question
-
-        if len(questions) != 1 or msg.opcode() != 0:
-            self.__send_to_dns_server(self.__transparent_dns, message)
-            return
+        if is_standard and self.__cache and self.__send_cached_response(message, query, address): return
 
-        """
-        q = questions[0]
-        if q.rdtype != 1 or q.rdclass != 1:
+        dns_id = (message[0] << 8) | message[1]
+        # 值的格式为 [原来的DNS ID,客户端地址,规则flags,缓存键],flags为None表示请求没有经过隧道
+        # 缓存键为 (qname,qtype,qclass),不能解析的请求为None
+        key = (query[2].lower(), query[3], query[4],) if is_standard else None
+        value = [dns_id, address, None, key, ]
+        n_dns_id = self.alloc_dns_id(value, self.__DNS_QUERY_TIMEOUT)
+        # 请求过多,丢弃请求
+        if n_dns_id is None: return
+
+        message = dns_wire.set_id(message, n_dns_id)
+
+        # 无法解析以及非标准的请求直接转发
+        if not is_standard:
             self.__send_to_dns_server(self.__transparent_dns, message)
             return
-        """
 
-        q = questions[0]
-        host = b".".join(q.name[0:-1]).decode("iso-8859-1")
+        host = query[2]
         pos = host.find(".")
 
         if pos > 0 and self.__debug: print(host)
@@ -338,19 +376,19 @@ class dnsgw_proxy(dns_base):
 
         fileno, _ = self.dispatcher.get_bind_session(self.__session_id)
 
-        self.__dns_flags[n_dns_id] = flags
+        value[2] = flags
         self.ctl_handler(self.fileno, fileno, "request_dns", message)
 
     def message_from_handler(self, from_fd, byte_data):
+        if len(byte_data) < 12: return
+
         dns_id = (byte_data[0] << 8) | byte_data[1]
-        if dns_id not in self.__dns_flags: return
-        msg = dns.message.from_wire(byte_data)
-        for rrset in msg.answer:
-            for cname in rrset:
-                ip = cname.__str__()
-                if not self.__check_ipaddr(ip): continue
-                if self.__dns_flags[dns_id] == 1: self.dispatcher.set_router(ip)
-                ''''''
+        value = self.get_dns_id_map(dns_id)
+        if not value or value[2] is None: return
+
+        answer = dns_wire.parse_response(byte_data)
+        if answer and value[2] == 1:
+            for ip in answer[0]: self.dispatcher.set_router(ip)
         self.__send_to_client(byte_data)
 
     def udp_writable(self):
@@ -362,22 +400,19 @@ class dnsgw_proxy(dns_base):
 
     def udp_timeout(self):
         # 清除超时的DNS ID占用的资源,节约内存
-        dns_ids = self.__timer.get_timeout_names()
-        for dns_id in dns_ids:
-            if self.__timer.exists(dns_id): self.__timer.drop(dns_id)
-            if dns_id in self.__dns_flags: del self.__dns_flags[dns_id]
-        self.recyle_resource(dns_ids)
+        self.recycle_dns_ids()
         self.set_timeout(self.fileno, self.__TIMEOUT)
 
+        if self.__debug and self.__cache: print("dns cache: %s" % self.__cache.get_stats())
+
         return
 
     def udp_error(self):
         self.delete_handler(self.fileno)
 
 
-class dnslc_proxy(udp_handler.udp_handler):
+class dnslc_proxy(dns_base):
     __LOOP_TIMEOUT = 10
-    __dns_map = None
 
     __DNS_QUERY_TIMEOUT = 5
     __match = None
@@ -385,14 +420,15 @@ class dnslc_proxy(udp_handler.udp_handler):
     __virt_ns_naddr = None
 
     __debug = False
-    __timer = None
+
+    # DNS响应缓存,为None表示关闭缓存
+    __cache = None
+    __cache_configs = None
 
     def init_func(self, creator, virtual_nameserver, remote_nameserver, debug=False):
-        self.__match = _host_match()
+        self.__match = host_match.host_match()
         self.__virt_ns_naddr = socket.inet_aton(virtual_nameserver)
-        self.__dns_map = {}
         self.__debug = debug
-        self.__timer = timer.timer()
 
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
@@ -401,26 +437,42 @@ class dnslc_proxy(udp_handler.udp_handler):
         self.register(self.fileno)
         self.add_evt_read(self.fileno)
 
+        self.set_timeout(self.fileno, self.__LOOP_TIMEOUT)
+
         return self.fileno
 
     def __send_dns_to_remote_ns(self, message):
         self.add_evt_write(self.fileno)
         self.send(message)
 
-    def __check_ipaddr(self, sts):
-        """检查是否是IP地址
-        :param sts:
-        :return:
+    def __send_to_host(self, daddr, dport, message):
+        # 欺骗主机,让主机认为DNS数据包是从虚拟DNS服务器响应的
+        pkts = utils.build_udp_packets(self.__virt_ns_naddr, daddr, 53, dport, message)
+        tun_fd = self.dispatcher.get_tun()
+        for pkt in pkts:
+            self.send_message_to_handler(self.fileno, tun_fd, pkt)
+        return
+
+    def __send_cached_response(self, daddr, dport, message, query):
+        """从缓存中响应主机
+        :return bool: 是否命中缓存
         """
-        tmplist = sts.split(".")
-        if len(tmplist) != 4:
-            return False
-
-        for i in tmplist:
-            try:
-                _ = int(i)
-            except ValueError:
-                return False
+        _, _, host, qtype, qclass = query
+        dns_id = (message[0] << 8) | message[1]
+
+        rs = self.__cache.get(host, qtype, qclass, dns_id)
+        if not rs: return False
+
+        response, ipv4s = rs
+        is_match, flags = self.__match.match(host)
+
+        # 与没有缓存时相同,匹配规则的域名都需要打开隧道,需要代理的域名仍然需要设置路由
+        if is_match and not self.dispatcher.tunnel_is_ok(): self.dispatcher.open_tunnel()
+        if is_match and flags == 1:
+            for ip in ipv4s: self.dispatcher.set_router(ip)
+
+        self.__send_to_host(daddr, dport, response)
+
         return True
 
     def __handle_data_from_tun(self, byte_data):
@@ -437,21 +489,29 @@ class dnslc_proxy(udp_handler.udp_handler):
         sport = (byte_data[a] << 8) | byte_data[b]
         dns_id = (message[0] << 8) | message[1]
 
-        msg = dns.message.from_wire(message)
-
-        questions = msg.question
+        query = dns_wire.parse_query(message)
+        is_standard = query and query[0] == 0 and query[1] == 1
 
         if ip_ver == 4: saddr = byte_data[12:16]
 
-        self.__dns_map[dns_id] = [saddr, sport, None, ]
-        self.__timer.set_timeout(dns_id, self.__DNS_QUERY_TIMEOUT)
+        if is_standard and self.__cache and self.__send_cached_response(saddr, sport, message, query): return
+
+        # 不同主机的请求可能使用相同的DNS ID,因此需要分配新的DNS ID
+        # 值的格式为 [主机地址,主机端口,规则flags,原来的DNS ID,缓存键],缓存键与dnsgw_proxy相同
+        key = (query[2].lower(), query[3], query[4],) if is_standard else None
+        value = [saddr, sport, None, dns_id, key, ]
+        n_dns_id = self.alloc_dns_id(value, self.__DNS_QUERY_TIMEOUT)
+        # 请求过多,丢弃请求
+        if n_dns_id is None: return
 
-        if len(questions) != 1 or msg.opcode() != 0:
+        message = dns_wire.set_id(message, n_dns_id)
+
+        # 无法解析以及非标准的请求直接转发
+        if not is_standard:
             self.__send_dns_to_remote_ns(message)
             return
 
-        q = questions[0]
-        host = b".".join(q.name[0:-1]).decode("iso-8859-1")
+        host = query[2]
         pos = host.find(".")
         if pos > 0 and self.__debug: print(host)
         is_match, flags = self.__match.match(host)
@@ -459,7 +519,7 @@ class dnslc_proxy(udp_handler.udp_handler):
         if not is_match:
             self.__send_dns_to_remote_ns(message)
             return
-        self.__dns_map[dns_id][2] = flags
+        value[2] = flags
         # 没有打开隧道,尝试打开隧道
         if not self.dispatcher.tunnel_is_ok(): self.dispatcher.open_tunnel()
         # 打开隧道失败,直接丢弃数据包
@@ -468,33 +528,47 @@ class dnslc_proxy(udp_handler.udp_handler):
         self.ctl_handler(self.fileno, fileno, "request_dns", message)
 
     def __handle_dns_response(self, message):
+        if len(message) < 12: return
+
         dns_id = (message[0] << 8) | message[1]
-        if dns_id not in self.__dns_map: return
-        msg = dns.message.from_wire(message)
-        daddr, dport, flags = self.__dns_map[dns_id]
+        value = self.free_dns_id(dns_id)
+        if not value: return
 
-        for rrset in msg.answer:
-            for cname in rrset:
-                ip = cname.__str__()
-                if not self.__check_ipaddr(ip): continue
-                if flags == 1: self.dispatcher.set_router(ip)
-            ''''''
+        daddr, dport, flags, o_dns_id, key = value
+        message = dns_wire.set_id(message, o_dns_id)
+        if self.__cache and key: self.__cache.put(message, key)
 
-        # 欺骗主机,让主机认为DNS数据包是从虚拟DNS服务器响应的
-        pkts = utils.build_udp_packets(self.__virt_ns_naddr, daddr, 53, dport, message)
-        tun_fd = self.dispatcher.get_tun()
-        for pkt in pkts:
-            self.send_message_to_handler(self.fileno, tun_fd, pkt)
-        return
+        answer = dns_wire.parse_response(message)
+        if answer and flags == 1:
+            for ip in answer[0]: self.dispatcher.set_router(ip)
+
+        self.__send_to_host(daddr, dport, message)
+
+    def set_dns_cache(self, **kwargs):
+        """设置DNS缓存,参数见dns_cache.dns_cache,max_entries为0时关闭缓存"""
+        if kwargs.get("max_entries", 1) < 1:
+            self.__cache = None
+            self.__cache_configs = None
+            return
+
+        self.__cache_configs = kwargs
+        self.__cache = dns_cache.dns_cache(**kwargs)
+
+    def get_dns_cache_stats(self):
+        if not self.__cache: return None
+        return self.__cache.get_stats()
 
     def update_host_rules(self, host_rules):
-        self.__match.clear()
+        """更新规则,先构建新的规则再替换,可以在后台线程中调用"""
+        match = host_match.host_match()
         for rule in host_rules:
             _, flags = rule
             # 不支持2号规则
             if flags == 2: continue
-            self.__match.add_rule(rule)
-        return
+            match.add_rule(rule)
+        self.__match = match
+        # 规则改变之后缓存的响应可能来自不同的DNS服务器,替换为新的缓存
+        if self.__cache: self.__cache = dns_cache.dns_cache(**self.__cache_configs)
 
     def udp_readable(self, messsage, address):
         self.__handle_dns_response(messsage)
@@ -511,12 +585,9 @@ class dnslc_proxy(udp_handler.udp_handler):
 
     def udp_timeout(self):
         self.set_timeout(self.fileno, self.__LOOP_TIMEOUT)
-        names = self.__timer.get_timeout_names()
-        for name in names:
-            if not self.__timer.exists(name): continue
-            self.__timer.drop(name)
-            del self.__dns_map[name]
-        return
+        self.recycle_dns_ids()
+
+        if self.__debug and self.__cache: print("dns cache: %s" % self.__cache.get_stats())
 
     def handler_ctl(self, from_fd, cmd, *args, **kwargs):
         if cmd != "response_dns": return
@@ -525,3 +596,124 @@ class dnslc_proxy(udp_handler.udp_handler):
 
     def message_from_handler(self, from_fd, byte_data):
         self.__handle_data_from_tun(byte_data)
+
+
+if __name__ == "__main__":
+    # 缓存命中时的隧道与路由检查,python3 -m freenet.handler.dns_proxy
+    import dns.message, dns.rrset
+    import pywind.evtframework.consts as consts
+    from pywind.global_vars import global_vars
+
+    sent = []
+
+
+    class _dispatcher(object):
+        """只记录隧道与路由操作的分发器"""
+
+        def __init__(self):
+            self.is_bound = True
+            self.tunnel_opens = 0
+            self.routers = []
+
+        def __getattr__(self, name):
+            return lambda *args, **kwargs: None
+
+        def is_bind_session(self, session_id):
+            return self.is_bound
+
+        def get_bind_session(self, session_id):
+            return (-1, None,)
+
+        def open_tunnel(self):
+            self.tunnel_opens += 1
+
+        def set_router(self, ip):
+            self.routers.append(ip)
+
+        def ctl_handler(self, src_fd, dst_fd, cmd, *args, **kwargs):
+            if cmd == "request_dns": sent.append((args[0], "tunnel",))
+            if cmd == "response_dns": sent.append((args[1], "client",))
+
+
+    class _proxy(dnsgw_proxy):
+        def bind(self, address):
+            super(_proxy, self).bind(("127.0.0.1", 0,))
+
+        def sendto(self, byte_data, address, flags=0):
+            sent.append((byte_data, address,))
+
+
+    disp = _dispatcher()
+    global_vars[consts.SERVER_INSTANCE_NAME] = disp
+
+    proxy = _proxy()
+    proxy.init_func(-1, b"0" * 16, [("proxy.example.com", 1,), ("udp.example.com", 2,), ("encrypt.example.com", 0,)])
+    proxy.set_dns_cache()
+    client = ("192.168.1.2", 5353,)
+
+    for host, flags in (("proxy.example.com", 1,), ("udp.example.com", 2,), ("encrypt.example.com", 0,)):
+        query = dns.message.make_query(host, "A")
+
+        # 第一次请求经过上游服务器,响应被缓存
+        disp.is_bound = True
+        proxy.udp_readable(query.to_wire(), client)
+        message, address = sent[-1]
+        if (address == "tunnel") == (flags == 2): raise SystemExit("wrong upstream for %s" % host)
+
+        response = dns.message.make_response(dns.message.from_wire(message))
+        response.answer.append(dns.rrset.from_text(host + ".", 300, "IN", "A", "1.2.3.4"))
+        if flags == 2:
+            proxy.udp_readable(response.to_wire(), (fn_config.configs["dns"], 53,))
+        else:
+            proxy.message_from_handler(-1, response.to_wire())
+        if sent[-1][1] != client: raise SystemExit("no response for %s" % host)
+
+        # 隧道关闭之后缓存命中,仍然需要打开隧道,只有需要代理的域名设置路由
+        disp.is_bound = False
+        disp.tunnel_opens = 0
+        disp.routers = []
+        proxy.udp_readable(query.to_wire(), client)
+        message, address = sent[-1]
+        if address != client or dns.message.from_wire(message).id != query.id: raise SystemExit(
+            "%s should be answered from the cache" % host)
+        if disp.tunnel_opens != 1: raise SystemExit("the tunnel should be opened for %s:%s" % (host, flags,))
+        if disp.routers != (["1.2.3.4"] if flags == 1 else []): raise SystemExit("wrong routers for %s" % host)
+    ''''''
+    print(proxy.get_dns_cache_stats())
+
+
+    # 重传超时之后到达的响应,在客户端还没有得到响应时仍然使用
+    class _server_proxy(dnsd_proxy):
+        def sendto(self, byte_data, address, flags=0):
+            sent.append((byte_data, address,))
+
+
+    dns_upstream.upstreams._upstreams__INIT_RTO = 0.05
+    servers = [("127.0.0.1", 5301,), ("127.0.0.2", 5302,), ("127.0.0.3", 5303,)]
+    server_proxy = _server_proxy()
+    server_proxy.init_func(-1, servers)
+    disp.is_bound = True
+
+    query = dns.message.make_query("late.example.com", "A")
+    del sent[:]
+    server_proxy.handler_ctl(-1, "request_dns", b"0" * 16, query.to_wire())
+    if [address for _, address in sent] != servers[0:2]: raise SystemExit("the query should race two servers")
+
+    # 前两个服务器都超时,重传到第三个服务器
+    time.sleep(0.06)
+    server_proxy.udp_timeout()
+    if sent[-1][1] != servers[2]: raise SystemExit("the query should be retransmitted to the third server")
+
+    response = dns.message.make_response(dns.message.from_wire(sent[0][0]))
+    response.answer.append(dns.rrset.from_text("late.example.com.", 300, "IN", "A", "1.2.3.4"))
+    server_proxy.udp_readable(response.to_wire(), servers[0])
+    if sent[-1][1] != "client" or dns.message.from_wire(sent[-1][0]).id != query.id:
+        raise SystemExit("the late answer should be sent to the client")
+
+    # 已经响应之后的其他响应不再发送给客户端,重传超时之后的响应不测量响应时间
+    n = len(sent)
+    server_proxy.udp_readable(response.to_wire(), servers[2])
+    if len(sent) != n: raise SystemExit("the client should be answered only once")
+    if [stats["srtt_ms"] for stats in server_proxy.get_upstream_stats()][0:2] != [None, None]:
+        raise SystemExit("the late answer should not be measured")
+    print(server_proxy.get_upstream_stats())
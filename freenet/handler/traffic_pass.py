@@ -68,10 +68,11 @@ class traffic_read(handler.handler):
             try:
                 pkt = os.read(self.fileno, 8192)
             except BlockingIOError:
-                break
+                return
             if not pkt: continue
             self.__qos.add_data(pkt)
-        return
+        # 边沿触发模式下没有读取到EAGAIN,需要重新激活
+        self.rearm(self.fileno)
 
     def delete(self):
         self.unregister(self.fileno)
@@ -233,40 +234,22 @@ class udp_proxy(udp_handler.udp_handler):
     def udp_writable(self):
         self.remove_evt_write(self.fileno)
 
-    def __modify_src_address(self, new_ip_pkt, pkt_list):
-        """修改源地址"""
-        old_checsum = (pkt_list[10] << 8) | pkt_list[11]
-        new_csum = checksum.calc_checksum_for_ip_change(
-            bytes(pkt_list[12:16]), new_ip_pkt, old_checsum
-        )
-
-        pkt_list[10:12] = ((new_csum & 0xff00) >> 8, new_csum & 0x00ff,)
-        pkt_list[12:16] = new_ip_pkt
-
     def __handle_ipv4_data_for_send(self, byte_data):
         ihl = (byte_data[0] & 0x0f) * 4
         bind_addr, bind_port = self.__bind_address
         bind_addr_pkt = socket.inet_aton(bind_addr)
-        L = list(byte_data)
 
         dst_addr = socket.inet_ntoa(byte_data[16:20])
 
         b = ihl
         e = ihl + 1
         sport = (byte_data[b] << 8) | byte_data[e]
-        # 修改源端口
-        e = e + 1
-        L[b:e] = ((bind_port & 0xff00) >> 8, bind_port & 0x00ff,)
-
-        b = ihl + 6
-        e = b + 2
-
-        # 改UDP校检和为0,即不计算校检和
-        L[b:e] = (0, 0,)
 
-        self.__modify_src_address(bind_addr_pkt, L)
+        # 修改源地址与源端口,同时修正IP与UDP校检和
+        data = bytearray(byte_data)
+        checksum.modify_address_in_place(bind_addr_pkt, data, checksum.FLAG_MODIFY_SRC_IP, bind_port)
 
-        message = bytes(L)
+        message = bytes(data)
         self.__internet_ip[dst_addr] = sport
         self.__timer.set_timeout(dst_addr, self.__UDP_SESSION_TIMEOUT)
         self.send_message_to_handler(self.fileno, self.__raw_socket_fd, message)
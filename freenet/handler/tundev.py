@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import os, sys, socket
+import os, sys, socket, collections
 import pywind.evtframework.handler.handler as handler
 import freenet.lib.fn_utils as fn_utils
 
@@ -9,48 +9,69 @@ try:
 except ImportError:
     pass
 
+# 写队列满时丢弃最早的数据包
+DROP_HEAD = "head"
+# 写队列满时丢弃新的数据包
+DROP_TAIL = "tail"
+
 
 class tun_base(handler.handler):
     __creator_fd = None
     # 要写入到tun的IP包
-    ___ip_packets_for_write = []
-    # 写入tun设备的最大IP数据包的个数
-    __MAX_WRITE_QUEUE_SIZE = 20
-    # 当前需要写入tun设备的IP数据包的个数
-    __current_write_queue_n = 0
+    __ip_packets_for_write = None
+    # 写队列中数据包的总字节数
+    __write_queue_bytes = 0
+    # 写队列的最大IP数据包的个数
+    __max_write_queue_size = 20
+    # 写队列的最大字节数,0表示不限制
+    __max_write_queue_bytes = 0
+    __drop_policy = DROP_HEAD
+
+    # 写队列统计,格式为 {"enqueued":n,"dequeued":n,"dropped":n,"blocked":n,"write_errors":n}
+    __write_stats = None
 
     __BLOCK_SIZE = 16 * 1024
+    # 每次读事件最多读取的IP包个数,读取到的IP包作为一批交给隧道处理
+    __MAX_READ_PACKETS = 16
 
-    def __create_tun_dev(self, name):
+    def __create_tun_dev(self, name, multi_queue=False):
         """创建tun 设备
         :param name:
+        :param multi_queue:是否使用IFF_MULTI_QUEUE,多个进程打开同一个设备时每个进程拥有一个队列
         :return fd:
         """
-        tun_fd = fn_utils.tuntap_create(name, fn_utils.IFF_TUN | fn_utils.IFF_NO_PI)
-        fn_utils.interface_up(name)
+        flags = fn_utils.IFF_TUN | fn_utils.IFF_NO_PI
+        if multi_queue: flags |= fn_utils.IFF_MULTI_QUEUE
 
+        tun_fd = fn_utils.tuntap_create(name, flags)
         if tun_fd < 0:
             raise SystemError("can not create tun device,please check your root")
 
+        fn_utils.interface_up(name)
+
         return tun_fd
 
     @property
     def creator(self):
         return self.__creator_fd
 
-    def init_func(self, creator_fd, tun_dev_name, *args, **kwargs):
+    def init_func(self, creator_fd, tun_dev_name, *args, multi_queue=False, **kwargs):
         """
         :param creator_fd:
         :param tun_dev_name:tun 设备名称
         :param subnet:如果是服务端则需要则个参数
+        :param multi_queue:是否作为多队列tun设备的一个队列打开
         """
-        tun_fd = self.__create_tun_dev(tun_dev_name)
+        tun_fd = self.__create_tun_dev(tun_dev_name, multi_queue=multi_queue)
 
         if tun_fd < 3:
             print("error:create tun device failed:%s" % tun_dev_name)
             sys.exit(-1)
 
         self.__creator_fd = creator_fd
+        self.__ip_packets_for_write = collections.deque()
+        self.__write_queue_bytes = 0
+        self.__write_stats = {"enqueued": 0, "dequeued": 0, "dropped": 0, "blocked": 0, "write_errors": 0}
 
         self.set_fileno(tun_fd)
         fcntl.fcntl(tun_fd, fcntl.F_SETFL, os.O_NONBLOCK)
@@ -58,33 +79,67 @@ class tun_base(handler.handler):
 
         return tun_fd
 
+    def set_write_queue(self, max_size=20, max_bytes=0, drop_policy=DROP_HEAD):
+        """设置写队列
+        :param max_size:最大IP数据包的个数
+        :param max_bytes:最大字节数,0表示不限制
+        :param drop_policy:队列满时的丢包策略,DROP_HEAD或者DROP_TAIL
+        :return:
+        """
+        if drop_policy not in (DROP_HEAD, DROP_TAIL,):
+            raise ValueError("the drop_policy must be %s or %s" % (DROP_HEAD, DROP_TAIL,))
+        if max_size < 1:
+            raise ValueError("the max_size must be more than 0")
+
+        self.__max_write_queue_size = max_size
+        self.__max_write_queue_bytes = max_bytes
+        self.__drop_policy = drop_policy
+
+    def get_write_queue_stats(self):
+        """获取写队列的统计信息"""
+        stats = self.__write_stats.copy()
+        stats["queued"] = len(self.__ip_packets_for_write)
+        stats["queued_bytes"] = self.__write_queue_bytes
+
+        return stats
+
     def dev_init(self, dev_name, *args, **kwargs):
         pass
 
     def evt_read(self):
-        for i in range(5):
+        ip_packets = []
+        for i in range(self.__MAX_READ_PACKETS):
             try:
-                ip_packet = os.read(self.fileno, self.__BLOCK_SIZE)
+                ip_packets.append(os.read(self.fileno, self.__BLOCK_SIZE))
             except BlockingIOError:
-                return
-            self.handle_ip_packet_from_read(ip_packet)
-        return
+                break
+            ''''''
+        if ip_packets: self.handle_ip_packets_from_read(ip_packets)
+        # 每次最多读取__MAX_READ_PACKETS个数据包,边沿触发模式下设备可能还有数据包
+        if len(ip_packets) == self.__MAX_READ_PACKETS: self.rearm(self.fileno)
 
     def evt_write(self):
-        try:
-            ip_packet = self.___ip_packets_for_write.pop(0)
-        except IndexError:
-            self.remove_evt_write(self.fileno)
-            return
+        """尽可能多地写入数据包,直到队列为空或者设备不可写"""
+        ip_packets = self.__ip_packets_for_write
+        stats = self.__write_stats
+        size = 0
 
-        self.__current_write_queue_n -= 1
-        try:
-            os.write(self.fileno, ip_packet)
-        except BlockingIOError:
-            self.__current_write_queue_n += 1
-            self.___ip_packets_for_write.insert(0, ip_packet)
-            return
-        ''''''
+        while ip_packets:
+            ip_packet = ip_packets[0]
+            try:
+                os.write(self.fileno, ip_packet)
+            except BlockingIOError:
+                stats["blocked"] += 1
+                break
+            except OSError:
+                # 设备不接受的数据包直接丢弃,防止阻塞整个队列
+                stats["write_errors"] += 1
+            ip_packets.popleft()
+            size += len(ip_packet)
+            stats["dequeued"] += 1
+
+        self.__write_queue_bytes -= size
+        if not ip_packets: self.remove_evt_write(self.fileno)
 
     def handle_ip_packet_from_read(self, ip_packet):
         """处理读取过来的IP包,重写这个方法
@@ -93,6 +148,14 @@ class tun_base(handler.handler):
         """
         pass
 
+    def handle_ip_packets_from_read(self, ip_packets):
+        """处理一次读事件读取到的所有IP包,默认逐个调用handle_ip_packet_from_read
+        需要批量加密的子类重写这个方法
+        :param ip_packets:IP包列表
+        :return None:
+        """
+        for ip_packet in ip_packets: self.handle_ip_packet_from_read(ip_packet)
+
     def handle_ip_packet_for_write(self, ip_packet):
         """处理要写入的IP包,重写这个方法
         :param ip_packet:
@@ -127,19 +190,38 @@ class tun_base(handler.handler):
         """
         pass
 
+    def __write_queue_is_full(self, size):
+        if len(self.__ip_packets_for_write) >= self.__max_write_queue_size: return True
+        if not self.__max_write_queue_bytes: return False
+
+        return self.__write_queue_bytes + size > self.__max_write_queue_bytes
+
     def add_to_sent_queue(self, ip_packet):
-        # 丢到超出规定的数据包,防止内存过度消耗
         n_ip_message = self.handle_ip_packet_for_write(ip_packet)
         if not n_ip_message: return
 
-        if self.__current_write_queue_n == self.__MAX_WRITE_QUEUE_SIZE:
-            # 删除第一个包,防止队列过多
-            self.__current_write_queue_n -= 1
-            self.___ip_packets_for_write.pop(0)
-            return
+        ip_packets = self.__ip_packets_for_write
+        stats = self.__write_stats
+        size = len(n_ip_message)
 
-        self.__current_write_queue_n += 1
-        self.___ip_packets_for_write.append(n_ip_message)
+        # 丢掉超出规定的数据包,防止内存过度消耗
+        if self.__write_queue_is_full(size):
+            if self.__drop_policy == DROP_TAIL:
+                stats["dropped"] += 1
+                return
+            while ip_packets and self.__write_queue_is_full(size):
+                self.__write_queue_bytes -= len(ip_packets.popleft())
+                stats["dropped"] += 1
+            # 数据包本身超出字节限制
+            if not ip_packets and self.__write_queue_is_full(size):
+                stats["dropped"] += 1
+                return
+            ''''''
+        ip_packets.append(n_ip_message)
+        self.__write_queue_bytes += size
+        stats["enqueued"] += 1
+
+        if len(ip_packets) == 1: self.add_evt_write(self.fileno)
 
 
 class tuns(tun_base):
@@ -177,13 +259,14 @@ class tuns(tun_base):
     def __add_route6(self, dev_name, subnet):
         pass
 
-    def dev_init(self, tun_devname, subnet, nat, is_ipv6=False):
+    def dev_init(self, tun_devname, subnet, nat, is_ipv6=False, add_route=True):
+        """
+        :param add_route: 是否添加路由,多进程模式下只需要一个工作进程添加
+        """
         self.register(self.fileno)
         self.add_evt_read(self.fileno)
-        if is_ipv6:
-            self.__add_route6(tun_devname, subnet)
-        else:
-            self.__add_route(tun_devname, subnet)
+        if add_route and is_ipv6: self.__add_route6(tun_devname, subnet)
+        if add_route and not is_ipv6: self.__add_route(tun_devname, subnet)
         self.__nat = nat
 
         if is_ipv6: self.__ip_ver = 6
@@ -197,17 +280,27 @@ class tuns(tun_base):
     def __handle_ipv6_packet_from_read(self, ip_packet):
         pass
 
-    def __handle_ipv4_packet_from_read(self, ip_packet):
+    def __get_ipv4_packet_dst(self, ip_packet):
+        """获取IPv4数据包要发送到的隧道
+        :return tuple: (fileno,session_id,msg),不需要发送时返回None
+        """
         protocol = ip_packet[9]
-        if protocol not in (1, 6, 17,): return
+        if protocol not in (1, 6, 17,): return None
 
         rs = self.__nat.get_ippkt2cLan_from_sLan(ip_packet)
-        if not rs: return
+        if not rs: return None
         session_id, msg = rs
-        if not self.dispatcher.is_bind_session(session_id): return
+        if not self.dispatcher.is_bind_session(session_id): return None
         fileno, _ = self.dispatcher.get_bind_session(session_id)
 
-        if not self.handler_exists(fileno): return
+        if not self.handler_exists(fileno): return None
+
+        return (fileno, session_id, msg,)
+
+    def __handle_ipv4_packet_from_read(self, ip_packet):
+        rs = self.__get_ipv4_packet_dst(ip_packet)
+        if not rs: return
+        fileno, session_id, msg = rs
 
         self.ctl_handler(self.fileno, fileno, "set_packet_session_id", session_id)
         self.send_message_to_handler(self.fileno, fileno, msg)
@@ -218,6 +311,41 @@ class tuns(tun_base):
         if ip_ver == 4: self.__handle_ipv4_packet_from_read(ip_packet)
         if ip_ver == 6: self.__handle_ipv6_packet_from_read(ip_packet)
 
+    def handle_ip_packets_from_read(self, ip_packets):
+        if self.__ip_ver != 4:
+            super(tuns, self).handle_ip_packets_from_read(ip_packets)
+            return
+
+        worker_id = self.dispatcher.worker_id
+        get_addr_worker = self.dispatcher.get_addr_worker
+        seq = []
+
+        for ip_packet in ip_packets:
+            if (ip_packet[0] & 0xf0) >> 4 != 4: continue
+            # 多队列模式下内核按照流选择队列,目的地址由其他工作进程分配时转发给该进程做地址转换
+            n = get_addr_worker(ip_packet[16:20])
+            if n == worker_id:
+                seq.append(ip_packet)
+            else:
+                self.ctl_handler(self.fileno, self.dispatcher.ipc_fd, "forward_tun", n, ip_packet)
+            ''''''
+        self.__handle_ipv4_packets(seq)
+
+    def __handle_ipv4_packets(self, ip_packets):
+        # 按会话分组,每个会话的数据包一次交给隧道加密
+        batches = collections.OrderedDict()
+        for ip_packet in ip_packets:
+            rs = self.__get_ipv4_packet_dst(ip_packet)
+            if not rs: continue
+            fileno, session_id, msg = rs
+            key = (fileno, session_id,)
+            if key not in batches: batches[key] = []
+            batches[key].append(msg)
+
+        for (fileno, session_id,), msgs in batches.items():
+            self.ctl_handler(self.fileno, fileno, "msg_batch_from_tun", session_id, msgs)
+        return
+
     def handle_ip_packet_for_write(self, ip_packet):
 
         return ip_packet
@@ -234,7 +362,8 @@ class tuns(tun_base):
         if ip_ver != self.__ip_ver: return
 
         n_ippkt = self.__nat.get_ippkt2sLan_from_cLan(self.__packet_session_id, ip_packet)
-        self.add_evt_write(self.fileno)
+        # napt模式下不支持的数据包会被丢弃
+        if not n_ippkt: return
         self.add_to_sent_queue(n_ippkt)
 
     def dev_timeout(self):
@@ -242,8 +371,10 @@ class tuns(tun_base):
         self.set_timeout(self.fileno, self.__LOOP_TIMEOUT)
 
     def handler_ctl(self, from_fd, cmd, *args, **kwargs):
-        if cmd not in ("set_packet_session_id",): return
+        if cmd not in ("set_packet_session_id", "msg_from_worker",): return
         if cmd == "set_packet_session_id": self.__packet_session_id, = args
+        # 其他工作进程从tun设备读取到的数据包
+        if cmd == "msg_from_worker": self.__handle_ipv4_packets(args)
 
 
 class tungw(tun_base):
@@ -259,6 +390,11 @@ class tungw(tun_base):
         if not self.handler_exists(tunnel_fd): return
         self.send_message_to_handler(self.fileno, tunnel_fd, ip_packet)
 
+    def handle_ip_packets_from_read(self, ip_packets):
+        tunnel_fd = self.dispatcher.get_tunnel()
+        if not self.handler_exists(tunnel_fd): return
+        self.ctl_handler(self.fileno, tunnel_fd, "msg_batch_from_tun", ip_packets)
+
     def handle_ip_packet_for_write(self, ip_packet):
         return ip_packet
 
@@ -270,7 +406,6 @@ class tungw(tun_base):
         self.delete_handler(self.fileno)
 
     def message_from_handler(self, from_fd, byte_data):
-        self.add_evt_read(self.fileno)
         self.add_to_sent_queue(byte_data)
 
 
@@ -292,6 +427,17 @@ class tunlc(tun_base):
         fileno = self.dispatcher.get_tunnel()
         self.send_message_to_handler(self.fileno, fileno, ip_packet)
 
+    def handle_ip_packets_from_read(self, ip_packets):
+        seq = []
+        for ip_packet in ip_packets:
+            if self.dispatcher.is_dns_request(ip_packet):
+                self.send_message_to_handler(self.fileno, self.dispatcher.get_dns(), ip_packet)
+            else:
+                seq.append(ip_packet)
+            ''''''
+        if not seq or not self.dispatcher.tunnel_is_ok(): return
+        self.ctl_handler(self.fileno, self.dispatcher.get_tunnel(), "msg_batch_from_tun", seq)
+
     def handle_ip_packet_for_write(self, ip_packet):
         return ip_packet
 
@@ -306,5 +452,4 @@ class tunlc(tun_base):
         pass
 
     def message_from_handler(self, from_fd, byte_data):
-        self.add_evt_write(self.fileno)
         self.add_to_sent_queue(byte_data)
@@ -24,6 +24,8 @@ class tunnelc_tcp(tcp_handler.tcp_handler):
     __dns_fd = -1
 
     __BUFSIZE = 16 * 1024
+    # 是否已经请求使用v2格式
+    __framing_offered = False
 
     __session_id = None
 
@@ -68,15 +70,48 @@ class tunnelc_tcp(tcp_handler.tcp_handler):
 
         return self.fileno
 
+    def __writer_is_full(self):
+        """发送缓冲区过大时,v1格式丢弃阻塞的包,v2格式的帧之间有关联,只能丢弃当前的数据包
+        :return Boolean: True表示丢弃当前的数据包
+        """
+        if self.writer.size() <= self.__BUFSIZE: return False
+        if self.__encrypt.framing == 2: return True
+
+        self.writer.flush()
+        return False
+
     def __send_data(self, sent_data, action=tunnel_tcp.ACT_DATA):
         self.__conn_time = time.time()
+        if self.__writer_is_full(): return
         sent_pkt = self.__encrypt.build_packet(self.__session_id, action, sent_data)
-        # 丢弃阻塞的包
-        if self.writer.size() > self.__BUFSIZE: self.writer.flush()
         self.__encrypt.reset()
         self.writer.write(sent_pkt)
         self.add_evt_write(self.fileno)
 
+    def __send_batch(self, packets):
+        """一次加密并发送多个数据包"""
+        self.__conn_time = time.time()
+        if self.__writer_is_full(): return
+        self.writer.write(self.__encrypt.build_batch(self.__session_id, tunnel_tcp.ACT_DATA, packets))
+        self.add_evt_write(self.fileno)
+
+    def __offer_framing(self):
+        """请求服务端使用v2格式"""
+        if not fngw_config.configs["tcp_v2_framing"]: return
+        if not self.__encrypt.framing_v2_is_supported(): return
+
+        self.__framing_offered = True
+        self.writer.write(self.__encrypt.build_offer(self.__session_id))
+        self.add_evt_write(self.fileno)
+
+    def __handle_framing(self, byte_data):
+        """服务端切换到v2格式之后,本端也切换到v2格式"""
+        if not byte_data or byte_data[0] != tunnel_tcp.FRAMING_SWITCH: return
+        if not self.__framing_offered or self.__encrypt.framing == 2: return
+
+        self.writer.write(self.__encrypt.build_switch(self.__session_id))
+        self.add_evt_write(self.fileno)
+
     def connect_ok(self):
         # 可能目标主机不可达到
         try:
@@ -98,6 +133,7 @@ class tunnelc_tcp(tcp_handler.tcp_handler):
         self.set_timeout(self.fileno, self.__LOOP_TIMEOUT)
         self.register(self.fileno)
         self.add_evt_read(self.fileno)
+        self.__offer_framing()
 
         while 1:
             try:
@@ -139,26 +175,21 @@ class tunnelc_tcp(tcp_handler.tcp_handler):
             return
         if action == tunnel_tcp.ACT_DNS: self.__handle_dns(resp_data)
         if action == tunnel_tcp.ACT_DATA: self.__handle_data_from_tunnel(resp_data)
+        if action == tunnel_tcp.ACT_FRAMING: self.__handle_framing(resp_data)
 
     def __send_dns(self, dns_msg):
         self.__send_data(dns_msg, action=tunnel_tcp.ACT_DNS)
 
     def tcp_readable(self):
         rdata = self.reader.read()
-        self.__decrypt.input(rdata)
-        while self.__decrypt.can_continue_parse():
-            try:
-                self.__decrypt.parse()
-            except proto_utils.ProtoError:
-                self.print_access_log("wrong_format_packet")
-                self.delete_handler(self.fileno)
-                return
-            while 1:
-                pkt_info = self.__decrypt.get_pkt()
-                if not pkt_info: break
-                self.__handle_read(*pkt_info)
-            ''''''
-        return
+        try:
+            results = self.__decrypt.input(rdata)
+        except proto_utils.ProtoError:
+            self.print_access_log("wrong_format_packet")
+            self.delete_handler(self.fileno)
+            return
+
+        for pkt_info in results: self.__handle_read(*pkt_info)
 
     def tcp_writable(self):
         self.remove_evt_write(self.fileno)
@@ -196,25 +227,42 @@ class tunnelc_tcp(tcp_handler.tcp_handler):
         sys.stdout.flush()
 
     def handler_ctl(self, from_fd, cmd, *args, **kwargs):
-        if cmd not in ("request_dns",): return
+        if cmd not in ("request_dns", "msg_batch_from_tun",): return
         if cmd == "request_dns":
             dns_msg, = args
             if not self.is_conn_ok():
                 self.__wait_sent.append((1, dns_msg))
                 return
             self.__send_dns(dns_msg)
+        if cmd == "msg_batch_from_tun":
+            msgs, = args
+            if not self.is_conn_ok():
+                self.__wait_sent.extend([(0, msg,) for msg in msgs])
+                return
+            self.__handle_traffic_batch_from_lan(msgs)
         return
 
-    def __handle_ipv4_traffic_from_lan(self, byte_data):
+    def __check_ipv4_traffic_from_lan(self, byte_data):
+        """检查局域网的IPv4数据包是否需要发送,需要发送时更新路由访问时间"""
         size = len(byte_data)
-        if size < 21: return
+        if size < 21: return False
 
         protocol = byte_data[9]
-        if protocol not in (1, 6, 17,): return
+        if protocol not in (1, 6, 17,): return False
 
         ipaddr = socket.inet_ntoa(byte_data[16:20])
         self.dispatcher.update_router_access_time(ipaddr)
-        self.__send_data(byte_data)
+
+        return True
+
+    def __handle_ipv4_traffic_from_lan(self, byte_data):
+        if self.__check_ipv4_traffic_from_lan(byte_data): self.__send_data(byte_data)
+
+    def __handle_traffic_batch_from_lan(self, packets):
+        # 暂时不支持IPv6
+        seq = [byte_data for byte_data in packets if (byte_data[0] & 0xf0) >> 4 == 4]
+        seq = [byte_data for byte_data in seq if self.__check_ipv4_traffic_from_lan(byte_data)]
+        if seq: self.__send_batch(seq)
 
     def __handle_ipv6_traffic_from_lan(self, byte_data):
         pass
@@ -6,6 +6,7 @@ import socket, sys, time
 import fdslight_etc.fn_gw as fngw_config
 import pywind.evtframework.handler.udp_handler as udp_handler
 import freenet.lib.base_proto.tunnel_udp as tunnel_proto
+import freenet.lib.base_proto.fec as fec
 import freenet.handler.traffic_pass as traffic_pass
 import freenet.lib.fdsl_ctl as fdsl_ctl
 import freenet.lib.base_proto.utils as proto_utils
@@ -36,6 +37,13 @@ class tunnelc_udp(udp_handler.udp_handler):
     __conn_time = 0
     __conn_timeout = 0
 
+    # 前向纠错,没有开启时为None,服务端只对发送过冗余包的客户端发送冗余包
+    __fec_encoder = None
+    __fec_decoder = None
+    __fec_flush_time = 0.02
+    # 下一次调用udp_timeout的时间
+    __wakeup_time = 0
+
     def init_func(self, creator_fd, session_id, dns_fd, raw_socket_fd, raw6_socket_fd, debug=False, is_ipv6=False):
         self.__server = fngw_config.configs["udp_server_address"]
 
@@ -51,6 +59,12 @@ class tunnelc_udp(udp_handler.udp_handler):
         self.__encrypt_m.config(crypto_config)
         self.__decrypt_m.config(crypto_config)
 
+        fec_config = fngw_config.configs["udp_fec"]
+        if int(fec_config["k"]):
+            self.__fec_encoder = fec.encoder(int(fec_config["k"]), int(fec_config["m"]))
+            self.__fec_decoder = fec.decoder(window=int(fec_config["window"]))
+            self.__fec_flush_time = float(fec_config["flush_time"])
+
         self.__debug = debug
 
         self.__session_id = session_id
@@ -85,6 +99,7 @@ class tunnelc_udp(udp_handler.udp_handler):
 
         account = fngw_config.configs["account"]
         self.__session_id = proto_utils.gen_session_id(account["username"], account["password"])
+        self.__wakeup_time = time.monotonic() + self.__LOOP_TIMEOUT
         self.set_timeout(self.fileno, self.__LOOP_TIMEOUT)
 
         return self.fileno
@@ -135,8 +150,47 @@ class tunnelc_udp(udp_handler.udp_handler):
         # print("send:", byte_data)
         for ippkt in ippkts: self.send(ippkt)
 
+        if self.__fec_encoder and action == tunnel_proto.ACT_DATA: self.__send_fec(byte_data)
+        self.add_evt_write(self.fileno)
+
+    def __send_batch(self, packets):
+        """一次加密并发送多个数据包"""
+        self.__conn_time = time.time()
+        for ippkt in self.__encrypt_m.build_batch(self.__session_id, tunnel_proto.ACT_DATA, packets): self.send(ippkt)
+
+        if self.__fec_encoder:
+            for byte_data in packets: self.__send_fec(byte_data)
         self.add_evt_write(self.fileno)
 
+    def __send_fec(self, byte_data):
+        """组满时发送前向纠错冗余包,组不完整时等待空闲之后发送"""
+        self.__send_repairs(self.__fec_encoder.add(byte_data))
+        if self.__fec_encoder.pending: self.__wakeup_after(self.__fec_flush_time)
+
+    def __send_repairs(self, repairs):
+        for repair in repairs:
+            ippkts = self.__encrypt_m.build_packets(self.__session_id, tunnel_proto.ACT_FEC, repair)
+            self.__encrypt_m.reset()
+            for ippkt in ippkts: self.send(ippkt)
+        return
+
+    def __wakeup_after(self, seconds):
+        """保证在seconds秒之内调用udp_timeout"""
+        t = time.monotonic() + seconds
+        if t >= self.__wakeup_time: return
+
+        self.__wakeup_time = t
+        self.set_timeout(self.fileno, seconds)
+
+    def get_fec_stats(self):
+        """获取前向纠错统计信息"""
+        if not self.__fec_decoder: return None
+
+        stats = self.__fec_decoder.get_stats()
+        stats.update(self.__fec_encoder.get_stats())
+
+        return stats
+
     def udp_readable(self, message, address):
         result = self.__decrypt_m.parse(message)
         if not result: return
@@ -148,7 +202,11 @@ class tunnelc_udp(udp_handler.udp_handler):
             self.print_access_log("can_not_found_action_%s" % action)
             return
 
-        if action == tunnel_proto.ACT_DATA: self.__handle_data_from_tunnel(byte_data)
+        if action == tunnel_proto.ACT_DATA and not self.__fec_decoder: self.__handle_data_from_tunnel(byte_data)
+        if action == tunnel_proto.ACT_DATA and self.__fec_decoder:
+            for pkt in self.__fec_decoder.input_data(byte_data): self.__handle_data_from_tunnel(pkt)
+        if action == tunnel_proto.ACT_FEC and self.__fec_decoder:
+            for pkt in self.__fec_decoder.input_repair(byte_data): self.__handle_data_from_tunnel(pkt)
         if action == tunnel_proto.ACT_DNS: self.send_message_to_handler(self.fileno, self.__dns_fd, byte_data)
 
     def udp_writable(self):
@@ -162,7 +220,17 @@ class tunnelc_udp(udp_handler.udp_handler):
         if time.time() - self.__conn_time > self.__conn_timeout:
             self.delete_handler(self.fileno)
             return
-        self.set_timeout(self.fileno, self.__LOOP_TIMEOUT)
+
+        seconds = self.__LOOP_TIMEOUT
+        if self.__fec_encoder:
+            repairs = self.__fec_encoder.flush(self.__fec_flush_time)
+            if repairs:
+                self.__send_repairs(repairs)
+                self.add_evt_write(self.fileno)
+            if self.__fec_encoder.pending: seconds = self.__fec_flush_time
+
+        self.__wakeup_time = time.monotonic() + seconds
+        self.set_timeout(self.fileno, seconds)
 
     def udp_delete(self):
         self.dispatcher.unbind_session_id(self.__session_id)
@@ -182,13 +250,18 @@ class tunnelc_udp(udp_handler.udp_handler):
     def __udp_local_proxy_for_send(self, byte_data):
         self.dispatcher.send_msg_to_udp_proxy(self.__session_id, byte_data)
 
-    def __handle_ipv4_traffic_from_lan(self, byte_data):
+    def __check_ipv4_traffic_from_lan(self, byte_data):
+        """检查局域网的IPv4数据包是否需要发送,需要发送时更新路由访问时间"""
         protocol = byte_data[9]
-        if protocol not in (1, 6, 17,): return
+        if protocol not in (1, 6, 17,): return False
 
         ipaddr = socket.inet_ntoa(byte_data[16:20])
         self.dispatcher.update_router_access_time(ipaddr)
-        self.__send_data(byte_data)
+
+        return True
+
+    def __handle_ipv4_traffic_from_lan(self, byte_data):
+        if self.__check_ipv4_traffic_from_lan(byte_data): self.__send_data(byte_data)
 
     def __handle_ipv6_traffic_from_lan(self, byte_data):
         pass
@@ -201,6 +274,12 @@ class tunnelc_udp(udp_handler.udp_handler):
         if version == 4: self.__handle_ipv4_traffic_from_lan(byte_data)
         if version == 6: self.__handle_ipv6_traffic_from_lan(byte_data)
 
+    def __handle_traffic_batch_from_lan(self, packets):
+        # 暂时不支持IPv6
+        seq = [byte_data for byte_data in packets if len(byte_data) >= 21 and (byte_data[0] & 0xf0) >> 4 == 4]
+        seq = [byte_data for byte_data in seq if self.__check_ipv4_traffic_from_lan(byte_data)]
+        if seq: self.__send_batch(seq)
+
     def message_from_handler(self, from_fd, byte_data):
         self.__handle_traffic_from_lan(byte_data)
 
@@ -213,7 +292,11 @@ class tunnelc_udp(udp_handler.udp_handler):
         sys.stdout.flush()
 
     def handler_ctl(self, from_fd, cmd, *args, **kwargs):
-        if cmd not in ("request_dns",): return False
+        if cmd not in ("request_dns", "msg_batch_from_tun",): return False
+        if cmd == "msg_batch_from_tun":
+            msgs, = args
+            self.__handle_traffic_batch_from_lan(msgs)
+            return True
         dns_msg, = args
         self.__send_data(dns_msg, action=tunnel_proto.ACT_DNS)
         return True
@@ -15,6 +15,8 @@ class tunnellc_tcp(tcp_handler.tcp_handler):
 
     __wait_sent = None
     __BUFSIZE = 16 * 1024
+    # 是否已经请求使用v2格式
+    __framing_offered = False
 
     __conn_time = 0
     __conn_timeout = 0
@@ -53,12 +55,30 @@ class tunnellc_tcp(tcp_handler.tcp_handler):
 
         return self.fileno
 
+    def __offer_framing(self):
+        """请求服务端使用v2格式"""
+        if not fnlc_config.configs["tcp_v2_framing"]: return
+        if not self.__encrypt.framing_v2_is_supported(): return
+
+        self.__framing_offered = True
+        self.writer.write(self.__encrypt.build_offer(self.__session_id))
+        self.add_evt_write(self.fileno)
+
+    def __handle_framing(self, byte_data):
+        """服务端切换到v2格式之后,本端也切换到v2格式"""
+        if not byte_data or byte_data[0] != tunnel_tcp.FRAMING_SWITCH: return
+        if not self.__framing_offered or self.__encrypt.framing == 2: return
+
+        self.writer.write(self.__encrypt.build_switch(self.__session_id))
+        self.add_evt_write(self.fileno)
+
     def connect_ok(self):
         self.__conn_time = time.time()
         self.set_timeout(self.fileno, self.__LOOP_TIMEOUT)
         self.dispatcher.tunnel_ok()
         self.register(self.fileno)
         self.add_evt_read(self.fileno)
+        self.__offer_framing()
 
         while 1:
             try:
@@ -78,6 +98,9 @@ class tunnellc_tcp(tcp_handler.tcp_handler):
             dns_fd = self.dispatcher.get_dns()
             self.ctl_handler(self.fileno, dns_fd, "response_dns", byte_data)
             return
+        if action == tunnel_tcp.ACT_FRAMING:
+            self.__handle_framing(byte_data)
+            return
         ip_ver = (byte_data[0] & 0xf0) >> 4
         # 暂时不支持ipv6
         if ip_ver == 6: return
@@ -86,19 +109,13 @@ class tunnellc_tcp(tcp_handler.tcp_handler):
 
     def tcp_readable(self):
         rdata = self.reader.read()
-        self.__decrypt.input(rdata)
-        while self.__decrypt.can_continue_parse():
-            try:
-                self.__decrypt.parse()
-            except proto_utils.ProtoError:
-                self.delete_handler(self.fileno)
-                return
-            while 1:
-                pkt_info = self.__decrypt.get_pkt()
-                if not pkt_info: break
-                self.__handle_data_from_tunnel(*pkt_info)
-            ''''''
-        return
+        try:
+            results = self.__decrypt.input(rdata)
+        except proto_utils.ProtoError:
+            self.delete_handler(self.fileno)
+            return
+
+        for pkt_info in results: self.__handle_data_from_tunnel(*pkt_info)
 
     def tcp_writable(self):
         self.remove_evt_write(self.fileno)
@@ -120,15 +137,31 @@ class tunnellc_tcp(tcp_handler.tcp_handler):
         self.close()
         self.dispatcher.tunnel_fail()
 
+    def __writer_is_full(self):
+        """发送缓冲区过大时,v1格式丢弃阻塞的包,v2格式的帧之间有关联,只能丢弃当前的数据包
+        :return Boolean: True表示丢弃当前的数据包
+        """
+        if self.writer.size() <= self.__BUFSIZE: return False
+        if self.__encrypt.framing == 2: return True
+
+        self.writer.flush()
+        return False
+
     def __send_data(self, sent_data, action=tunnel_tcp.ACT_DATA):
         self.__conn_time = time.time()
+        if self.__writer_is_full(): return
         sent_pkt = self.__encrypt.build_packet(self.__session_id, action, sent_data)
-        # 丢弃阻塞的包
-        if self.writer.size() > self.__BUFSIZE: self.writer.flush()
         self.__encrypt.reset()
         self.writer.write(sent_pkt)
         self.add_evt_write(self.fileno)
 
+    def __send_batch(self, packets):
+        """一次加密并发送多个数据包"""
+        self.__conn_time = time.time()
+        if self.__writer_is_full(): return
+        self.writer.write(self.__encrypt.build_batch(self.__session_id, tunnel_tcp.ACT_DATA, packets))
+        self.add_evt_write(self.fileno)
+
     def __handle_data_from_tun(self, byte_data):
         ip_ver = (byte_data[0] & 0xf0) >> 4
         if ip_ver not in (4, 6,): return
@@ -141,7 +174,15 @@ class tunnellc_tcp(tcp_handler.tcp_handler):
         self.__handle_data_from_tun(byte_data)
 
     def handler_ctl(self, from_fd, cmd, *args, **kwargs):
-        if cmd != "request_dns": return
+        if cmd not in ("request_dns", "msg_batch_from_tun",): return
+        if cmd == "msg_batch_from_tun":
+            msgs, = args
+            if not self.dispatcher.tunnel_is_ok():
+                self.__wait_sent.extend([(0, msg,) for msg in msgs])
+                return
+            seq = [byte_data for byte_data in msgs if (byte_data[0] & 0xf0) >> 4 in (4, 6,)]
+            if seq: self.__send_batch(seq)
+            return
         message, = args
         if not self.dispatcher.tunnel_is_ok():
             self.__wait_sent.append((1, message))
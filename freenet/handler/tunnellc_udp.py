@@ -3,6 +3,7 @@ import pywind.evtframework.handler.udp_handler as udp_handler
 import fdslight_etc.fn_local as fnlc_config
 import socket, sys, time
 import freenet.lib.base_proto.tunnel_udp as tunnel_udp
+import freenet.lib.base_proto.fec as fec
 
 
 class tunnellc_udp(udp_handler.udp_handler):
@@ -15,6 +16,13 @@ class tunnellc_udp(udp_handler.udp_handler):
     __conn_time = 0
     __conn_timeout = 0
 
+    # 前向纠错,没有开启时为None,服务端只对发送过冗余包的客户端发送冗余包
+    __fec_encoder = None
+    __fec_decoder = None
+    __fec_flush_time = 0.02
+    # 下一次调用udp_timeout的时间
+    __wakeup_time = 0
+
     def init_func(self, creator, session_id, is_ipv6=False):
         address = fnlc_config.configs["udp_server_address"]
         self.__conn_timeout = int(fnlc_config.configs["timeout"])
@@ -31,6 +39,12 @@ class tunnellc_udp(udp_handler.udp_handler):
         self.__encrypt.config(crypto_config)
         self.__decrypt.config(crypto_config)
 
+        fec_config = fnlc_config.configs["udp_fec"]
+        if int(fec_config["k"]):
+            self.__fec_encoder = fec.encoder(int(fec_config["k"]), int(fec_config["m"]))
+            self.__fec_decoder = fec.decoder(window=int(fec_config["window"]))
+            self.__fec_flush_time = float(fec_config["flush_time"])
+
         self.__session_id = session_id
         # 如果是域名,那么获取真是IP地址,防止死循环查询
         ipaddr = self.dispatcher.get_ipaddr(address[0])
@@ -43,6 +57,7 @@ class tunnellc_udp(udp_handler.udp_handler):
         self.set_socket(s)
 
         self.connect((ipaddr, address[1]))
+        self.__wakeup_time = time.monotonic() + self.__LOOP_TIMEOUT
         self.set_timeout(self.fileno, self.__LOOP_TIMEOUT)
         self.dispatcher.tunnel_ok()
         self.register(self.fileno)
@@ -70,8 +85,47 @@ class tunnellc_udp(udp_handler.udp_handler):
         # print("send:", byte_data)
         for ippkt in ippkts: self.send(ippkt)
 
+        if self.__fec_encoder and action == tunnel_udp.ACT_DATA: self.__send_fec(byte_data)
+        self.add_evt_write(self.fileno)
+
+    def __send_batch(self, packets):
+        """一次加密并发送多个数据包"""
+        self.__conn_time = time.time()
+        for ippkt in self.__encrypt.build_batch(self.__session_id, tunnel_udp.ACT_DATA, packets): self.send(ippkt)
+
+        if self.__fec_encoder:
+            for byte_data in packets: self.__send_fec(byte_data)
         self.add_evt_write(self.fileno)
 
+    def __send_fec(self, byte_data):
+        """组满时发送前向纠错冗余包,组不完整时等待空闲之后发送"""
+        self.__send_repairs(self.__fec_encoder.add(byte_data))
+        if self.__fec_encoder.pending: self.__wakeup_after(self.__fec_flush_time)
+
+    def __send_repairs(self, repairs):
+        for repair in repairs:
+            ippkts = self.__encrypt.build_packets(self.__session_id, tunnel_udp.ACT_FEC, repair)
+            self.__encrypt.reset()
+            for ippkt in ippkts: self.send(ippkt)
+        return
+
+    def __wakeup_after(self, seconds):
+        """保证在seconds秒之内调用udp_timeout"""
+        t = time.monotonic() + seconds
+        if t >= self.__wakeup_time: return
+
+        self.__wakeup_time = t
+        self.set_timeout(self.fileno, seconds)
+
+    def get_fec_stats(self):
+        """获取前向纠错统计信息"""
+        if not self.__fec_decoder: return None
+
+        stats = self.__fec_decoder.get_stats()
+        stats.update(self.__fec_encoder.get_stats())
+
+        return stats
+
     def __handle_data_from_tunnel(self, byte_data):
         ip_ver = (byte_data[0] & 0xf0) >> 4
         if ip_ver not in (4, 6,): return
@@ -86,7 +140,11 @@ class tunnellc_udp(udp_handler.udp_handler):
         if session_id != self.__session_id: return
         if action not in tunnel_udp.ACTS: return
 
-        if action == tunnel_udp.ACT_DATA: self.__handle_data_from_tunnel(byte_data)
+        if action == tunnel_udp.ACT_DATA and not self.__fec_decoder: self.__handle_data_from_tunnel(byte_data)
+        if action == tunnel_udp.ACT_DATA and self.__fec_decoder:
+            for pkt in self.__fec_decoder.input_data(byte_data): self.__handle_data_from_tunnel(pkt)
+        if action == tunnel_udp.ACT_FEC and self.__fec_decoder:
+            for pkt in self.__fec_decoder.input_repair(byte_data): self.__handle_data_from_tunnel(pkt)
         if action == tunnel_udp.ACT_DNS:
             dns_fd = self.dispatcher.get_dns()
             self.ctl_handler(self.fileno, dns_fd, "response_dns", byte_data)
@@ -99,7 +157,17 @@ class tunnellc_udp(udp_handler.udp_handler):
         if time.time() - self.__conn_time > self.__conn_timeout:
             self.delete_handler(self.fileno)
             return
-        self.set_timeout(self.fileno, self.__LOOP_TIMEOUT)
+
+        seconds = self.__LOOP_TIMEOUT
+        if self.__fec_encoder:
+            repairs = self.__fec_encoder.flush(self.__fec_flush_time)
+            if repairs:
+                self.__send_repairs(repairs)
+                self.add_evt_write(self.fileno)
+            if self.__fec_encoder.pending: seconds = self.__fec_flush_time
+
+        self.__wakeup_time = time.monotonic() + seconds
+        self.set_timeout(self.fileno, seconds)
 
     def udp_delete(self):
         self.unregister(self.fileno)
@@ -110,7 +178,11 @@ class tunnellc_udp(udp_handler.udp_handler):
         self.delete_handler(self.fileno)
 
     def handler_ctl(self, from_fd, cmd, *args, **kwargs):
-        if cmd != "request_dns": return
+        if cmd not in ("request_dns", "msg_batch_from_tun",): return
+        if cmd == "msg_batch_from_tun":
+            msgs, = args
+            self.__handle_batch_for_send(msgs)
+            return
         message, = args
         self.__send_data(message, action=tunnel_udp.ACT_DNS)
 
@@ -119,6 +191,14 @@ class tunnellc_udp(udp_handler.udp_handler):
         self.dispatcher.update_router_access_time(socket.inet_ntoa(daddr))
         self.__send_data(byte_data)
 
+    def __handle_batch_for_send(self, packets):
+        # 暂时不支持IPv6
+        seq = [byte_data for byte_data in packets if (byte_data[0] & 0xf0) >> 4 == 4]
+        if not seq: return
+
+        for byte_data in seq: self.dispatcher.update_router_access_time(socket.inet_ntoa(byte_data[16:20]))
+        self.__send_batch(seq)
+
     def __handle_ipv6_data_for_send(self, byte_data):
         pass
 
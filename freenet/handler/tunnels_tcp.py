@@ -21,7 +21,8 @@ class tunnel_tcp_listener(tcp_handler.tcp_handler):
 
     __auth_module = None
 
-    def init_func(self, creator_fd, tun_fd, tun6_fd, dns_fd, auth_module, debug=True, is_ipv6=False):
+    def init_func(self, creator_fd, tun_fd, tun6_fd, dns_fd, auth_module, debug=True, is_ipv6=False,
+                  reuse_port=False):
         self.__debug = debug
         self.__max_conns = fns_config.configs["max_tcp_conns"]
 
@@ -31,12 +32,15 @@ class tunnel_tcp_listener(tcp_handler.tcp_handler):
         self.__dns_fd = dns_fd
 
         if is_ipv6:
-            s = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+            s = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
             bind = fns_config.configs["tcp6_listen"]
         else:
             s = socket.socket()
             bind = fns_config.configs["tcp_listen"]
 
+        # 多进程模式下每个工作进程都绑定同一个端口
+        if reuse_port: s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
         self.__auth_module = auth_module
         self.set_socket(s)
         self.bind(bind)
@@ -47,20 +51,31 @@ class tunnel_tcp_listener(tcp_handler.tcp_handler):
 
         return self.fileno
 
+    def __create_conn(self, cs, caddr, init_data=b""):
+        """创建隧道连接
+        :return Boolean: False表示超过最大连接数
+        """
+        if self.__curr_conns == self.__max_conns:
+            cs.close()
+            return False
+
+        self.__curr_conns += 1
+        self.create_handler(self.fileno, tunnels_tcp_handler,
+                            self.__tun_fd, self.__tun6_fd, self.__dns_fd,
+                            cs, caddr, self.__auth_module, debug=self.__debug, init_data=init_data
+                            )
+        return True
+
     def tcp_accept(self):
         while 1:
             try:
                 cs, caddr = self.accept()
             except BlockingIOError:
                 break
-            if self.__curr_conns == self.__max_conns:
-                cs.close()
+            if not self.__create_conn(cs, caddr):
+                # 超过最大连接数时每次只关闭一个连接,边沿触发模式下需要重新激活以处理剩余的连接
+                self.rearm(self.fileno)
                 return
-            self.__curr_conns += 1
-            self.create_handler(self.fileno, tunnels_tcp_handler,
-                                self.__tun_fd, self.__tun6_fd, self.__dns_fd,
-                                cs, caddr, self.__auth_module, debug=self.__debug
-                                )
             ''''''
         return
 
@@ -81,8 +96,10 @@ class tunnel_tcp_listener(tcp_handler.tcp_handler):
         self.close()
 
     def handler_ctl(self, from_fd, cmd, *args, **kwargs):
-        if cmd not in ("del_conn",): return None
+        if cmd not in ("del_conn", "conn_from_worker",): return None
         if cmd == "del_conn": self.__curr_conns -= 1
+        # 其他工作进程转交过来的连接
+        if cmd == "conn_from_worker": self.__create_conn(*args)
 
         return None
 
@@ -110,12 +127,21 @@ class tunnels_tcp_handler(tcp_handler.tcp_handler):
 
     __auth_module = None
 
-    def init_func(self, creator_fd, tun_fd, tun6_fd, dns_fd, cs, caddr, auth_module, debug=True):
+    # 会话确定之前收到的原始数据,会话属于其他工作进程时需要与连接一起转交
+    __init_data = None
+    # 连接是否已经转交给其他工作进程
+    __is_handoff = False
+
+    # 是否接受客户端的v2格式协商
+    __framing_v2 = False
+
+    def init_func(self, creator_fd, tun_fd, tun6_fd, dns_fd, cs, caddr, auth_module, debug=True, init_data=b""):
         self.__debug = debug
         self.__caddr = caddr
         self.__auth_module = auth_module
 
         self.__conn_timeout = int(fns_config.configs["timeout"])
+        self.__framing_v2 = bool(fns_config.configs["tcp_v2_framing"])
 
         name = "freenet.lib.crypto.%s" % fns_config.configs["tcp_crypto_module"]["name"]
         __import__(name)
@@ -143,13 +169,31 @@ class tunnels_tcp_handler(tcp_handler.tcp_handler):
         self.add_evt_read(self.fileno)
 
         self.set_timeout(self.fileno, self.__LOOP_TIMEOUT)
+
+        self.__init_data = []
+
+        # 其他工作进程转交过来的连接,需要等待handler创建完成之后再处理已经收到的数据
+        if init_data:
+            self.reader._putvalue(init_data)
+            self.add_to_loop_task(self.fileno)
+            return self.fileno
+
         self.print_access_log("connect")
 
         return self.fileno
 
+    def __writer_is_full(self):
+        """发送缓冲区过大时,v1格式清空还没有发送的数据,v2格式的帧之间有关联,只能丢弃当前的数据包
+        :return Boolean: True表示丢弃当前的数据包
+        """
+        if self.writer.size() <= self.__BUFSIZE: return False
+        if self.encrypt.framing == 2: return True
+
+        self.writer.flush()
+        return False
+
     def __send_data(self, byte_data, action=tunnel_tcp.ACT_DATA):
-        # 清空还没有发送的数据
-        if self.writer.size() > self.__BUFSIZE: self.writer.flush()
+        if self.__writer_is_full(): return
         if not self.__auth_module.handle_send(self.__session_id, len(byte_data)): return
 
         self.__conn_time = time.time()
@@ -158,6 +202,17 @@ class tunnels_tcp_handler(tcp_handler.tcp_handler):
         self.add_evt_write(self.fileno)
         self.encrypt.reset()
 
+    def __send_batch(self, packets):
+        """一次加密并发送多个数据包"""
+        if self.__writer_is_full(): return
+
+        seq = [byte_data for byte_data in packets if self.__auth_module.handle_send(self.__session_id, len(byte_data))]
+        if not seq: return
+
+        self.__conn_time = time.time()
+        self.writer.write(self.encrypt.build_batch(self.__session_id, tunnel_tcp.ACT_DATA, seq))
+        self.add_evt_write(self.fileno)
+
     def __handle_ipv4_data_from_tunnel(self, byte_data):
         if not self.dispatcher.check_ipv4_data(byte_data):
             self.print_access_log("wrong_ip_packet")
@@ -185,6 +240,16 @@ class tunnels_tcp_handler(tcp_handler.tcp_handler):
         if ip_ver == 4: self.__handle_ipv4_data_from_tunnel(byte_data)
         if ip_ver == 6: self.__handle_ipv6_data_from_tunnel(byte_data)
 
+    def __handle_framing(self, byte_data):
+        """客户端请求使用v2格式时回复FRAMING_SWITCH,之后发送的数据使用v2格式"""
+        if byte_data != bytes((tunnel_tcp.FRAMING_OFFER,)): return
+        if not self.__framing_v2 or self.encrypt.framing == 2: return
+        if not self.encrypt.framing_v2_is_supported(): return
+
+        if self.__debug: self.print_access_log("framing_v2")
+        self.writer.write(self.encrypt.build_switch(self.__session_id))
+        self.add_evt_write(self.fileno)
+
     def __handle_dns_request(self, dns_msg):
         self.ctl_handler(self.fileno, self.__dns_fd, "request_dns", self.__session_id, dns_msg)
 
@@ -209,23 +274,34 @@ class tunnels_tcp_handler(tcp_handler.tcp_handler):
 
         if action == tunnel_tcp.ACT_DNS: self.__handle_dns_request(byte_data)
         if action == tunnel_tcp.ACT_DATA: self.__handle_data_from_tunnel(byte_data)
+        if action == tunnel_tcp.ACT_FRAMING: self.__handle_framing(byte_data)
+
+    def __handoff(self):
+        """把连接转交给会话所属的工作进程"""
+        self.__is_handoff = True
+        self.unregister(self.fileno)
+        self.ctl_handler(self.fileno, self.dispatcher.ipc_fd, "forward_tcp", self.__session_id, self.socket,
+                         self.__caddr, b"".join(self.__init_data))
+        self.delete_handler(self.fileno)
 
     def tcp_readable(self):
         rdata = self.reader.read()
-        self.__decrypt.input(rdata)
+        if self.__init_data is not None: self.__init_data.append(rdata)
 
-        while self.__decrypt.can_continue_parse():
-            try:
-                self.__decrypt.parse()
-            except proto_utils.ProtoError:
-                self.print_access_log("wrong_format_packet")
-                self.delete_handler(self.fileno)
+        try:
+            results = self.__decrypt.input(rdata)
+        except proto_utils.ProtoError:
+            self.print_access_log("wrong_format_packet")
+            self.delete_handler(self.fileno)
+            return
+
+        for pkt_info in results:
+            if not self.__session_id and not self.dispatcher.is_local_session(pkt_info[0]):
+                self.__session_id = pkt_info[0]
+                self.__handoff()
                 return
-            while 1:
-                pkt_info = self.decrypt.get_pkt()
-                if not pkt_info: break
-                self.__handle_read(*pkt_info)
-            ''''''
+            self.__handle_read(*pkt_info)
+            if self.__session_id: self.__init_data = None
         return
 
     @property
@@ -252,7 +328,16 @@ class tunnels_tcp_handler(tcp_handler.tcp_handler):
         self.__auth_module.handle_timing_task(self.__session_id)
         self.set_timeout(self.fileno, self.__LOOP_TIMEOUT)
 
+    def task_loop(self):
+        self.del_loop_task(self.fileno)
+        self.print_access_log("handoff")
+        self.tcp_readable()
+
     def tcp_delete(self):
+        if self.__is_handoff:
+            self.ctl_handler(self.fileno, self.__creator_fd, "del_conn")
+            return
+
         if self.__session_id:
             self.dispatcher.unbind_session_id(self.__session_id)
         self.print_access_log("conn_close")
@@ -269,12 +354,17 @@ class tunnels_tcp_handler(tcp_handler.tcp_handler):
         self.__send_data(byte_data, action=tunnel_tcp.ACT_DNS)
 
     def handler_ctl(self, from_fd, cmd, *args, **kwargs):
-        if cmd not in ("response_dns", "msg_from_udp_proxy", "set_packet_session_id",): return False
+        if cmd not in ("response_dns", "msg_from_udp_proxy", "set_packet_session_id", "msg_batch_from_tun",):
+            return False
         if cmd == "response_dns":
             session_id, dns_msg, = args
             self.__send_dns(dns_msg)
             return
         if cmd == "set_packet_session_id": return
+        if cmd == "msg_batch_from_tun":
+            session_id, msgs = args
+            self.__send_batch(msgs)
+            return
 
         session_id, msg = args
         self.__send_data(msg)
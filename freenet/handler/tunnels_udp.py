@@ -2,6 +2,8 @@
 import socket, sys, time
 import fdslight_etc.fn_server as fns_config
 import freenet.lib.base_proto.tunnel_udp as tunnel_proto
+import freenet.lib.base_proto.fec as fec
+import freenet.lib.fn_utils as fn_utils
 import pywind.evtframework.handler.udp_handler as udp_handler
 import pywind.lib.timer as timer
 
@@ -24,7 +26,10 @@ class tunnels_udp_listener(udp_handler.udp_handler):
     __dns_fd = -1
 
     __encrypt = None
-    __decrypt = None
+    # 每个客户端地址单独的解析器,避免不同客户端的分段互相影响
+    __decrypts = None
+    __crypto_m = None
+    __crypto_config = None
 
     __debug = False
 
@@ -33,7 +38,20 @@ class tunnels_udp_listener(udp_handler.udp_handler):
     # 当前包的session id
     __cur_packet_session_id = None
 
-    def init_func(self, creator_fd, tun_fd, tun6_fd, dns_fd, auth_module, debug=True, is_ipv6=False):
+    # 前向纠错,只对发送过冗余包的客户端开启,格式为 {session_id:encoder,...} 与 {session_id:decoder,...}
+    __fec_config = None
+    __fec_encoders = None
+    __fec_decoders = None
+    # 已经断开的会话的前向纠错统计
+    __fec_stats = None
+    # 有不完整的组的会话,格式为 {session_id:None,...}
+    __fec_pending = None
+    __fec_flush_time = 0.02
+    # 下一次调用udp_timeout的时间
+    __wakeup_time = 0
+
+    def init_func(self, creator_fd, tun_fd, tun6_fd, dns_fd, auth_module, debug=True, is_ipv6=False,
+                  reuse_port=False):
         self.__debug = debug
         config = fns_config.configs
 
@@ -47,17 +65,28 @@ class tunnels_udp_listener(udp_handler.udp_handler):
 
         crypto_config = config["udp_crypto_module"]["configs"]
 
-        self.__encrypt = m.encrypt()
-        self.__decrypt = m.decrypt()
+        self.__crypto_m = m
+        self.__crypto_config = crypto_config
 
+        self.__encrypt = m.encrypt()
         self.__encrypt.config(crypto_config)
-        self.__decrypt.config(crypto_config)
+
+        self.__decrypts = tunnel_proto.parser_contexts(self.__create_decrypt,
+                                                       max_contexts=int(config["max_udp_parsers"]),
+                                                       timeout=self.__SESSION_TIMEOUT)
 
         self.__timer = timer.timer()
         self.__debug = debug
         self.__sessions = {}
         self.__auth_module = auth_module
 
+        self.__fec_config = config["udp_fec"]
+        self.__fec_encoders = {}
+        self.__fec_decoders = {}
+        self.__fec_stats = {"repairs": 0, "recovered": 0, "unrecoverable": 0, "groups": 0, "flushes": 0, }
+        self.__fec_pending = {}
+        self.__fec_flush_time = float(self.__fec_config["flush_time"])
+
         if is_ipv6:
             bind_address = fns_config.configs["udp6_listen"]
         else:
@@ -68,11 +97,22 @@ class tunnels_udp_listener(udp_handler.udp_handler):
         else:
             s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
+        # 多进程模式下每个工作进程都绑定同一个端口
+        if reuse_port: s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
         self.set_socket(s)
         self.bind(bind_address)
+
+        # 批量收发数据,减少系统调用次数
+        io_batch = int(config["udp_io_batch"])
+        if hasattr(fn_utils, "udp_recvmmsg"):
+            self.set_io_batch(io_batch, fn_utils.udp_recvmmsg, fn_utils.udp_sendmmsg)
+        else:
+            self.set_recv_buf_qsize(io_batch)
         self.register(self.fileno)
         self.add_evt_read(self.fileno)
 
+        self.__wakeup_time = time.monotonic() + self.__LOOP_TIMEOUT
         self.set_timeout(self.fileno, self.__LOOP_TIMEOUT)
 
         self.__tun_fd = tun_fd
@@ -81,6 +121,14 @@ class tunnels_udp_listener(udp_handler.udp_handler):
 
         return self.fileno
 
+    def __create_decrypt(self):
+        decrypt = self.__crypto_m.decrypt()
+        decrypt.config(self.__crypto_config)
+        # 单个客户端同时重组的数据包不会太多
+        decrypt.set_reassembly(max_slots=64)
+
+        return decrypt
+
     def __register_session(self, session_id, address):
         """ 注册会话
         :param address:客户端地址
@@ -114,6 +162,14 @@ class tunnels_udp_listener(udp_handler.udp_handler):
 
         del self.__sessions[session_id]
 
+        self.__fec_pending.pop(session_id, None)
+        fec_encoder = self.__fec_encoders.pop(session_id, None)
+        if fec_encoder:
+            for k, v in fec_encoder.get_stats().items(): self.__fec_stats[k] += v
+        fec_decoder = self.__fec_decoders.pop(session_id, None)
+        if not fec_decoder: return
+        for k, v in fec_decoder.get_stats().items(): self.__fec_stats[k] += v
+
     def __handle_dns_request(self, session_id, dns_msg):
         self.ctl_handler(self.fileno, self.__dns_fd, "request_dns", session_id, dns_msg)
 
@@ -160,14 +216,109 @@ class tunnels_udp_listener(udp_handler.udp_handler):
             if not self.__auth_module.handle_send(session_id, len(byte_data)): return
             self.sendto(pkt, address)
 
+        self.__send_fec(session_id, address, byte_data)
+        self.add_evt_write(self.fileno)
+
+    def __send_batch(self, session_id, packets):
+        """一次加密并发送同一个会话的多个数据包"""
+        try:
+            address = self.__sessions[session_id]
+        except KeyError:
+            return
+
+        seq = [byte_data for byte_data in packets if self.__auth_module.handle_send(session_id, len(byte_data))]
+        if not seq: return
+
+        for pkt in self.__encrypt.build_batch(session_id, tunnel_proto.ACT_DATA, seq): self.sendto(pkt, address)
+        for byte_data in seq: self.__send_fec(session_id, address, byte_data)
+
         self.add_evt_write(self.fileno)
 
+    def __send_fec(self, session_id, address, byte_data):
+        """组满时发送前向纠错冗余包,组不完整时等待空闲之后发送"""
+        fec_encoder = self.__fec_encoders.get(session_id, None)
+        if not fec_encoder: return
+
+        self.__send_repairs(session_id, address, fec_encoder.add(byte_data))
+
+        if not fec_encoder.pending:
+            self.__fec_pending.pop(session_id, None)
+            return
+        self.__fec_pending[session_id] = None
+        self.__wakeup_after(self.__fec_flush_time)
+
+    def __send_repairs(self, session_id, address, repairs):
+        for repair in repairs:
+            pkts = self.__encrypt.build_packets(session_id, tunnel_proto.ACT_FEC, repair)
+            self.__encrypt.reset()
+            for pkt in pkts: self.sendto(pkt, address)
+        return
+
+    def __flush_fec(self):
+        """为空闲的不完整的组发送冗余包"""
+        for session_id in list(self.__fec_pending):
+            fec_encoder = self.__fec_encoders.get(session_id, None)
+            address = self.__sessions.get(session_id, None)
+            if not fec_encoder or not address:
+                del self.__fec_pending[session_id]
+                continue
+
+            repairs = fec_encoder.flush(self.__fec_flush_time)
+            if not repairs: continue
+
+            del self.__fec_pending[session_id]
+            self.__send_repairs(session_id, address, repairs)
+            self.add_evt_write(self.fileno)
+        return
+
+    def __wakeup_after(self, seconds):
+        """保证在seconds秒之内调用udp_timeout"""
+        t = time.monotonic() + seconds
+        if t >= self.__wakeup_time: return
+
+        self.__wakeup_time = t
+        self.set_timeout(self.fileno, seconds)
+
+    def __handle_fec(self, session_id, payload):
+        """处理前向纠错冗余包,收到第一个冗余包时为该会话开启前向纠错"""
+        if session_id not in self.__fec_decoders:
+            self.__fec_decoders[session_id] = fec.decoder(window=int(self.__fec_config["window"]))
+            k = int(self.__fec_config["k"])
+            if k: self.__fec_encoders[session_id] = fec.encoder(k, int(self.__fec_config["m"]))
+
+        for byte_data in self.__fec_decoders[session_id].input_repair(payload):
+            self.__handle_data_from_tunnel(session_id, byte_data)
+        return
+
+    def get_reassembly_stats(self):
+        """获取解析器与分段重组的统计信息"""
+        return self.__decrypts.get_stats()
+
+    def get_fec_stats(self):
+        """获取前向纠错统计信息"""
+        stats = dict(self.__fec_stats)
+
+        for fec_encoder in self.__fec_encoders.values():
+            for k, v in fec_encoder.get_stats().items(): stats[k] += v
+        for fec_decoder in self.__fec_decoders.values():
+            for k, v in fec_decoder.get_stats().items(): stats[k] += v
+        return stats
+
     def udp_readable(self, message, address):
-        result = self.__decrypt.parse(message)
+        result = self.__decrypts.get(address).parse(message)
         if not result: return
 
         session_id, action, byte_data = result
 
+        # 会话属于其他工作进程,那么转发给该进程处理
+        if not self.dispatcher.is_local_session(session_id):
+            self.ctl_handler(self.fileno, self.dispatcher.ipc_fd, "forward_udp", session_id, action, byte_data,
+                             address)
+            return
+
+        self.__handle_msg(session_id, action, byte_data, address)
+
+    def __handle_msg(self, session_id, action, byte_data, address):
         if self.dispatcher.is_bind_session(session_id):
             fileno, other = self.dispatcher.get_bind_session(session_id)
             if fileno != self.fileno and other == "tcp": self.delete_handler(fileno)
@@ -185,8 +336,14 @@ class tunnels_udp_listener(udp_handler.udp_handler):
         self.__modify_client_address(session_id, address)
         self.__timer.set_timeout(session_id, self.__SESSION_TIMEOUT)
 
-        if action == tunnel_proto.ACT_DATA: self.__handle_data_from_tunnel(session_id, byte_data)
+        if action == tunnel_proto.ACT_DATA:
+            fec_decoder = self.__fec_decoders.get(session_id, None)
+            if not fec_decoder:
+                self.__handle_data_from_tunnel(session_id, byte_data)
+                return
+            for pkt in fec_decoder.input_data(byte_data): self.__handle_data_from_tunnel(session_id, pkt)
         if action == tunnel_proto.ACT_DNS: self.__handle_dns_request(session_id, byte_data)
+        if action == tunnel_proto.ACT_FEC: self.__handle_fec(session_id, byte_data)
 
         return
 
@@ -202,7 +359,14 @@ class tunnels_udp_listener(udp_handler.udp_handler):
                 self.__unregister_session(name)
                 self.__auth_module.handle_timing_task(b"")
             continue
-        self.set_timeout(self.fileno, self.__LOOP_TIMEOUT)
+        self.__decrypts.expire()
+        self.__flush_fec()
+
+        seconds = self.__LOOP_TIMEOUT
+        if self.__fec_pending: seconds = self.__fec_flush_time
+
+        self.__wakeup_time = time.monotonic() + seconds
+        self.set_timeout(self.fileno, seconds)
 
     def udp_delete(self):
         self.unregister(self.fileno)
@@ -227,7 +391,13 @@ class tunnels_udp_listener(udp_handler.udp_handler):
         self.add_evt_write(self.fileno)
 
     def handler_ctl(self, from_fd, cmd, *args, **kwargs):
-        if cmd not in ("response_dns", "msg_from_udp_proxy", "set_packet_session_id",): return False
+        if cmd not in ("response_dns", "msg_from_udp_proxy", "set_packet_session_id", "msg_from_worker",
+                       "msg_batch_from_tun",):
+            return False
+
+        if cmd == "msg_from_worker":
+            self.__handle_msg(*args)
+            return True
 
         if cmd == "response_dns":
             session_id, dns_msg = args
@@ -237,6 +407,10 @@ class tunnels_udp_listener(udp_handler.udp_handler):
         if cmd == "set_packet_session_id":
             self.__cur_packet_session_id, = args
             return True
+        if cmd == "msg_batch_from_tun":
+            session_id, msgs = args
+            self.__send_batch(session_id, msgs)
+            return True
 
         session_id, msg = args
         if session_id not in self.__sessions: return True
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+"""工作进程之间的通信
+每个工作进程拥有一对UNIX数据报套接字,其他工作进程通过发送端把消息发送到这个工作进程
+UDP隧道数据包在解密之后转发给会话所属的工作进程,TCP隧道连接则把文件描述符转交给会话所属的工作进程
+从tun设备的队列中读取到的其他工作进程的数据包转发给分配该地址的工作进程
+"""
+import socket, struct
+import pywind.evtframework.handler.handler as handler
+
+# 转发UDP隧道数据
+MSG_UDP = 1
+# 转交TCP隧道连接
+MSG_TCP = 2
+# 转发从tun设备读取的数据包
+MSG_TUN = 3
+
+# 消息头格式为 msg_type(1) + port(2) + flowinfo(4) + scope_id(4) + host_len(1),之后为host
+# IPv4地址的flowinfo与scope_id为0
+_HDR_FMT = "!BHIIB"
+_HDR_SIZE = struct.calcsize(_HDR_FMT)
+
+# 一次最多读取的消息个数
+_MAX_RECV_NUM = 64
+_RECV_SIZE = 65536
+
+
+def get_session_worker(session_id, workers):
+    """获取会话所属的工作进程编号"""
+    return int.from_bytes(session_id[0:4], "big") % workers
+
+
+def create_channels(workers):
+    """创建工作进程的通信通道,必须在fork之前调用
+    :param workers: 工作进程的个数
+    :return list: [(recv_socket,send_socket),...]
+    """
+    channels = []
+
+    for i in range(workers):
+        r, w = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        r.setblocking(0)
+        w.setblocking(0)
+        channels.append((r, w,))
+
+    return channels
+
+
+class worker_ipc(handler.handler):
+    __worker_id = 0
+    __workers = 1
+    __socket = None
+    # 发送到其他工作进程的套接字,格式为 {worker_id:socket,...}
+    __peers = None
+    # 隧道监听者,格式为 {(proto,is_ipv6):fd,...}
+    __listeners = None
+
+    def init_func(self, creator_fd, worker_id, channels):
+        self.__worker_id = worker_id
+        self.__workers = len(channels)
+        self.__peers = {}
+        self.__listeners = {}
+
+        for i, (r, w) in enumerate(channels):
+            if i == worker_id:
+                self.__socket = r
+                w.close()
+                continue
+            r.close()
+            self.__peers[i] = w
+
+        self.set_fileno(self.__socket.fileno())
+        self.register(self.fileno)
+        self.add_evt_read(self.fileno)
+
+        return self.fileno
+
+    def __build_msg(self, msg_type, address, byte_data):
+        host = address[0].encode()
+        if len(address) == 4:
+            flowinfo, scope_id = address[2:4]
+        else:
+            flowinfo, scope_id = (0, 0,)
+
+        return b"".join([struct.pack(_HDR_FMT, msg_type, address[1], flowinfo, scope_id, len(host)), host, byte_data])
+
+    def __send(self, session_id, msg, fds=None):
+        """发送消息到会话所属的工作进程
+        :return Boolean: False表示发送失败
+        """
+        return self.__send_to_worker(get_session_worker(session_id, self.__workers), msg, fds=fds)
+
+    def __send_to_worker(self, worker_id, msg, fds=None):
+        w = self.__peers.get(worker_id, None)
+        if not w: return False
+
+        try:
+            if fds:
+                socket.send_fds(w, [msg], fds)
+            else:
+                w.send(msg)
+        except (BlockingIOError, ConnectionError, FileNotFoundError):
+            return False
+
+        return True
+
+    def __forward_udp(self, session_id, action, byte_data, address):
+        msg = self.__build_msg(MSG_UDP, address, b"".join([session_id, bytes([action]), byte_data]))
+        self.__send(session_id, msg)
+
+    def __forward_tun(self, worker_id, ip_packet):
+        msg = self.__build_msg(MSG_TUN, ("", 0,), ip_packet)
+        self.__send_to_worker(worker_id, msg)
+
+    def __forward_tcp(self, session_id, cs, address, byte_data):
+        msg = self.__build_msg(MSG_TCP, address, byte_data)
+        self.__send(session_id, msg, fds=[cs.fileno()])
+        # 不管是否转交成功,当前进程都不再拥有这个连接
+        cs.close()
+
+    def __handle_msg(self, msg, fds):
+        if len(msg) < _HDR_SIZE: return
+
+        msg_type, port, flowinfo, scope_id, host_len = struct.unpack(_HDR_FMT, msg[0:_HDR_SIZE])
+        b = _HDR_SIZE
+        e = b + host_len
+        host = msg[b:e].decode()
+
+        is_ipv6 = ":" in host
+        if is_ipv6:
+            address = (host, port, flowinfo, scope_id,)
+        else:
+            address = (host, port,)
+
+        if msg_type == MSG_TUN:
+            fileno = self.__listeners.get(("tun", False,), -1)
+            if not self.handler_exists(fileno): return
+            self.ctl_handler(self.fileno, fileno, "msg_from_worker", msg[e:])
+            return
+
+        if msg_type == MSG_UDP:
+            fileno = self.__listeners.get(("udp", is_ipv6,), -1)
+            if len(msg) < e + 17 or not self.handler_exists(fileno): return
+            session_id = msg[e:e + 16]
+            action = msg[e + 16]
+            self.ctl_handler(self.fileno, fileno, "msg_from_worker", session_id, action, msg[e + 17:], address)
+            return
+
+        if msg_type != MSG_TCP or not fds: return
+
+        cs = socket.socket(fileno=fds[0])
+        fileno = self.__listeners.get(("tcp", is_ipv6,), -1)
+
+        if not self.handler_exists(fileno):
+            cs.close()
+            return
+
+        self.ctl_handler(self.fileno, fileno, "conn_from_worker", cs, address, msg[e:])
+
+    def evt_read(self):
+        for i in range(_MAX_RECV_NUM):
+            try:
+                msg, fds, _, _ = socket.recv_fds(self.__socket, _RECV_SIZE, 1)
+            except BlockingIOError:
+                return
+            # 多余的文件描述符直接关闭
+            for fd in fds[1:]: socket.close(fd)
+            self.__handle_msg(msg, fds)
+        # 边沿触发模式下没有读取到EAGAIN,需要重新激活
+        self.rearm(self.fileno)
+
+    def error(self):
+        self.delete_handler(self.fileno)
+
+    def delete(self):
+        self.unregister(self.fileno)
+        self.__socket.close()
+        for w in self.__peers.values(): w.close()
+
+    def handler_ctl(self, from_fd, cmd, *args, **kwargs):
+        if cmd not in ("set_listener", "forward_udp", "forward_tcp", "forward_tun",): return False
+
+        if cmd == "set_listener":
+            proto, is_ipv6, fileno = args
+            self.__listeners[(proto, is_ipv6,)] = fileno
+            return True
+
+        if cmd == "forward_udp":
+            self.__forward_udp(*args)
+            return True
+
+        if cmd == "forward_tun":
+            self.__forward_tun(*args)
+            return True
+
+        self.__forward_tcp(*args)
+        return True
+
+
+if __name__ == "__main__":
+    # 1到N个工作进程的UDP隧道吞吐量测试,python3 -m freenet.handler.worker_ipc [max_workers] [seconds]
+    # 每个工作进程使用SO_REUSEPORT绑定同一个端口,解密之后把不属于自己的会话转发给所属的工作进程
+    # 客户端进程从多个源端口发送加密的数据包,统计所有工作进程每秒处理的数据包个数
+    import os, sys, time
+    import pywind.evtframework.evt_dispatcher as dispatcher
+    import pywind.evtframework.handler.udp_handler as udp_handler
+    import freenet.lib.base_proto.tunnel_udp as tunnel_proto
+    import freenet.lib.crypto.aes_gcm_udp as crypto
+
+    try:
+        import freenet.lib.fn_utils as fn_utils
+    except ImportError:
+        fn_utils = None
+
+    CRYPTO_CONFIG = {"key": "fdslight-benchmark"}
+    SESSIONS = 256
+    CLIENT_SOCKETS = 16
+
+
+    class bench_listener(udp_handler.udp_handler):
+        __decrypt = None
+        __counts = None
+
+        def init_func(self, creator_fd, port, counts):
+            self.__decrypt = crypto.decrypt()
+            self.__decrypt.config(CRYPTO_CONFIG)
+            self.__counts = counts
+
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+            self.set_socket(s)
+            self.bind(("127.0.0.1", port,))
+
+            if fn_utils and hasattr(fn_utils, "udp_recvmmsg"):
+                self.set_io_batch(32, fn_utils.udp_recvmmsg, fn_utils.udp_sendmmsg)
+            self.register(self.fileno)
+            self.add_evt_read(self.fileno)
+
+            return self.fileno
+
+        def udp_readable(self, message, address):
+            result = self.__decrypt.parse(message)
+            if not result: return
+
+            session_id, action, byte_data = result
+            if self.dispatcher.is_local_session(session_id):
+                self.__counts["local"] += 1
+                return
+
+            self.ctl_handler(self.fileno, self.dispatcher.ipc_fd, "forward_udp", session_id, action, byte_data,
+                             address)
+            self.__counts["forwarded"] += 1
+
+        def handler_ctl(self, from_fd, cmd, *args, **kwargs):
+            if cmd != "msg_from_worker": return False
+            self.__counts["from_worker"] += 1
+            return True
+
+
+    class bench_worker(dispatcher.dispatcher):
+        __worker_id = 0
+        __workers = 1
+        __ipc_fd = -1
+        __deadline = 0
+        __counts = None
+        __result_w = -1
+
+        def init_func(self, worker_id, channels, port, seconds, result_w):
+            self.__worker_id = worker_id
+            self.__workers = len(channels)
+            self.__deadline = time.monotonic() + seconds
+            self.__counts = {"local": 0, "forwarded": 0, "from_worker": 0, }
+            self.__result_w = result_w
+
+            self.create_poll()
+            fileno = self.create_handler(-1, bench_listener, port, self.__counts)
+            if self.__workers > 1:
+                self.__ipc_fd = self.create_handler(-1, worker_ipc, worker_id, channels)
+                self.ctl_handler(-1, self.__ipc_fd, "set_listener", "udp", False, fileno)
+            self.set_timeout(fileno, seconds)
+
+        @property
+        def ipc_fd(self):
+            return self.__ipc_fd
+
+        def is_local_session(self, session_id):
+            if self.__workers < 2: return True
+            return get_session_worker(session_id, self.__workers) == self.__worker_id
+
+        def myloop(self):
+            if time.monotonic() < self.__deadline: return
+            c = self.__counts
+            os.write(self.__result_w, struct.pack("!QQQ", c["local"], c["forwarded"], c["from_worker"]))
+            os._exit(0)
+
+
+    def run_client(port, seconds):
+        encrypt = crypto.encrypt()
+        encrypt.config(CRYPTO_CONFIG)
+        # 模拟隧道中的IP数据包,不超过一个分段
+        payload = bytes(1000)
+        pkts = []
+        for i in range(SESSIONS):
+            pkts += encrypt.build_packets(os.urandom(16), tunnel_proto.ACT_DATA, payload)
+            encrypt.reset()
+        ''''''
+        socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for i in range(CLIENT_SOCKETS)]
+        address = ("127.0.0.1", port,)
+        batch = [(pkt, address,) for pkt in pkts[0:32]]
+
+        deadline = time.monotonic() + seconds
+        n = 0
+        while time.monotonic() < deadline:
+            s = socks[n % CLIENT_SOCKETS]
+            try:
+                if fn_utils and hasattr(fn_utils, "udp_sendmmsg"):
+                    fn_utils.udp_sendmmsg(s.fileno(), batch)
+                    batch = [(pkts[(n * 32 + i) % len(pkts)], address,) for i in range(32)]
+                else:
+                    s.sendto(pkts[n % len(pkts)], address)
+            except OSError:
+                pass
+            n += 1
+        os._exit(0)
+
+
+    def run(workers, seconds):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(("127.0.0.1", 0,))
+        port = s.getsockname()[1]
+        s.close()
+
+        channels = create_channels(workers)
+        result_r, result_w = os.pipe()
+        pids = []
+
+        for i in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                os.close(result_r)
+                bench_worker().ioloop(i, channels, port, seconds, result_w)
+            pids.append(pid)
+        ''''''
+        # 等待所有工作进程绑定端口
+        time.sleep(0.3)
+        for i in range(max(2, workers)):
+            pid = os.fork()
+            if pid == 0: run_client(port, seconds)
+            pids.append(pid)
+        ''''''
+        for pid in pids: os.waitpid(pid, 0)
+        os.close(result_w)
+        for r, w in channels:
+            r.close()
+            w.close()
+
+        total = [0, 0, 0]
+        for i in range(workers):
+            for j, n in enumerate(struct.unpack("!QQQ", os.read(result_r, 24))): total[j] += n
+        os.close(result_r)
+
+        # 被转发的数据包由所属的工作进程处理
+        local, forwarded, from_worker = total
+        return ((local + from_worker) / seconds, forwarded / max(local + forwarded, 1),)
+
+
+    argv = sys.argv[1:]
+    max_workers = int(argv[0]) if argv else max(2, os.cpu_count() or 1)
+    seconds = float(argv[1]) if len(argv) > 1 else 3
+
+    print("cpus: %s, recvmmsg: %s" % (os.cpu_count(), bool(fn_utils),))
+    base = None
+    workers = 1
+    while workers <= max_workers:
+        rate, forwarded = run(workers, seconds)
+        if base is None: base = rate
+        print("%2d workers: %8d pkts/s, %4.1f%% forwarded, %.2fx" % (workers, rate, forwarded * 100, rate / base,))
+        workers *= 2
+    ''''''
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""UDP隧道的前向纠错(FEC),使用GF(256)上的Reed-Solomon编码
+发送端把连续的k个数据包分为一组,每组生成m个冗余包,一组中丢失的数据包不超过m个时可以恢复
+流量较小时一组可能很久不满,空闲一段时间之后为不完整的组生成冗余包(flush),冗余包中的k为实际的数据包个数
+数据包本身按原样发送,冗余包使用tunnel_udp.ACT_FEC动作发送,不支持的对端会直接丢弃冗余包
+
+冗余包格式
+group_id:4 bytes 组编号
+k:1 byte 组内数据包个数
+m:1 byte 组内冗余包个数
+index:1 byte 当前冗余包序号
+size:2 bytes 冗余数据长度,即组内最长数据包的长度
+items: k * 18 bytes 组内每个数据包的MD5值(16 bytes)和长度(2 bytes)
+parity: size bytes 冗余数据
+
+编码矩阵为柯西矩阵 C[i][j] = 1 / (x[i] + y[j]), x[i] = 255 - i, y[j] = j
+因为柯西矩阵的任意方阵都可逆,所以任意k个数据包或者冗余包都能恢复出整组数据
+"""
+
+import struct, collections, time
+import freenet.lib.base_proto.utils as proto_utils
+
+# 组内最大的数据包个数与冗余包个数,冗余包需要能够放进两个隧道数据块
+MAX_K = 16
+MAX_M = 16
+
+_HDR_FMT = "!IBBBH"
+_HDR_SIZE = struct.calcsize(_HDR_FMT)
+_ITEM_FMT = "!16sH"
+_ITEM_SIZE = struct.calcsize(_ITEM_FMT)
+
+# GF(256)的指数表与对数表,本原多项式为 x^8 + x^4 + x^3 + x^2 + 1
+_EXP = [0] * 512
+_LOG = [0] * 256
+
+
+def _init_tables():
+    n = 1
+    for i in range(255):
+        _EXP[i] = n
+        _LOG[n] = i
+        n <<= 1
+        if n & 0x100: n ^= 0x11d
+        ''''''
+    for i in range(255, 512): _EXP[i] = _EXP[i - 255]
+
+
+_init_tables()
+
+
+def _gf_mul(a, b):
+    if a == 0 or b == 0: return 0
+    return _EXP[_LOG[a] + _LOG[b]]
+
+
+def _gf_inv(a):
+    return _EXP[255 - _LOG[a]]
+
+
+# 柯西编码系数,格式为 _COEFS[i][j]
+_COEFS = [[_gf_inv((255 - i) ^ j) for j in range(MAX_K)] for i in range(MAX_M)]
+
+# 常数乘法表,用于bytes.translate,格式为 {n:table,...}
+_MUL_TABLES = {}
+
+
+def _mul_bytes(n, byte_data):
+    """把数据中的每个字节都乘以n,返回小端整数,这样不同长度的数据可以直接异或"""
+    if n not in _MUL_TABLES: _MUL_TABLES[n] = bytes([_gf_mul(n, x) for x in range(256)])
+
+    return int.from_bytes(byte_data.translate(_MUL_TABLES[n]), "little")
+
+
+def _gf_invert_matrix(matrix):
+    """求矩阵的逆矩阵"""
+    size = len(matrix)
+    m = [list(row) + [int(i == j) for j in range(size)] for i, row in enumerate(matrix)]
+
+    for col in range(size):
+        pivot = col
+        while m[pivot][col] == 0: pivot += 1
+        m[col], m[pivot] = m[pivot], m[col]
+
+        inv = _gf_inv(m[col][col])
+        m[col] = [_gf_mul(inv, x) for x in m[col]]
+
+        for row in range(size):
+            n = m[row][col]
+            if row == col or n == 0: continue
+            m[row] = [x ^ _gf_mul(n, y) for x, y in zip(m[row], m[col])]
+        ''''''
+    return [row[size:] for row in m]
+
+
+class encoder(object):
+    __k = 0
+    __m = 0
+    __group_id = 0
+    # 冗余数据,每个冗余包一个小端整数
+    __parity = None
+    # 组内数据包信息,格式为 [(md5,length),...]
+    __items = None
+    __size = 0
+    # 最后一个数据包加入的时间
+    __add_time = 0
+
+    __stats = None
+
+    def __init__(self, k, m):
+        if k < 1 or k > MAX_K: raise ValueError("the value of k must be 1 to %s" % MAX_K)
+        if m < 1 or m > MAX_M: raise ValueError("the value of m must be 1 to %s" % MAX_M)
+
+        self.__k = k
+        self.__m = m
+        self.__stats = {"groups": 0, "flushes": 0, }
+        self.__reset()
+
+    def __reset(self):
+        self.__parity = [0] * self.__m
+        self.__items = []
+        self.__size = 0
+
+    def __build_repairs(self):
+        """生成当前组的冗余包并开始新的组,不完整的组最多生成与数据包个数相同的冗余包"""
+        seq = [struct.pack(_ITEM_FMT, md5, length) for md5, length in self.__items]
+        items = b"".join(seq)
+        k = len(self.__items)
+        m = min(self.__m, k)
+        repairs = []
+
+        for i, parity in enumerate(self.__parity[0:m]):
+            hdr = struct.pack(_HDR_FMT, self.__group_id, k, m, i, self.__size)
+            repairs.append(b"".join([hdr, items, parity.to_bytes(self.__size, "little")]))
+        ''''''
+        self.__group_id = (self.__group_id + 1) & 0xffffffff
+        self.__reset()
+
+        return repairs
+
+    def add(self, byte_data):
+        """加入一个已发送的数据包
+        :return list: 组满时返回冗余包数据,否则返回空列表
+        """
+        j = len(self.__items)
+        parity = self.__parity
+
+        for i in range(self.__m): parity[i] ^= _mul_bytes(_COEFS[i][j], byte_data)
+
+        size = len(byte_data)
+        self.__items.append((proto_utils.calc_content_md5(byte_data), size,))
+        if size > self.__size: self.__size = size
+        self.__add_time = time.monotonic()
+
+        if len(self.__items) < self.__k: return []
+
+        self.__stats["groups"] += 1
+
+        return self.__build_repairs()
+
+    @property
+    def pending(self):
+        """是否有还没有生成冗余包的数据包"""
+        return bool(self.__items)
+
+    def flush(self, idle_time=0):
+        """组内有数据包并且超过idle_time秒没有新的数据包时,为不完整的组生成冗余包
+        :return list: 冗余包数据,不需要生成时返回空列表
+        """
+        if not self.__items: return []
+        if time.monotonic() - self.__add_time < idle_time: return []
+
+        self.__stats["flushes"] += 1
+
+        return self.__build_repairs()
+
+    def get_stats(self):
+        """获取统计信息
+        groups:组满时生成冗余包的次数,flushes:空闲时为不完整的组生成冗余包的次数
+        """
+        return dict(self.__stats)
+
+
+class decoder(object):
+    # 最多同时等待恢复的组数
+    __window = 0
+    # 等待恢复的组,格式为 {group_id:group,...}
+    __groups = None
+    # 缺失数据包所在的组,格式为 {md5:group_id,...}
+    __missing = None
+    # 最近收到的数据包,用于冗余包先于数据包到达的情况,格式为 {md5:byte_data,...}
+    __recent = None
+    # 最近恢复的数据包,之后到达的相同数据包直接丢弃
+    __recovered = None
+
+    __stats = None
+
+    def __init__(self, window=16):
+        self.__window = window
+        self.__groups = collections.OrderedDict()
+        self.__missing = {}
+        self.__recent = collections.OrderedDict()
+        self.__recovered = collections.OrderedDict()
+        self.__stats = {"repairs": 0, "recovered": 0, "unrecoverable": 0, }
+
+    def __remember(self, table, md5, value):
+        table[md5] = value
+        if len(table) > self.__window * MAX_K: table.popitem(last=False)
+
+    def __parse_repair(self, payload):
+        if len(payload) < _HDR_SIZE: return None
+
+        group_id, k, m, index, size = struct.unpack(_HDR_FMT, payload[0:_HDR_SIZE])
+        if k < 1 or k > MAX_K or index >= m or m > MAX_M: return None
+
+        b = _HDR_SIZE
+        e = b + k * _ITEM_SIZE
+        if len(payload) != e + size: return None
+
+        items = [struct.unpack(_ITEM_FMT, payload[i:i + _ITEM_SIZE]) for i in range(b, e, _ITEM_SIZE)]
+
+        return (group_id, index, items, size, int.from_bytes(payload[e:], "little"),)
+
+    def __new_group(self, group_id, items, size):
+        group = {"id": group_id, "items": items, "size": size, "data": {}, "repairs": {}, "done": False, }
+
+        for j, (md5, length) in enumerate(items):
+            if md5 in self.__recent:
+                group["data"][j] = self.__recent[md5]
+            else:
+                self.__missing[md5] = group_id
+            ''''''
+        self.__groups[group_id] = group
+
+        if len(self.__groups) > self.__window:
+            _, old = self.__groups.popitem(last=False)
+            self.__drop_group(old)
+
+        return group
+
+    def __drop_group(self, group):
+        if group["done"]: return
+
+        lost = 0
+        for j, (md5, length) in enumerate(group["items"]):
+            if j in group["data"]: continue
+            if self.__missing.get(md5, None) == group["id"]: del self.__missing[md5]
+            lost += 1
+
+        self.__stats["unrecoverable"] += lost
+
+    def __decode(self, group):
+        """尝试恢复丢失的数据包
+        :return list: 恢复出的数据包
+        """
+        if group["done"]: return []
+
+        items = group["items"]
+        data = group["data"]
+        lost = [j for j in range(len(items)) if j not in data]
+
+        if not lost:
+            group["done"] = True
+            return []
+
+        if len(group["repairs"]) < len(lost): return []
+
+        rows = sorted(group["repairs"])[0:len(lost)]
+        size = group["size"]
+
+        # 去掉已收到数据包的部分,剩下的只与丢失的数据包有关
+        syndromes = []
+        for i in rows:
+            n = group["repairs"][i]
+            for j, byte_data in data.items(): n ^= _mul_bytes(_COEFS[i][j], byte_data)
+            syndromes.append(n.to_bytes(size, "little"))
+
+        inv = _gf_invert_matrix([[_COEFS[i][j] for j in lost] for i in rows])
+        results = []
+
+        for a, j in enumerate(lost):
+            n = 0
+            for b, syndrome in enumerate(syndromes): n ^= _mul_bytes(inv[a][b], syndrome)
+            md5, length = items[j]
+            byte_data = n.to_bytes(size, "little")[0:length]
+
+            self.__missing.pop(md5, None)
+            if proto_utils.calc_content_md5(byte_data) != md5:
+                self.__stats["unrecoverable"] += 1
+                continue
+
+            self.__remember(self.__recovered, md5, None)
+            results.append(byte_data)
+        ''''''
+        self.__stats["recovered"] += len(results)
+        group["done"] = True
+
+        return results
+
+    def input_data(self, byte_data):
+        """输入收到的数据包
+        :return list: 需要处理的数据包,包括该数据包本身和由此恢复出的数据包,重复的数据包返回空列表
+        """
+        md5 = proto_utils.calc_content_md5(byte_data)
+
+        if md5 in self.__recovered:
+            del self.__recovered[md5]
+            return []
+
+        group_id = self.__missing.pop(md5, None)
+        if group_id is None:
+            self.__remember(self.__recent, md5, byte_data)
+            return [byte_data]
+
+        group = self.__groups[group_id]
+        for j, (item_md5, length) in enumerate(group["items"]):
+            if item_md5 == md5: group["data"][j] = byte_data
+
+        return [byte_data] + self.__decode(group)
+
+    def input_repair(self, payload):
+        """输入冗余包
+        :return list: 恢复出的数据包
+        """
+        result = self.__parse_repair(payload)
+        if not result: return []
+
+        group_id, index, items, size, parity = result
+        self.__stats["repairs"] += 1
+
+        group = self.__groups.get(group_id, None)
+        # 对端重新开始编号时组编号会重复
+        if group and group["items"] != items:
+            del self.__groups[group_id]
+            self.__drop_group(group)
+            group = None
+        if not group: group = self.__new_group(group_id, items, size)
+
+        group["repairs"][index] = parity
+
+        return self.__decode(group)
+
+    def get_stats(self):
+        """获取统计信息
+        repairs:收到的冗余包个数,recovered:恢复的数据包个数,unrecoverable:无法恢复的数据包个数
+        """
+        return dict(self.__stats)
+
+
+if __name__ == "__main__":
+    # 性能测试,python3 -m freenet.lib.base_proto.fec
+    import os
+
+    # 不完整的组在空闲之后生成冗余包,丢失的数据包仍然可以恢复
+    enc = encoder(8, 2)
+    dec = decoder()
+    pkts = [os.urandom(100 + i) for i in range(3)]
+    for byte_data in pkts:
+        if enc.add(byte_data): raise SystemExit("the group should not be full")
+    if enc.flush(idle_time=10) or not enc.pending: raise SystemExit("the group is not idle")
+    repairs = enc.flush()
+    if len(repairs) != 2 or enc.pending or enc.get_stats() != {"groups": 0, "flushes": 1, }:
+        raise SystemExit("wrong flush")
+    dec.input_data(pkts[1])
+    recovered = []
+    for repair in repairs: recovered += dec.input_repair(repair)
+    if sorted(recovered) != sorted([pkts[0], pkts[2]]): raise SystemExit("partial group should be recovered")
+    # 只有一个数据包的组只生成一个冗余包
+    enc.add(pkts[0])
+    if len(enc.flush()) != 1: raise SystemExit("wrong repair count")
+
+    n = 20000
+    pkts = [os.urandom(1400) for i in range(n)]
+
+    for k, m in ((4, 1,), (8, 2,), (16, 4,),):
+        enc = encoder(k, m)
+        groups = []
+
+        t = time.time()
+        for i in range(n):
+            repairs = enc.add(pkts[i])
+            if repairs: groups.append((pkts[i - k + 1:i + 1], repairs,))
+        cost = (time.time() - t) / n
+        print("k=%s m=%s encode: %.1f us/pkt, %d pkts/s" % (k, m, cost * 1000000, 1 / cost))
+
+        for lost in range(m + 1):
+            dec = decoder()
+            t = time.time()
+            for data_seq, repairs in groups:
+                for byte_data in data_seq[lost:]: dec.input_data(byte_data)
+                for repair in repairs: dec.input_repair(repair)
+                ''''''
+            cost = (time.time() - t) / (len(groups) * k)
+            print("    decode with %s lost: %.1f us/pkt, %d pkts/s, %s" % (lost, cost * 1000000, 1 / cost,
+                                                                           dec.get_stats()))
+        ''''''
@@ -7,23 +7,47 @@ reverse:4bit 保留
 action:4 bit 包动作
 tot_length: 2 bytes 包的总长度
 real_length: 2 bytes 加密前的长度
+
+v2格式
+一个TCP连接只属于一个会话,因此协商之后不再发送会话ID与MD5值,数据完整性由加密模块保证
+协商使用上面的格式(v1)发送ACT_FRAMING包,内容的第一个字节为类型
+    FRAMING_OFFER:客户端支持v2格式
+    FRAMING_SWITCH:之后跟随16 bytes的随机种子,发送端在这个包之后的所有数据使用v2格式
+客户端连接之后发送FRAMING_OFFER,服务端回复FRAMING_SWITCH,客户端收到之后再回复FRAMING_SWITCH
+两个方向分别切换,切换点就在FRAMING_SWITCH包之后,因此不需要等待对端确认
+v2格式如下:
+length:2 bytes 之后的数据长度
+frame:length bytes 由加密模块处理之后的 action(1 byte) + 数据
 """
 
 ACT_DATA = 1
 ACT_DNS = 2
+# v2格式协商
+ACT_FRAMING = 3
 
 ACTS = (
-    ACT_DATA, ACT_DNS,
+    ACT_DATA, ACT_DNS, ACT_FRAMING,
 )
 
 MIN_FIXED_HEADER_SIZE = 37
 
+FRAMING_OFFER = 1
+FRAMING_SWITCH = 2
+
+FRAMING_SEED_SIZE = 16
+
+import os, struct
 import pywind.lib.reader as reader
 import freenet.lib.base_proto.utils as proto_utils
 
+_HEADER = struct.Struct("!16s16sBHH")
+_FRAME_HEADER = struct.Struct("!H")
+
 
 class builder(object):
     __fixed_hdr_size = 0
+    # 当前使用的格式,1或者2
+    __framing = 1
 
     def __init__(self, fixed_hdr_size):
         self.__fixed_hdr_size = fixed_hdr_size
@@ -31,34 +55,74 @@ class builder(object):
             "min fixed header size is %s" % MIN_FIXED_HEADER_SIZE)
 
     def __build_proto_headr(self, session_id, payload_m5, tot_len, real_size, action):
-        seq = [
-            session_id, payload_m5,
-        ]
-
-        T = (
-            action & 0x0f,
-            (tot_len & 0xff00) >> 8,
-            tot_len & 0x00ff,
-            (real_size & 0xff00) >> 8,
-            real_size & 0x00ff,
-        )
+        return _HEADER.pack(session_id, payload_m5, action & 0x0f, tot_len & 0xffff, real_size & 0xffff)
 
-        seq.append(bytes(T))
-
-        return b"".join(seq)
-
-    def build_packet(self, session_id, action, byte_data):
-        if len(session_id) != 16: raise proto_utils.ProtoError("the size of session_id must be 16")
+    def __build(self, session_id, action, byte_data):
+        if self.__framing == 2: return self.__build_frame(action, byte_data)
 
         pkt_len = len(byte_data)
         tot_len = self.get_payload_length(pkt_len)
-        payload_md5 = proto_utils.calc_content_md5(byte_data)
+        payload_md5 = self.gen_pkt_id(byte_data)
         base_hdr = self.__build_proto_headr(session_id, payload_md5, tot_len, pkt_len, action)
 
         e_hdr = self.wrap_header(base_hdr)
         e_body = self.wrap_body(pkt_len, byte_data)
 
-        return b"".join((e_hdr, e_body,))
+        return (e_hdr, e_body,)
+
+    def __build_frame(self, action, byte_data):
+        e_frame = self.wrap_frame(b"".join((bytes((action,)), byte_data,)))
+        size = len(e_frame)
+        if size > 0xffff: raise proto_utils.ProtoError("the frame is too long")
+
+        return (_FRAME_HEADER.pack(size), e_frame,)
+
+    def build_packet(self, session_id, action, byte_data):
+        if len(session_id) != 16: raise proto_utils.ProtoError("the size of session_id must be 16")
+
+        return b"".join(self.__build(session_id, action, byte_data))
+
+    def build_batch(self, session_id, action, packets):
+        """一次加密多个数据包,每个数据包之后自动调用reset
+        :param packets: 数据包列表
+        :return bytes: 所有加密后的数据包,可以一次写入连接
+        """
+        if len(session_id) != 16: raise proto_utils.ProtoError("the size of session_id must be 16")
+
+        seq = []
+        for byte_data in packets:
+            seq.extend(self.__build(session_id, action, byte_data))
+            self.reset()
+        return b"".join(seq)
+
+    def build_offer(self, session_id):
+        """生成FRAMING_OFFER包"""
+        pkt = self.build_packet(session_id, ACT_FRAMING, bytes((FRAMING_OFFER,)))
+        self.reset()
+
+        return pkt
+
+    def build_switch(self, session_id):
+        """生成FRAMING_SWITCH包,之后生成的数据包使用v2格式"""
+        if not self.framing_v2_is_supported(): raise proto_utils.ProtoError("the crypto module not support v2 framing")
+        if self.__framing == 2: raise proto_utils.ProtoError("the framing has been switched")
+
+        seed = os.urandom(FRAMING_SEED_SIZE)
+        pkt = self.build_packet(session_id, ACT_FRAMING, b"".join((bytes((FRAMING_SWITCH,)), seed,)))
+        self.reset()
+
+        self.init_frames(seed)
+        self.__framing = 2
+
+        return pkt
+
+    @property
+    def framing(self):
+        return self.__framing
+
+    def gen_pkt_id(self, byte_data):
+        """生成协议头中的payload_md5字段,带有认证的加密模块可以重写这个方法,省去MD5计算"""
+        return proto_utils.calc_content_md5(byte_data)
 
     def wrap_header(self, base_hdr):
         """重写这个方法"""
@@ -68,6 +132,20 @@ class builder(object):
         """重写这个方法"""
         return body_data
 
+    def framing_v2_is_supported(self):
+        """是否支持v2格式,v2格式没有MD5校验,只有带认证的加密模块才应该支持,重写这个方法"""
+        return False
+
+    def init_frames(self, seed):
+        """切换到v2格式时调用,重写这个方法
+        :param seed: FRAMING_SWITCH包中的随机种子
+        """
+        pass
+
+    def wrap_frame(self, frame):
+        """v2格式的帧加密,重写这个方法"""
+        return frame
+
     def reset(self):
         pass
 
@@ -81,6 +159,9 @@ class builder(object):
 
 
 class parser(object):
+    """TCP隧道解析器,每次输入数据时一次取出所有完整的数据包
+    协议头解密之后如果数据还不完整,保存协议头的解析结果,避免重复解密
+    """
     __reader = None
     __fixed_hdr_size = MIN_FIXED_HEADER_SIZE
     __session_id = None
@@ -91,7 +172,8 @@ class parser(object):
     __real_length = 0
     __header_ok = False
     __action = 0
-    __results = None
+    # 当前使用的格式,1或者2
+    __framing = 1
 
     def __init__(self, fixed_hdr_size):
         """
@@ -99,7 +181,6 @@ class parser(object):
         """
         self.__reader = reader.reader()
         self.__fixed_hdr_size = fixed_hdr_size
-        self.__results = []
 
         if fixed_hdr_size < MIN_FIXED_HEADER_SIZE: raise ValueError(
             "min fixed header size is %s" % MIN_FIXED_HEADER_SIZE)
@@ -115,31 +196,87 @@ class parser(object):
 
         return (session_id, paylod_md5, action, tot_len, real_size,)
 
+    def __switch_framing(self, body):
+        """对端发送FRAMING_SWITCH包之后的数据使用v2格式"""
+        if len(body) != 1 + FRAMING_SEED_SIZE or body[0] != FRAMING_SWITCH: return
+        if not self.framing_v2_is_supported(): raise proto_utils.ProtoError("the crypto module not support v2 framing")
+
+        self.init_frames(body[1:])
+        self.__framing = 2
+
+    def __parse(self, view, results):
+        """从view中解析出所有完整的数据包
+        :return int: 已经处理的字节数
+        """
+        size = len(view)
+        fixed_hdr_size = self.__fixed_hdr_size
+        pos = 0
+
+        while 1:
+            if self.__framing == 2:
+                if not self.__header_ok:
+                    if size - pos < 2: break
+                    self.__tot_length = (view[pos] << 8) | view[pos + 1]
+                    self.__header_ok = True
+                    pos += 2
+                if size - pos < self.__tot_length: break
+
+                e = pos + self.__tot_length
+                frame = self.unwrap_frame(bytes(view[pos:e]))
+                pos = e
+                self.reset()
+
+                if not frame: raise proto_utils.ProtoError("data has been modified")
+                results.append((self.__session_id, frame[0], frame[1:],))
+                continue
+
+            if not self.__header_ok:
+                if size - pos < fixed_hdr_size: break
+                e = pos + fixed_hdr_size
+                hdr = self.unwrap_header(bytes(view[pos:e]))
+                pos = e
+                if not hdr:
+                    self.reset()
+                    continue
+                self.__session_id, self.__payload_md5, \
+                self.__action, self.__tot_length, self.__real_length = self.__parse_header(hdr)
+                self.__header_ok = True
+
+            if size - pos < self.__tot_length: break
+
+            e = pos + self.__tot_length
+            body = self.unwrap_body(self.__real_length, bytes(view[pos:e]))
+            pos = e
+
+            if not self.check_pkt_id(self.__payload_md5, body): raise proto_utils.ProtoError(
+                "data has been modified")
+
+            results.append((self.__session_id, self.__action, body,))
+            if self.__action == ACT_FRAMING: self.__switch_framing(body)
+            self.reset()
+
+        return pos
+
     def input(self, byte_data):
+        """输入从连接读取的数据
+        :return list: 所有完整的数据包,格式为 [(session_id,action,body),...]
+        """
         self.__reader._putvalue(byte_data)
+        results = []
 
-    def parse(self):
-        size = self.__reader.size()
+        view = self.__reader.peek()
+        try:
+            pos = self.__parse(view, results)
+        finally:
+            view.release()
 
-        if self.__header_ok:
-            if size < self.__tot_length: return
-            e_body = self.__reader.read(self.__tot_length)
-            body = self.unwrap_body(self.__real_length, e_body)
+        self.__reader.consume(pos)
 
-            if proto_utils.calc_content_md5(body) != self.__payload_md5: raise proto_utils.ProtoError(
-                "data has been modified")
+        return results
 
-            self.__results.append((self.__session_id, self.__action, body,))
-            self.reset()
-            return
-        if self.__reader.size() < self.__fixed_hdr_size: return
-        hdr = self.unwrap_header(self.__reader.read(self.__fixed_hdr_size))
-        if not hdr:
-            self.reset()
-            return
-        self.__session_id, self.__payload_md5, \
-        self.__action, self.__tot_length, self.__real_length = self.__parse_header(hdr)
-        self.__header_ok = True
+    def check_pkt_id(self, payload_md5, body):
+        """检查数据是否被修改,带有认证的加密模块可以重写这个方法,省去MD5计算"""
+        return payload_md5 == proto_utils.calc_content_md5(body)
 
     def unwrap_header(self, header):
         """重写这个方法"""
@@ -149,24 +286,132 @@ class parser(object):
         """重写这个方法"""
         return body_data
 
+    def framing_v2_is_supported(self):
+        """是否支持v2格式,重写这个方法"""
+        return False
+
+    def init_frames(self, seed):
+        """切换到v2格式时调用,重写这个方法
+        :param seed: FRAMING_SWITCH包中的随机种子
+        """
+        pass
+
+    def unwrap_frame(self, e_frame):
+        """v2格式的帧解密,重写这个方法
+        :return bytes: 解密之后的帧,认证失败时返回None
+        """
+        return e_frame
+
+    @property
+    def framing(self):
+        return self.__framing
+
     def reset(self):
         self.__tot_length = 0
         self.__header_ok = False
         self.__real_length = 0
 
-    def can_continue_parse(self):
-        size = self.__reader.size()
-        if not self.__header_ok and size < self.__fixed_hdr_size: return False
-        if not self.__header_ok: return True
-
-        return size >= self.__tot_length
-
-    def get_pkt(self):
-        try:
-            return self.__results.pop(0)
-        except IndexError:
-            return None
-
     def config(self, config):
         """重写这个方法,用于协议配置"""
         pass
+
+
+if __name__ == "__main__":
+    # 与原来的解析器的性能比较,python3 -m freenet.lib.base_proto.tunnel_tcp
+    # 1MB左右的数据流,数据包大小为60到1400 bytes,按照不同的大小分块输入,取5次中最快的一次
+    import random, time
+
+
+    class old_parser(object):
+        """原来的解析器,每次parse只处理一个帧头或者一个帧体,只保留基本类需要的部分"""
+
+        def __init__(self, fixed_hdr_size):
+            self.__reader = reader.reader()
+            self.__fixed_hdr_size = fixed_hdr_size
+            self.__results = []
+            self.reset()
+
+        def input(self, byte_data):
+            self.__reader._putvalue(byte_data)
+
+        def parse(self):
+            size = self.__reader.size()
+
+            if self.__header_ok:
+                if size < self.__tot_length: return
+                body = self.__reader.read(self.__tot_length)
+
+                if proto_utils.calc_content_md5(body) != self.__payload_md5: raise proto_utils.ProtoError(
+                    "data has been modified")
+
+                self.__results.append((self.__session_id, self.__action, body,))
+                self.reset()
+                return
+            if size < self.__fixed_hdr_size: return
+            hdr = self.__reader.read(self.__fixed_hdr_size)
+
+            self.__session_id = hdr[0:16]
+            self.__payload_md5 = hdr[16:32]
+            self.__action = hdr[32] & 0x0f
+            self.__tot_length = (hdr[33] << 8) | hdr[34]
+            self.__header_ok = True
+
+        def reset(self):
+            self.__tot_length = 0
+            self.__header_ok = False
+
+        def can_continue_parse(self):
+            size = self.__reader.size()
+            if not self.__header_ok and size < self.__fixed_hdr_size: return False
+            if not self.__header_ok: return True
+
+            return size >= self.__tot_length
+
+        def get_pkt(self):
+            try:
+                return self.__results.pop(0)
+            except IndexError:
+                return None
+
+
+    def old_input(p, byte_data):
+        """与原来的隧道处理者相同的调用方式"""
+        results = []
+        p.input(byte_data)
+        while p.can_continue_parse():
+            p.parse()
+            while 1:
+                pkt_info = p.get_pkt()
+                if not pkt_info: break
+                results.append(pkt_info)
+            ''''''
+        return results
+
+
+    session_id = os.urandom(16)
+    pkts = [os.urandom(random.randint(60, 1400)) for i in range(1500)]
+    stream = builder(MIN_FIXED_HEADER_SIZE).build_batch(session_id, ACT_DATA, pkts)
+    print("stream: %d bytes, %d packets" % (len(stream), len(pkts),))
+
+    for chunk in (1500, 16 * 1024, len(stream),):
+        costs = []
+        for name, create, input_func in (("old", old_parser, old_input,),
+                                         ("new", parser, lambda p, byte_data: p.input(byte_data),)):
+            cost = None
+            for n in range(5):
+                p = create(MIN_FIXED_HEADER_SIZE)
+                results = []
+
+                t = time.time()
+                for i in range(0, len(stream), chunk): results.extend(input_func(p, stream[i:i + chunk]))
+                t = time.time() - t
+
+                if [r[2] for r in results] != pkts: raise SystemExit("wrong %s parse result" % name)
+                if cost is None or t < cost: cost = t
+            ''''''
+            costs.append(cost)
+        ''''''
+        old_cost, new_cost = costs
+        print("chunk %7s bytes: old %.1f ms, %d pkts/s; new %.1f ms, %d pkts/s; %.2fx" % (
+            chunk, old_cost * 1000, len(pkts) / old_cost, new_cost * 1000, len(pkts) / new_cost,
+            old_cost / new_cost,))
@@ -9,17 +9,23 @@ seq: 4 bit 当前分包序号
 reverse:4 bit 保留
 action:4bit 动作
 """
+import collections, struct
 import freenet.lib.base_proto.utils as proto_utils
+import pywind.lib.timer as timer
 
 ACT_DATA = 1
 ACT_DNS = 2
+# 前向纠错冗余包,见fec模块
+ACT_FEC = 3
 
 ACTS = (
-    ACT_DATA, ACT_DNS,
+    ACT_DATA, ACT_DNS, ACT_FEC,
 )
 
 MIN_FIXED_HEADER_SIZE = 38
 
+_HEADER = struct.Struct("!16s16sHHBB")
+
 
 class builder(object):
     __session_id = 0
@@ -41,44 +47,19 @@ class builder(object):
 
     def __gen_raib(self, block_a, block_b):
         """生成冗余数据块,类似于磁盘阵列的RAID5模式,较少丢包率
+        把整个数据块转换成整数进行异或,避免逐字节计算
         """
-        size_a = len(block_a)
-        size_b = len(block_b)
-
-        list_a = list(block_a)
-        list_b = list(block_b)
+        size = max(len(block_a), len(block_b))
 
-        L = None
-        if size_a > size_b:
-            L = list_b
-        else:
-            L = list_a
-        n = abs(size_a - size_b)
-        for i in range(n): L.append(0)
-        csum_list = []
-        cnt = 0
-        for n in list_a:
-            csum = n ^ list_b[cnt]
-            cnt += 1
-            csum_list.append(csum)
-
-        return (bytes(list_a), bytes(list_b), bytes(csum_list),)
-
-    def __build_proto_header(self, session_id, pkt_md5, pkt_len, real_size, tot_seg, seq, action):
-        if action not in ACTS: raise ValueError("not support action type")
-        L = [
-            session_id, pkt_md5,
-        ]
+        block_a = block_a.ljust(size, b"\0")
+        block_b = block_b.ljust(size, b"\0")
 
-        T = [
-            (pkt_len & 0xff00) >> 8, pkt_len & 0x00ff,
-            (real_size & 0xff00) >> 8, real_size & 0x00ff,
-            (tot_seg << 4) | seq, action,
-        ]
+        csum = int.from_bytes(block_a, "little") ^ int.from_bytes(block_b, "little")
 
-        L.append(bytes(T))
+        return (block_a, block_b, csum.to_bytes(size, "little"),)
 
-        return b"".join(L)
+    def __build_proto_header(self, session_id, pkt_md5, pkt_len, real_size, tot_seg, seq, action):
+        return _HEADER.pack(session_id, pkt_md5, pkt_len & 0xffff, real_size & 0xffff, (tot_seg << 4) | seq, action)
 
     def __get_sent_raw_data(self, data_len, byte_data):
         """获取要发送的原始数据"""
@@ -104,31 +85,56 @@ class builder(object):
             ret_v = tuple(tmplist)
         return ret_v
 
-    def build_packets(self, session_id, action, byte_data):
-        if len(session_id) != 16: raise proto_utils.ProtoError("the size of session_id must be 16")
-
+    def __build_segments(self, session_id, action, byte_data, results):
         data_len = len(byte_data)
-        data_seq = []
         tmp_t = self.__get_sent_raw_data(data_len, byte_data)
         tot_seq = len(tmp_t)
-        md5_hash = proto_utils.calc_content_md5(byte_data)
+        md5_hash = self.gen_pkt_id(byte_data)
         seq = 1
         for block in tmp_t:
             size = len(block)
             base_header = self.__build_proto_header(session_id, md5_hash, data_len, size, tot_seq, seq, action)
             e_hdr = self.wrap_header(base_header)
             e_body = self.wrap_body(size, block)
-            data_seq.append(b"".join((e_hdr, e_body,)))
+            results.append(b"".join((e_hdr, e_body,)))
             seq += 1
+        return
+
+    def build_packets(self, session_id, action, byte_data):
+        if len(session_id) != 16: raise proto_utils.ProtoError("the size of session_id must be 16")
+        if action not in ACTS: raise ValueError("not support action type")
+
+        data_seq = []
+        self.__build_segments(session_id, action, byte_data, data_seq)
 
         return data_seq
 
+    def build_batch(self, session_id, action, packets):
+        """一次加密多个数据包,会话与动作的检查只做一次,每个数据包之后自动调用reset
+        :param packets: 数据包列表
+        :return list: 所有数据包的分段,按数据包的顺序排列
+        """
+        if len(session_id) != 16: raise proto_utils.ProtoError("the size of session_id must be 16")
+        if action not in ACTS: raise ValueError("not support action type")
+
+        data_seq = []
+        for byte_data in packets:
+            self.__build_segments(session_id, action, byte_data, data_seq)
+            self.reset()
+        return data_seq
+
     def set_max_pkt_size(self, size):
         """单个UDP数据包所能传输的数据大小"""
         min_size = 1000 + self.__fixed_header_size
         if size < min_size: raise proto_utils.ProtoError("the value of size must not be less than %s" % min_size)
         self.__block_size = size
 
+    def gen_pkt_id(self, byte_data):
+        """生成数据包ID,即协议头中的packet_md5字段,同一数据包的所有分段ID相同
+        带有认证的加密模块可以重写这个方法,省去MD5计算
+        """
+        return proto_utils.calc_content_md5(byte_data)
+
     def wrap_header(self, base_hdr):
         """重写这个方法"""
         return base_hdr
@@ -154,30 +160,49 @@ class builder(object):
 
 class parser(object):
     __fixed_header_size = 0
-    __pkt_md5 = None
-    __data_area = None
-    # 总共的段数
-    __tot_seg = 0
+    # 正在重组的数据包,按最近使用排序,格式为 {(session_id,pkt_md5):{seq:body,...},...}
+    __slots = None
+    # 最近重组完成但分段没有全部到达的数据包,用于丢弃之后到达的多余分段,格式为 {key:set(seq,...),...}
+    __done = None
+    __timer = None
+
+    # 最多同时重组的数据包个数
+    __max_slots = 1024
+    # 分段的最长等待时间
+    __slot_timeout = 3
 
-    __pkt_len = 0
+    __stats = None
 
     def __init__(self, fixed_header_size):
         if fixed_header_size < MIN_FIXED_HEADER_SIZE: raise proto_utils.ProtoError(
             "the header size can not less than %s" % MIN_FIXED_HEADER_SIZE)
 
         self.__fixed_header_size = fixed_header_size
-        self.__wait_fill_seq = []
-        self.__data_area = {}
+        self.__slots = collections.OrderedDict()
+        self.__done = collections.OrderedDict()
+        self.__timer = timer.timer()
+        self.__stats = {"completed": 0, "expired": 0, "evicted": 0, }
+
+    def set_reassembly(self, max_slots=1024, timeout=3):
+        """设置数据包重组
+        :param max_slots: 最多同时重组的数据包个数,超过时丢弃最久没有收到分段的数据包
+        :param timeout: 分段的最长等待时间,单位为秒
+        """
+        self.__max_slots = max_slots
+        self.__slot_timeout = timeout
+
+    def get_reassembly_stats(self):
+        """获取重组统计信息"""
+        stats = dict(self.__stats)
+        stats["slots"] = len(self.__slots)
+
+        return stats
 
     def __parse_raib(self, data_block, csum_block):
         """从数据块和校检块中获取另一数据块内容"""
-        cnt = 0
-        tmp_list = []
-        for n in data_block:
-            tmp_list.append(n ^ csum_block[cnt])
-            cnt += 1
+        data = int.from_bytes(data_block, "little") ^ int.from_bytes(csum_block, "little")
 
-        return bytes(tmp_list)
+        return data.to_bytes(len(data_block), "little")
 
     def __parse_header(self, header):
         session_id = header[0:16]
@@ -194,14 +219,64 @@ class parser(object):
 
         return (session_id, pkt_md5, pkt_len, payload_len, tot_seg, seq, action,)
 
-    def __get_pkt(self, pkt):
-        if len(pkt) < self.__pkt_len: raise proto_utils.ProtoError("wrong packet length")
+    def __get_pkt(self, pkt, pkt_len):
+        if len(pkt) < pkt_len: raise proto_utils.ProtoError("wrong packet length")
+
+        return pkt[0:pkt_len]
+
+    def __expire_slots(self):
+        for key in self.__timer.get_timeout_names():
+            self.__timer.drop(key)
+            if key not in self.__slots: continue
+            del self.__slots[key]
+            self.__stats["expired"] += 1
+        return
+
+    def __get_slot(self, key):
+        """获取重组数据区,没有时创建"""
+        data_area = self.__slots.get(key, None)
+
+        if data_area is not None:
+            self.__slots.move_to_end(key)
+            return data_area
+
+        self.__expire_slots()
+
+        data_area = {}
+        self.__slots[key] = data_area
+        self.__timer.set_timeout(key, self.__slot_timeout)
 
-        return pkt[0:self.__pkt_len]
+        if len(self.__slots) > self.__max_slots:
+            old_key, _ = self.__slots.popitem(last=False)
+            self.__timer.drop(old_key)
+            self.__stats["evicted"] += 1
 
-    def __check_data_is_modify(self, md5, byte_data):
-        n_md5 = proto_utils.calc_content_md5(byte_data)
-        return md5 == n_md5
+        return data_area
+
+    def __finish_slot(self, key, tot_seg):
+        data_area = self.__slots.pop(key)
+        self.__timer.drop(key)
+        self.__stats["completed"] += 1
+
+        if len(data_area) >= tot_seg: return
+
+        self.__done[key] = set(data_area)
+        if len(self.__done) > 64: self.__done.popitem(last=False)
+
+    def __is_redundant_seg(self, key, tot_seg, seq):
+        """是否是已经重组完成的数据包的多余分段"""
+        seqs = self.__done.get(key, None)
+        if seqs is None: return False
+
+        # 重复的分段说明是内容相同的新数据包
+        if seq in seqs:
+            del self.__done[key]
+            return False
+
+        seqs.add(seq)
+        if len(seqs) >= tot_seg: del self.__done[key]
+
+        return True
 
     def parse(self, packet):
         real_header = self.unwrap_header(packet[0:self.__fixed_header_size])
@@ -209,59 +284,56 @@ class parser(object):
 
         session_id, pkt_md5, pkt_len, payload_len, tot_seg, seq, action = self.__parse_header(real_header)
         real_body = self.unwrap_body(payload_len, packet[self.__fixed_header_size:])
+        if real_body is None: return None
 
-        self.__pkt_len = pkt_len
-
-        if seq > 3: return None
+        if seq > 3 or seq < 1: return None
         # 如果只有一个数据包,那么直接返回
         if tot_seg == 1:
-            self.reset()
-            if not self.__check_data_is_modify(pkt_md5, real_body): return None
+            if not self.check_pkt_id(pkt_md5, real_body): return None
             return (session_id, action, real_body,)
 
-        if pkt_md5 != self.__pkt_md5 and self.__data_area:
-            self.reset()
-            return None
-
         # 最大分段只能是3段
         if tot_seg > 3: return None
-        self.__data_area[seq] = real_body
 
-        if 1 in self.__data_area and 2 in self.__data_area:
-            pkt = b"".join((self.__data_area[1], self.__data_area[2],))
-            self.reset()
-            body_data = self.__get_pkt(pkt)
-            if not self.__check_data_is_modify(pkt_md5, body_data): return None
+        # 不同数据包的分段可能交错到达,因此按照会话与数据包MD5分别重组
+        key = (session_id, pkt_md5,)
+        if self.__is_redundant_seg(key, tot_seg, seq): return None
+
+        data_area = self.__get_slot(key)
+        data_area[seq] = real_body
+
+        if 1 in data_area and 2 in data_area:
+            pkt = b"".join((data_area[1], data_area[2],))
+            self.__finish_slot(key, tot_seg)
+            body_data = self.__get_pkt(pkt, pkt_len)
+            if not self.check_pkt_id(pkt_md5, body_data): return None
             return (session_id, action, body_data,)
-        if len(self.__data_area) == 2:
-            result = self.__get_data_from_raib()
-            body_data = self.__get_pkt(result)
-            self.reset()
-            if not self.__check_data_is_modify(pkt_md5, body_data): return None
+        if len(data_area) == 2:
+            self.__finish_slot(key, tot_seg)
+            result = self.__get_data_from_raib(data_area)
+            body_data = self.__get_pkt(result, pkt_len)
+            if not self.check_pkt_id(pkt_md5, body_data): return None
             return (session_id, action, body_data,)
 
-        self.__pkt_md5 = pkt_md5
         return None
 
-    def __get_data_from_raib(self):
+    def __get_data_from_raib(self, data_area):
         data_a = None
         n = 0
 
-        if 1 in self.__data_area:
-            data_a = self.__data_area[1]
+        if 1 in data_area:
+            data_a = data_area[1]
             n = 1
 
-        if 2 in self.__data_area:
-            data_a = self.__data_area[2]
+        if 2 in data_area:
+            data_a = data_area[2]
             n = 2
 
         len_a = len(data_a)
-        data_b = self.__data_area[3]
+        data_b = data_area[3]
         len_b = len(data_b)
 
-        if len_a != len_b:
-            self.reset()
-            return b""
+        if len_a != len_b: return b""
 
         data_c = self.__parse_raib(data_a, data_b)
         iter_obj = None
@@ -270,6 +342,10 @@ class parser(object):
 
         return b"".join(iter_obj)
 
+    def check_pkt_id(self, pkt_id, byte_data):
+        """检查数据包是否被修改,带有认证的加密模块可以重写这个方法,省去MD5计算"""
+        return pkt_id == proto_utils.calc_content_md5(byte_data)
+
     def unwrap_header(self, header_data):
         """
         解包头, 重写这个方法
@@ -278,34 +354,152 @@ class parser(object):
 
     def unwrap_body(self, real_size, body_data):
         """
-        重写这个方法
+        重写这个方法,返回None表示丢弃该分段
         """
         return body_data
 
     def reset(self):
         """
-        重写这个方法,该reset无需手动调用
+        重写这个方法,该reset无需手动调用,会丢弃所有正在重组的数据包
         """
-        self.__tot_seg = 0
-        self.__data_area = {}
+        self.__slots.clear()
+        self.__done.clear()
+        self.__timer = timer.timer()
 
     def config(self, config):
         """重写这个方法,用于协议配置"""
         pass
 
 
-"""
-p = parser(MIN_FIXED_HEADER_SIZE)
-b = builder(MIN_FIXED_HEADER_SIZE)
+class parser_contexts(object):
+    """按客户端地址分别保存解析器,一个客户端的分段不会影响其他客户端的重组
+    解析器按最近使用排序,超过个数限制或者空闲超时的解析器会被删除
+    """
+    # 格式为 {address:parser,...}
+    __parsers = None
+    __creator = None
+    __timer = None
 
-data = list(bytes(1400))
-data.append(69)
+    __max_contexts = 0
+    __timeout = 0
 
-edata = b.build_packets(bytes(16), ACT_DATA, bytes(data))
-edata.pop(1)
-# print(edata)
+    __stats = None
 
-for t in edata:
-    rs = p.parse(t)
-    if rs: print(rs)
-"""
\ No newline at end of file
+    def __init__(self, creator, max_contexts=4096, timeout=900):
+        """
+        :param creator: 创建解析器的函数
+        :param max_contexts: 最多保存的解析器个数
+        :param timeout: 解析器的空闲超时时间,一般与会话超时时间相同
+        """
+        self.__parsers = collections.OrderedDict()
+        self.__creator = creator
+        self.__timer = timer.timer()
+        self.__max_contexts = max_contexts
+        self.__timeout = timeout
+        self.__stats = {"created": 0, "expired": 0, "evicted": 0, }
+
+    def get(self, address):
+        """获取客户端地址对应的解析器,没有时创建"""
+        p = self.__parsers.get(address, None)
+
+        if p is None:
+            p = self.__creator()
+            self.__parsers[address] = p
+            self.__stats["created"] += 1
+
+            if len(self.__parsers) > self.__max_contexts:
+                old_address, _ = self.__parsers.popitem(last=False)
+                self.__timer.drop(old_address)
+                self.__stats["evicted"] += 1
+        else:
+            self.__parsers.move_to_end(address)
+
+        self.__timer.set_timeout(address, self.__timeout)
+
+        return p
+
+    def expire(self):
+        """删除空闲超时的解析器"""
+        for address in self.__timer.get_timeout_names():
+            self.__timer.drop(address)
+            if address not in self.__parsers: continue
+            del self.__parsers[address]
+            self.__stats["expired"] += 1
+        return
+
+    def get_stats(self):
+        """获取统计信息,包括所有解析器的重组统计"""
+        stats = dict(self.__stats)
+        stats["contexts"] = len(self.__parsers)
+
+        for p in self.__parsers.values():
+            for k, v in p.get_reassembly_stats().items():
+                stats[k] = stats.get(k, 0) + v
+            ''''''
+        return stats
+
+
+if __name__ == "__main__":
+    # 性能测试,python3 -m freenet.lib.base_proto.tunnel_udp
+    import time
+
+    n = 20000
+    data = bytes(range(256)) * 5 + bytes(120)
+
+    b = builder(MIN_FIXED_HEADER_SIZE)
+    p = parser(MIN_FIXED_HEADER_SIZE)
+
+    t = time.time()
+    for i in range(n): edata = b.build_packets(bytes(16), ACT_DATA, data)
+    print("build: %d pkts/s" % (n / (time.time() - t)))
+
+    batch = [data] * 16
+    t = time.time()
+    for i in range(n // len(batch)): b.build_batch(bytes(16), ACT_DATA, batch)
+    print("build batch of %s: %d pkts/s" % (len(batch), n / (time.time() - t)))
+
+    for lost in (None, 1,):
+        seq = list(edata)
+        if lost is not None: seq.pop(lost)
+
+        t = time.time()
+        for i in range(n):
+            rs = [p.parse(pkt) for pkt in seq]
+            ''''''
+        if [r for r in rs if r] != [(bytes(16), ACT_DATA, data,)]: raise SystemExit("wrong parse result")
+
+        if lost is None:
+            print("parse: %d pkts/s" % (n / (time.time() - t)))
+        else:
+            print("parse with lost segment %s: %d pkts/s" % (lost + 1, n / (time.time() - t)))
+        ''''''
+
+    # 负载测试,大量客户端的分段乱序交错到达,每个分段有5%的丢失率
+    import os, random
+
+    def load_test(clients, get_parser):
+        segs = []
+        for c in range(clients):
+            address = ("127.0.0.1", c,)
+            session_id = os.urandom(16)
+            for i in range(4):
+                for seg in b.build_packets(session_id, ACT_DATA, os.urandom(1400)):
+                    if random.random() < 0.05: continue
+                    segs.append((c + random.random() * clients / 4, address, seg,))
+                ''''''
+            ''''''
+        segs.sort(key=lambda x: x[0])
+
+        ok = 0
+        for _, address, seg in segs:
+            if get_parser(address).parse(seg): ok += 1
+        return ok / (clients * 4)
+
+    for clients in (100, 1000, 5000,):
+        p = parser(MIN_FIXED_HEADER_SIZE)
+        shared = load_test(clients, lambda address: p)
+
+        contexts = parser_contexts(lambda: parser(MIN_FIXED_HEADER_SIZE), max_contexts=clients)
+        separate = load_test(clients, contexts.get)
+
+        print("%s clients: shared parser %.2f%%, per client parser %.2f%%" % (clients, shared * 100, separate * 100))
@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 """计算校检和
+优先使用C扩展fn_utils,没有编译扩展时自动使用纯python实现
 """
 import socket
-import freenet.lib.fn_utils as fn_utils
+
+try:
+    import freenet.lib.fn_utils as fn_utils
+except ImportError:
+    fn_utils = None
 
 FLAG_MODIFY_SRC_IP = 0
 FLAG_MODIFY_DST_IP = 1
@@ -16,10 +21,111 @@ FLAG_FILL_TCP_CSUM = 0
 FLAG_FILL_UDP_CSUM = 1
 
 
+def _fold_checksum(n):
+    """把反码求和的结果折叠为16位,因为 2^16 % 0xffff == 1,所以按16位分组累加等价于对0xffff取模
+    结果不为0时与逐个字段累加的结果相同,和为0xffff的倍数时为0xffff
+    """
+    r = n % 0xffff
+    if r == 0 and n: return 0xffff
+
+    return r
+
+
+def _calc_incre_checksum(old_checksum, old_field, new_field):
+    """使用增量式计算校检和
+    :param old_checksum: 2 bytes的旧校检和
+    :param old_field: 2 bytes的旧的需要修改字段
+    :param new_field: 2 bytes的新的字段
+    :return:
+        """
+    chksum = (~old_checksum & 0xffff) + (~old_field & 0xffff) + new_field
+    chksum = (chksum >> 16) + (chksum & 0xffff)
+    chksum += (chksum >> 16)
+
+    return (~chksum) & 0xffff
+
+
+def _calc_checksum(pacekt, size):
+    """计算校检和
+    :param pacekt:
+    :param size:
+    :return:
+    """
+    data = bytes(pacekt[0:size])
+    if len(data) % 2: data += b"\0"
+
+    return ~_fold_checksum(int.from_bytes(data, "big")) & 0xffff
+
+
+def _adjust_checksum(old_checksum, old_field, new_field):
+    """增量式计算校检和,字段可以是任意偶数长度的bytes"""
+    mask = (1 << (len(old_field) * 8)) - 1
+    n = (~old_checksum & 0xffff) + (mask ^ int.from_bytes(old_field, "big")) + int.from_bytes(new_field, "big")
+
+    return ~_fold_checksum(n) & 0xffff
+
+
+def _modify_ip4_address(ip_packet, byte_ip, flags, port=-1):
+    """fn_utils.modify_ip4_address的纯python实现"""
+    if len(byte_ip) != 4: raise ValueError("the size of address must be 4")
+    if port > 0xffff: raise ValueError("wrong port value")
+    if len(ip_packet) < 20 or ip_packet[0] & 0xf0 != 0x40: raise ValueError("wrong ipv4 packet")
+
+    ihl = (ip_packet[0] & 0x0f) * 4
+    if ihl < 20 or ihl > len(ip_packet): raise ValueError("wrong ipv4 header length")
+
+    if flags:
+        a = 16
+        port_pos = ihl + 2
+    else:
+        a = 12
+        port_pos = ihl
+
+    old_ip = bytes(ip_packet[a:a + 4])
+    csum = (ip_packet[10] << 8) | ip_packet[11]
+    ip_packet[10:12] = _adjust_checksum(csum, old_ip, byte_ip).to_bytes(2, "big")
+
+    protocol = ip_packet[9]
+    frag_off = ((ip_packet[6] & 0x1f) << 8) | ip_packet[7]
+
+    # 只有第一个分片才有TCP或者UDP头部
+    if frag_off == 0 and protocol in (6, 17,):
+        if protocol == 6:
+            b = ihl + 16
+        else:
+            b = ihl + 6
+
+        if b + 2 <= len(ip_packet):
+            old_field = old_ip
+            new_field = byte_ip
+
+            if port >= 0:
+                new_port = port.to_bytes(2, "big")
+                old_field += bytes(ip_packet[port_pos:port_pos + 2])
+                new_field += new_port
+                ip_packet[port_pos:port_pos + 2] = new_port
+
+            csum = (ip_packet[b] << 8) | ip_packet[b + 1]
+            # UDP校检和为0表示不计算校检和,计算结果为0时使用0xffff
+            if protocol == 6 or csum:
+                csum = _adjust_checksum(csum, old_field, new_field)
+                if protocol == 17 and csum == 0: csum = 0xffff
+                ip_packet[b:b + 2] = csum.to_bytes(2, "big")
+            ''''''
+        ''''''
+    ip_packet[a:a + 4] = byte_ip
+
+
+# 编译了fn_utils时使用C扩展,旧版本的扩展没有的函数也使用python实现
+calc_checksum = getattr(fn_utils, "calc_csum", _calc_checksum)
+calc_incre_checksum = getattr(fn_utils, "calc_incre_csum", _calc_incre_checksum)
+__modify_ip4_address = getattr(fn_utils, "modify_ip4_address", _modify_ip4_address)
+
+
 def modify_address(byte_ip, ip_packet_list, flags):
     """修改地址
     :param ip:
-    :param ip_packet_list:list数据结构的IP包
+    :param ip_packet_list:list或者bytearray数据结构的IP包
     :param flags: 指明修改源IP,还是目的IP地址
     :return:
     """
@@ -36,6 +142,17 @@ def modify_address(byte_ip, ip_packet_list, flags):
     __modify_ip_packet_address(new_ip, ip_packet_list, flags)
 
 
+def modify_address_in_place(byte_ip, ip_packet, flags, port=-1):
+    """直接在bytearray中修改IPv4地址,同时修正IP以及TCP/UDP校检和
+    :param byte_ip: 新的bytes类型的IP地址
+    :param ip_packet: bytearray类型的IP包
+    :param flags: 指明修改源IP,还是目的IP地址,端口也随之为源端口或者目的端口
+    :param port: 新的端口,小于0表示不修改端口,只对TCP与UDP有效
+    :return:
+    """
+    __modify_ip4_address(ip_packet, byte_ip, flags, port)
+
+
 def calc_checksum_for_ip_change(old_ip_packet, new_ip_packet, old_checksum):
     """ ip地址改变之后重新获取校检码
     :param old_ip_packet:
@@ -51,8 +168,7 @@ def calc_checksum_for_ip_change(old_ip_packet, new_ip_packet, old_checksum):
     for i in range(2):
         old_field = (old_ip_packet[a] << 8) | old_ip_packet[b]
         new_field = (new_ip_packet[a] << 8) | new_ip_packet[b]
-        # final_checksum = checksum.calc_incre_checksum(final_checksum, old_field, new_field)
-        final_checksum = fn_utils.calc_incre_csum(final_checksum, old_field, new_field)
+        final_checksum = calc_incre_checksum(final_checksum, old_field, new_field)
         a = a + 2
         b = b + 2
 
@@ -62,7 +178,7 @@ def calc_checksum_for_ip_change(old_ip_packet, new_ip_packet, old_checksum):
 def __modify_ip_packet_address(ip_packet, ip_packet_list, flags=0):
     """修改IP包地址
     :param ip_packet: 新的bytes类型的IP地址
-    :param ip_packet_list: list类型的IP包
+    :param ip_packet_list: list或者bytearray类型的IP包
     :param flags: 0表示修改的是源地址,1表示修改的是目的地址
     :return:
     """
@@ -93,7 +209,7 @@ def __modify_ip_packet_address(ip_packet, ip_packet_list, flags=0):
 def modify_tcpudp_checksum_for_ip_change(ip_packet, ip_packet_list, proto, flags=0):
     """ IP改变的时候重新计算TCP和UDP的校检和
     :param ip_packet:
-    :param ip_packet_list:
+    :param ip_packet_list: list或者bytearray类型的IP包
     :param proto: 0表示计算的UDP,1表示计算的TCP
     :param flags: 0 表示修改时的源地址,1表示修改的是目的地址
     :return:
@@ -131,7 +247,7 @@ def fill_ip_hdr_checksum(pkt_list):
     :return:
     """
     hdr_len = (pkt_list[0] & 0x0f) * 4
-    checksum = fn_utils.calc_csum(bytes(pkt_list), hdr_len)
+    checksum = calc_checksum(bytes(pkt_list), hdr_len)
 
     pkt_list[10:12] = (
         (checksum & 0xff00) >> 8,
@@ -139,39 +255,106 @@ def fill_ip_hdr_checksum(pkt_list):
     )
     return
 
-def _calc_incre_checksum(old_checksum, old_field, new_field):
-    """使用增量式计算校检和
-    :param old_checksum: 2 bytes的旧校检和
-    :param old_field: 2 bytes的旧的需要修改字段
-    :param new_field: 2 bytes的新的字段
-    :return:
-        """
-    chksum = (~old_checksum & 0xffff) + (~old_field & 0xffff) + new_field
-    chksum = (chksum >> 16) + (chksum & 0xffff)
-    chksum += (chksum >> 16)
-
-    return (~chksum) & 0xffff
-
 
-def _calc_checksum(pacekt, size):
-    """计算校检和
-    :param pacekt:
-    :param size:
+def fill_ip_hdr_checksum_in_place(ip_packet):
+    """重新计算并填充IP包头校检和
+    :param ip_packet: bytearray类型的IP包
     :return:
     """
-    checksum = 0
-    a = 0
-    b = 1
-    while size > 1:
-        checksum += (pacekt[a] << 8) | pacekt[b]
-        size -= 2
-        a += 2
-        b += 2
+    hdr_len = (ip_packet[0] & 0x0f) * 4
+    ip_packet[10:12] = b"\0\0"
+    ip_packet[10:12] = calc_checksum(ip_packet, hdr_len).to_bytes(2, "big")
 
-    if size:
-        checksum += pacekt[a]
 
-    checksum = (checksum >> 16) + (checksum & 0xffff)
-    checksum += (checksum >> 16)
+def fill_tcpudp_checksum_in_place(ip_packet):
+    """重新计算并填充TCP或者UDP校检和,只对没有分片的IPv4数据包有效
+    :param ip_packet: bytearray类型的IP包
+    :return:
+    """
+    hdr_len = (ip_packet[0] & 0x0f) * 4
+    protocol = ip_packet[9]
 
-    return (~checksum) & 0xffff
+    if protocol == 6:
+        a = hdr_len + 16
+    elif protocol == 17:
+        a = hdr_len + 6
+    else:
+        return
+
+    tot_len = (ip_packet[2] << 8) | ip_packet[3]
+    size = tot_len - hdr_len
+    if a + 2 > tot_len or tot_len > len(ip_packet): raise ValueError("wrong ipv4 packet length")
+
+    ip_packet[a:a + 2] = b"\0\0"
+    # 伪头部为 源地址 + 目的地址 + 0 + 协议 + TCP或者UDP长度
+    data = b"".join((bytes(ip_packet[12:20]), bytes((0, protocol,)), size.to_bytes(2, "big"),
+                     bytes(ip_packet[hdr_len:tot_len]),))
+    checksum = calc_checksum(data, len(data))
+    if protocol == 17 and checksum == 0: checksum = 0xffff
+
+    ip_packet[a:a + 2] = checksum.to_bytes(2, "big")
+
+
+if __name__ == "__main__":
+    # C扩展与python实现的一致性以及性能测试,python3 -m freenet.lib.checksum
+    import os, random, time
+
+    for size in range(0, 1500):
+        data = os.urandom(size)
+        n = sum([(data[i] << 8) | (data[i + 1] if i + 1 < size else 0) for i in range(0, size, 2)])
+        while n >> 16: n = (n & 0xffff) + (n >> 16)
+        if _calc_checksum(data, size) != ~n & 0xffff: raise SystemExit("wrong python checksum")
+        if fn_utils and calc_checksum(data, size) != ~n & 0xffff: raise SystemExit("wrong C checksum")
+    ''''''
+
+    pkts = []
+    for i in range(2000):
+        protocol = random.choice((1, 6, 17,))
+        size = random.choice((40, 60, 576, 1400,))
+        pkt = bytearray(b"\x45\x00" + size.to_bytes(2, "big") + os.urandom(2) + b"\x40\x00\x40" + bytes((protocol,)))
+        pkt += bytes(2) + os.urandom(size - 12)
+        fill_ip_hdr_checksum_in_place(pkt)
+        fill_tcpudp_checksum_in_place(pkt)
+        pkts.append(bytes(pkt))
+    ''''''
+
+    def check_pkt(pkt):
+        if _calc_checksum(pkt, 20) != 0: return False
+        data = bytearray(pkt)
+        fill_tcpudp_checksum_in_place(data)
+        return data == pkt
+
+
+    for pkt in pkts:
+        new_addr = os.urandom(4)
+        flags = random.choice((FLAG_MODIFY_SRC_IP, FLAG_MODIFY_DST_IP,))
+        port = random.choice((-1, 0, 53, 65535,))
+
+        py_pkt = bytearray(pkt)
+        _modify_ip4_address(py_pkt, new_addr, flags, port)
+        if not check_pkt(bytes(py_pkt)): raise SystemExit("wrong python address modification")
+
+        if not fn_utils: continue
+        c_pkt = bytearray(pkt)
+        modify_address_in_place(new_addr, c_pkt, flags, port)
+        if c_pkt != py_pkt: raise SystemExit("C and python results are not same")
+    ''''''
+
+    n = 20
+    new_addr = socket.inet_aton("10.10.0.2")
+    impls = [("python", _calc_checksum, _modify_ip4_address,)]
+    if fn_utils: impls.append(("C", fn_utils.calc_csum, fn_utils.modify_ip4_address,))
+
+    for name, csum_func, modify_func in impls:
+        t = time.time()
+        for i in range(n):
+            for pkt in pkts: csum_func(pkt, len(pkt))
+        csum_rate = n * len(pkts) / (time.time() - t)
+
+        t = time.time()
+        for i in range(n):
+            for pkt in pkts: modify_func(bytearray(pkt), new_addr, FLAG_MODIFY_SRC_IP, 1999)
+        modify_rate = n * len(pkts) / (time.time() - t)
+
+        print("%-6s checksum: %7d pkts/s, modify address: %7d pkts/s" % (name, csum_rate, modify_rate,))
+    ''''''
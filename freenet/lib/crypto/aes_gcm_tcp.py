@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""TCP版本的AES-GCM加密模块
+每个数据包的格式为 nonce(12 bytes) + 加密后的协议头 + 加密后的数据 + tag(16 bytes)
+协议头中的tot_length包括tag的长度,协议头在收到整个数据包之后才能完成认证
+协议头与数据使用同一个加密对象一次加密,由tag保证数据完整性,因此不再计算MD5,数据也不需要填充
+
+支持tunnel_tcp的v2格式,每个帧的格式为 加密后的帧 + tag(16 bytes),不再发送nonce
+v2格式的密钥由原密钥与FRAMING_SWITCH包中的种子生成,每个连接的每个方向都不同,nonce为从0开始的计数器
+"""
+
+from Crypto.Cipher import AES
+import os, hashlib
+import freenet.lib.base_proto.tunnel_tcp as tunnel
+import freenet.lib.base_proto.utils as proto_utils
+
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+FIXED_HEADER_SIZE = NONCE_SIZE + tunnel.MIN_FIXED_HEADER_SIZE
+
+_NONCE_MAX = (1 << (NONCE_SIZE * 8)) - 1
+
+
+def _gen_frame_key(key, seed):
+    return hashlib.sha256(key + seed).digest()
+
+
+class encrypt(tunnel.builder):
+    __key = b""
+    __nonce = 0
+    __cipher = None
+
+    __frame_key = b""
+    __frame_nonce = 0
+
+    def __init__(self):
+        super(encrypt, self).__init__(FIXED_HEADER_SIZE)
+        self.__nonce = int.from_bytes(os.urandom(NONCE_SIZE), "big")
+
+    def new_cipher(self, key, nonce):
+        """重写这个方法可以更换AEAD算法"""
+        return AES.new(key, AES.MODE_GCM, nonce=nonce, mac_len=TAG_SIZE)
+
+    def gen_pkt_id(self, byte_data):
+        # 数据完整性由tag保证,不再需要MD5值
+        return bytes(16)
+
+    def wrap_header(self, base_hdr):
+        nonce = self.__nonce.to_bytes(NONCE_SIZE, "big")
+        self.__nonce = (self.__nonce + 1) & _NONCE_MAX
+        self.__cipher = self.new_cipher(self.__key, nonce)
+
+        return nonce + self.__cipher.encrypt(base_hdr)
+
+    def wrap_body(self, size, body_data):
+        return self.__cipher.encrypt(body_data) + self.__cipher.digest()
+
+    def get_payload_length(self, pkt_len):
+        return pkt_len + TAG_SIZE
+
+    def framing_v2_is_supported(self):
+        return True
+
+    def init_frames(self, seed):
+        self.__frame_key = _gen_frame_key(self.__key, seed)
+        self.__frame_nonce = 0
+
+    def wrap_frame(self, frame):
+        nonce = self.__frame_nonce.to_bytes(NONCE_SIZE, "big")
+        self.__frame_nonce += 1
+        e_frame, tag = self.new_cipher(self.__frame_key, nonce).encrypt_and_digest(frame)
+
+        return e_frame + tag
+
+    def __set_key(self, new_key):
+        self.__key = hashlib.sha256(new_key.encode()).digest()
+
+    def reset(self):
+        super(encrypt, self).reset()
+
+    def config(self, config):
+        """重写这个方法,用于协议配置"""
+        self.__set_key(config["key"])
+
+
+class decrypt(tunnel.parser):
+    __key = b""
+    __cipher = None
+
+    __frame_key = b""
+    __frame_nonce = 0
+
+    def __init__(self):
+        super(decrypt, self).__init__(FIXED_HEADER_SIZE)
+
+    def new_cipher(self, key, nonce):
+        """重写这个方法可以更换AEAD算法"""
+        return AES.new(key, AES.MODE_GCM, nonce=nonce, mac_len=TAG_SIZE)
+
+    def check_pkt_id(self, payload_md5, body):
+        # 数据完整性已经由tag保证
+        return True
+
+    def unwrap_header(self, header):
+        self.__cipher = self.new_cipher(self.__key, header[0:NONCE_SIZE])
+
+        # 此时协议头还没有经过认证,需要在unwrap_body中校验tag
+        return self.__cipher.decrypt(header[NONCE_SIZE:])
+
+    def unwrap_body(self, real_size, body_data):
+        if len(body_data) < TAG_SIZE: raise proto_utils.ProtoError("data wrong")
+        data = self.__cipher.decrypt(body_data[0:-TAG_SIZE])
+
+        try:
+            self.__cipher.verify(body_data[-TAG_SIZE:])
+        except ValueError:
+            raise proto_utils.ProtoError("data has been modified")
+
+        return data[0:real_size]
+
+    def framing_v2_is_supported(self):
+        return True
+
+    def init_frames(self, seed):
+        self.__frame_key = _gen_frame_key(self.__key, seed)
+        self.__frame_nonce = 0
+
+    def unwrap_frame(self, e_frame):
+        if len(e_frame) < TAG_SIZE: return None
+
+        nonce = self.__frame_nonce.to_bytes(NONCE_SIZE, "big")
+        self.__frame_nonce += 1
+        cipher = self.new_cipher(self.__frame_key, nonce)
+
+        try:
+            return cipher.decrypt_and_verify(e_frame[0:-TAG_SIZE], e_frame[-TAG_SIZE:])
+        except ValueError:
+            return None
+
+    def __set_key(self, key):
+        self.__key = hashlib.sha256(key.encode()).digest()
+
+    def reset(self):
+        super(decrypt, self).reset()
+
+    def config(self, config):
+        """重写这个方法,用于协议配置"""
+        self.__set_key(config["key"])
+
+
+if __name__ == "__main__":
+    # 与其他TCP加密模块的性能比较,python3 -m freenet.lib.crypto.aes_gcm_tcp
+    import time
+
+    n = 5000
+    for name, v2 in (("aes_tcp", False,), ("aes_gcm_tcp", False,), ("aes_gcm_tcp", True,), ("chacha20_tcp", True,),):
+        m = __import__("freenet.lib.crypto.%s" % name, fromlist=[name])
+
+        # 40 bytes为TCP ACK,100 bytes左右为DNS查询
+        for size in (40, 100, 1400,):
+            data = os.urandom(size)
+            builder = m.encrypt()
+            parser = m.decrypt()
+            builder.config({"key": "fdslight"})
+            parser.config({"key": "fdslight"})
+
+            if v2: parser.input(builder.build_switch(bytes(16)))
+
+            pkts = []
+            t = time.time()
+            for i in range(n):
+                pkts.append(builder.build_packet(bytes(16), tunnel.ACT_DATA, data))
+                builder.reset()
+            build_rate = n / (time.time() - t)
+
+            t = time.time()
+            for pkt in pkts: rs = parser.input(pkt)
+            parse_rate = n / (time.time() - t)
+
+            if [r[2] for r in rs] != [data]: raise SystemExit("wrong parse result")
+            print("%-12s v%s %4s bytes: build %6d pkts/s, parse %6d pkts/s, overhead %s bytes" % (
+                name, builder.framing, size, build_rate, parse_rate, len(pkts[0]) - size))
+        ''''''
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""UDP版本的AES-GCM加密模块
+每个分段的格式为 nonce(12 bytes) + 加密后的协议头 + 加密后的数据 + tag(16 bytes)
+协议头与数据使用同一个加密对象一次加密,由tag保证数据完整性,因此不再计算MD5,数据也不需要填充
+nonce是初始值随机的计数器,每个分段加1
+"""
+
+from Crypto.Cipher import AES
+import os, hashlib
+import freenet.lib.base_proto.tunnel_udp as tunnel
+
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+FIXED_HEADER_SIZE = NONCE_SIZE + tunnel.MIN_FIXED_HEADER_SIZE
+
+_NONCE_MAX = (1 << (NONCE_SIZE * 8)) - 1
+
+
+class encrypt(tunnel.builder):
+    __key = b""
+    __nonce = 0
+    __cipher = None
+
+    def __init__(self):
+        super(encrypt, self).__init__(FIXED_HEADER_SIZE)
+        # 加上tag之后的分段大小不超过原来的数据块大小
+        self.set_max_pkt_size(self.block_size - TAG_SIZE)
+        self.__nonce = int.from_bytes(os.urandom(NONCE_SIZE), "big")
+
+    def new_cipher(self, key, nonce):
+        """重写这个方法可以更换AEAD算法"""
+        return AES.new(key, AES.MODE_GCM, nonce=nonce, mac_len=TAG_SIZE)
+
+    def gen_pkt_id(self, byte_data):
+        # 使用数据包第一个分段的nonce作为数据包ID
+        return self.__nonce.to_bytes(16, "big")
+
+    def wrap_header(self, base_hdr):
+        nonce = self.__nonce.to_bytes(NONCE_SIZE, "big")
+        self.__nonce = (self.__nonce + 1) & _NONCE_MAX
+        self.__cipher = self.new_cipher(self.__key, nonce)
+
+        return nonce + self.__cipher.encrypt(base_hdr)
+
+    def wrap_body(self, size, body_data):
+        return self.__cipher.encrypt(body_data) + self.__cipher.digest()
+
+    def __set_key(self, new_key):
+        self.__key = hashlib.sha256(new_key.encode()).digest()
+
+    def reset(self):
+        super(encrypt, self).reset()
+
+    def config(self, config):
+        """重写这个方法,用于协议配置"""
+        self.__set_key(config["key"])
+
+
+class decrypt(tunnel.parser):
+    __key = b""
+    __cipher = None
+
+    def __init__(self):
+        super(decrypt, self).__init__(FIXED_HEADER_SIZE)
+
+    def new_cipher(self, key, nonce):
+        """重写这个方法可以更换AEAD算法"""
+        return AES.new(key, AES.MODE_GCM, nonce=nonce, mac_len=TAG_SIZE)
+
+    def check_pkt_id(self, pkt_id, byte_data):
+        # 数据完整性已经由tag保证
+        return True
+
+    def unwrap_header(self, header_data):
+        if len(header_data) < FIXED_HEADER_SIZE: return None
+        self.__cipher = self.new_cipher(self.__key, header_data[0:NONCE_SIZE])
+
+        # 此时协议头还没有经过认证,需要在unwrap_body中校验tag
+        return self.__cipher.decrypt(header_data[NONCE_SIZE:])
+
+    def unwrap_body(self, length, body_data):
+        if len(body_data) < TAG_SIZE: return None
+        data = self.__cipher.decrypt(body_data[0:-TAG_SIZE])
+
+        # 丢弃被修改或者误码的包
+        try:
+            self.__cipher.verify(body_data[-TAG_SIZE:])
+        except ValueError:
+            return None
+
+        return data[0:length]
+
+    def __set_key(self, key):
+        self.__key = hashlib.sha256(key.encode()).digest()
+
+    def reset(self):
+        super(decrypt, self).reset()
+
+    def config(self, config):
+        """重写这个方法,用于协议配置"""
+        self.__set_key(config["key"])
+
+
+if __name__ == "__main__":
+    # 与其他UDP加密模块的性能比较,python3 -m freenet.lib.crypto.aes_gcm_udp
+    import time
+
+    n = 5000
+    for name in ("aes_udp", "aes_gcm_udp", "chacha20_udp",):
+        m = __import__("freenet.lib.crypto.%s" % name, fromlist=[name])
+
+        for size in (100, 1400,):
+            data = os.urandom(size)
+            builder = m.encrypt()
+            parser = m.decrypt()
+            builder.config({"key": "fdslight"})
+            parser.config({"key": "fdslight"})
+
+            t = time.time()
+            for i in range(n): pkts = builder.build_packets(bytes(16), tunnel.ACT_DATA, data)
+            build_rate = n / (time.time() - t)
+
+            t = time.time()
+            for i in range(n):
+                rs = [parser.parse(pkt) for pkt in pkts]
+                ''''''
+            parse_rate = n / (time.time() - t)
+
+            if [r[2] for r in rs if r] != [data]: raise SystemExit("wrong parse result")
+            overhead = sum([len(pkt) for pkt in pkts]) - size
+            print("%-12s %4s bytes: build %6d pkts/s, parse %6d pkts/s, %s segments, overhead %s bytes" % (
+                name, size, build_rate, parse_rate, len(pkts), overhead))
+        ''''''
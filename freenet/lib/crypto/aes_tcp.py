@@ -6,18 +6,24 @@ sys.path.append("../../../")
 """
 
 from Crypto.Cipher import AES
-import random, hashlib
+import os, hashlib
 import freenet.lib.base_proto.tunnel_tcp as tunnel
 import freenet.lib.base_proto.utils as proto_utils
 
 FIXED_HEADER_SIZE = 64
 
+# IV随机数池的大小,单位为IV个数
+_IV_POOL_SIZE = 256
+
 
 class encrypt(tunnel.builder):
     __key = b""
     __iv = b""
     # 需要补充的`\0`
     __const_fill = b""
+    # IV随机数池
+    __iv_pool = b""
+    __iv_pos = 0
 
     def __init__(self):
         if tunnel.MIN_FIXED_HEADER_SIZE % 16 != 0:
@@ -26,26 +32,22 @@ class encrypt(tunnel.builder):
         super(encrypt, self).__init__(FIXED_HEADER_SIZE)
 
     def __rand(self, length=16):
-        sset = "1234567890qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM"
-        seq = []
+        """从随机数池中获取IV,池用完时一次性用os.urandom重新填充"""
+        if self.__iv_pos + length > len(self.__iv_pool):
+            self.__iv_pool = os.urandom(length * _IV_POOL_SIZE)
+            self.__iv_pos = 0
 
-        for i in range(length):
-            n = random.randint(0, 61)
-            seq.append(sset[n])
+        b = self.__iv_pos
+        self.__iv_pos += length
 
-        return "".join(seq).encode("iso-8859-1")
+        return self.__iv_pool[b:self.__iv_pos]
 
     def wrap_header(self, base_hdr):
         iv = self.__rand()
         cipher = AES.new(self.__key, AES.MODE_CFB, iv)
         self.__iv = iv
-        seq = [
-            base_hdr,
-            self.__const_fill
-        ]
-        e_data = cipher.encrypt(b"".join(seq))
 
-        return iv + e_data
+        return iv + cipher.encrypt(base_hdr + self.__const_fill)
 
     def wrap_body(self, size, body_data):
         cipher = AES.new(self.__key, AES.MODE_CFB, self.__iv)
@@ -120,27 +122,44 @@ class decrypt(tunnel.parser):
         self.__set_aes_key(config["key"])
 
 
-"""
-key="name"
-builder = encrypt()
-builder.config({"key":key})
-
-e_rs = builder.build_packet(bytes(16),tunnel.ACT_DATA,b"hello")
-builder.reset()
-
-parser = decrypt()
-parser.config({"key":"name"})
-parser.input(e_rs)
-
-while parser.can_continue_parse():
-    parser.parse()
-print(parser.get_pkt())
-
-e_rs = builder.build_packet(bytes(16),tunnel.ACT_DATA,b"world")
-builder.reset()
-parser.input(e_rs)
-
-while parser.can_continue_parse():
-    parser.parse()
-print(parser.get_pkt())
-"""
\ No newline at end of file
+if __name__ == "__main__":
+    # 与旧版本的兼容性测试,python3 -m freenet.lib.crypto.aes_tcp
+    # 旧版本的格式为 iv + AES_CFB(iv,协议头+填充) + AES_CFB(iv,数据+填充),两次加密都从iv开始
+    import random
+
+    key = hashlib.md5(b"fdslight").digest()
+    const_fill = b"f" * (16 - tunnel.MIN_FIXED_HEADER_SIZE % 16)
+    sset = b"1234567890qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM"
+
+    def legacy_unwrap(pkt):
+        iv = pkt[0:16]
+        hdr = AES.new(key, AES.MODE_CFB, iv).decrypt(pkt[16:FIXED_HEADER_SIZE])
+        body = AES.new(key, AES.MODE_CFB, iv).decrypt(pkt[FIXED_HEADER_SIZE:])
+        return (iv, hdr, body,)
+
+    def legacy_wrap(iv, hdr, body):
+        e_hdr = AES.new(key, AES.MODE_CFB, iv).encrypt(hdr)
+        e_body = AES.new(key, AES.MODE_CFB, iv).encrypt(body)
+        return b"".join([iv, e_hdr, e_body])
+
+    builder = encrypt()
+    builder.config({"key": "fdslight"})
+    parser = decrypt()
+    parser.config({"key": "fdslight"})
+
+    for size in (0, 1, 100, 1400, 2000,):
+        data = os.urandom(size)
+        pkt = builder.build_packet(bytes(16), tunnel.ACT_DATA, data)
+        builder.reset()
+
+        # 新版本生成的数据包与旧版本的加密方式逐字节相同
+        iv, hdr, body = legacy_unwrap(pkt)
+        if hdr[tunnel.MIN_FIXED_HEADER_SIZE:] != const_fill: raise SystemExit("wrong header fill")
+        if legacy_wrap(iv, hdr, body) != pkt: raise SystemExit("not compatible with the old version")
+
+        # 旧版本使用字母数字IV
+        old_iv = bytes([random.choice(sset) for i in range(16)])
+        rs = parser.input(legacy_wrap(old_iv, hdr, body))
+        if [r[2] for r in rs] != [data]: raise SystemExit("can not parse the packets of the old version")
+    ''''''
+    print("ok")
@@ -7,17 +7,23 @@ sys.path.append("../../../")
 """
 
 from Crypto.Cipher import AES
-import random, hashlib
+import os, hashlib
 import freenet.lib.base_proto.tunnel_udp as tunnel
 
 FIXED_HEADER_SIZE = 64
 
+# IV随机数池的大小,单位为IV个数
+_IV_POOL_SIZE = 256
+
 
 class encrypt(tunnel.builder):
     __key = b""
     __iv = b""
     # 需要补充的`\0`
     __const_fill = b""
+    # IV随机数池
+    __iv_pool = b""
+    __iv_pos = 0
 
     __real_size = 0
     __body_size = 0
@@ -30,26 +36,22 @@ class encrypt(tunnel.builder):
         self.set_max_pkt_size(self.block_size - self.block_size % 16)
 
     def __rand(self, length=16):
-        sset = "1234567890qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM"
-        seq = []
+        """从随机数池中获取IV,池用完时一次性用os.urandom重新填充"""
+        if self.__iv_pos + length > len(self.__iv_pool):
+            self.__iv_pool = os.urandom(length * _IV_POOL_SIZE)
+            self.__iv_pos = 0
 
-        for i in range(length):
-            n = random.randint(0, 61)
-            seq.append(sset[n])
+        b = self.__iv_pos
+        self.__iv_pos += length
 
-        return "".join(seq).encode("iso-8859-1")
+        return self.__iv_pool[b:self.__iv_pos]
 
     def wrap_header(self, base_hdr):
         iv = self.__rand()
         cipher = AES.new(self.__key, AES.MODE_CFB, iv)
         self.__iv = iv
-        seq = [
-            base_hdr,
-            self.__const_fill
-        ]
-        e_data = cipher.encrypt(b"".join(seq))
 
-        return iv + e_data
+        return iv + cipher.encrypt(base_hdr + self.__const_fill)
 
     def wrap_body(self, size, body_data):
         cipher = AES.new(self.__key, AES.MODE_CFB, self.__iv)
@@ -125,24 +127,46 @@ class decrypt(tunnel.parser):
         self.__set_aes_key(config["key"])
 
 
-"""
-length = 1500
-L = []
-
-for n in range(length):
-    L.append(33)
-
-key = "hello"
-builder = encrypt()
-builder.config({"key":key})
-
-packets = builder.build_packets(bytes(16),tunnel.ACT_DATA,b"hello")
-
-parser = decrypt()
-parser.config({"key":"hello"})
-
-
-for pkt in packets:
-    ret = parser.parse(pkt)
-    if ret: print(ret)
-"""
\ No newline at end of file
+if __name__ == "__main__":
+    # 与旧版本的兼容性测试,python3 -m freenet.lib.crypto.aes_udp
+    # 旧版本的格式为 iv + AES_CFB(iv,协议头+填充) + AES_CFB(iv,数据+填充),两次加密都从iv开始
+    import random
+
+    key = hashlib.md5(b"fdslight").digest()
+    const_fill = b"f" * (16 - tunnel.MIN_FIXED_HEADER_SIZE % 16)
+    sset = b"1234567890qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM"
+
+    def legacy_unwrap(pkt):
+        iv = pkt[0:16]
+        hdr = AES.new(key, AES.MODE_CFB, iv).decrypt(pkt[16:FIXED_HEADER_SIZE])
+        body = AES.new(key, AES.MODE_CFB, iv).decrypt(pkt[FIXED_HEADER_SIZE:])
+        return (iv, hdr, body,)
+
+    def legacy_wrap(iv, hdr, body):
+        e_hdr = AES.new(key, AES.MODE_CFB, iv).encrypt(hdr)
+        e_body = AES.new(key, AES.MODE_CFB, iv).encrypt(body)
+        return b"".join([iv, e_hdr, e_body])
+
+    builder = encrypt()
+    builder.config({"key": "fdslight"})
+    parser = decrypt()
+    parser.config({"key": "fdslight"})
+
+    for size in (0, 1, 100, 1400, 2000,):
+        data = os.urandom(size)
+        pkts = builder.build_packets(bytes(16), tunnel.ACT_DATA, data)
+        old_pkts = []
+
+        for pkt in pkts:
+            iv, hdr, body = legacy_unwrap(pkt)
+            # 新版本生成的数据包与旧版本的加密方式逐字节相同
+            if hdr[tunnel.MIN_FIXED_HEADER_SIZE:] != const_fill: raise SystemExit("wrong header fill")
+            if legacy_wrap(iv, hdr, body) != pkt: raise SystemExit("not compatible with the old version")
+            # 旧版本使用字母数字IV
+            old_iv = bytes([random.choice(sset) for i in range(16)])
+            old_pkts.append(legacy_wrap(old_iv, hdr, body))
+        ''''''
+        rs = [parser.parse(pkt) for pkt in old_pkts]
+        if [r[2] for r in rs if r] != [data]: raise SystemExit("can not parse the packets of the old version")
+    ''''''
+    print("ok")
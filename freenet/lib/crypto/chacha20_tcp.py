@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+"""TCP版本的ChaCha20-Poly1305加密模块,格式与aes_gcm_tcp相同,适用于没有AES硬件加速的机器"""
+
+from Crypto.Cipher import ChaCha20_Poly1305
+import freenet.lib.crypto.aes_gcm_tcp as aes_gcm_tcp
+
+FIXED_HEADER_SIZE = aes_gcm_tcp.FIXED_HEADER_SIZE
+
+
+class encrypt(aes_gcm_tcp.encrypt):
+    def new_cipher(self, key, nonce):
+        return ChaCha20_Poly1305.new(key=key, nonce=nonce)
+
+
+class decrypt(aes_gcm_tcp.decrypt):
+    def new_cipher(self, key, nonce):
+        return ChaCha20_Poly1305.new(key=key, nonce=nonce)
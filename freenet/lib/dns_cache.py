@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""DNS响应缓存
+以(qname,qtype,qclass)为键缓存完整的响应报文,缓存时间为回答中最小的TTL
+域名不存在以及没有记录的否定响应按照授权部分的SOA记录缓存,见RFC 2308
+命中时把报文的DNS ID改为请求的ID,并且把所有的TTL减去已经缓存的时间
+缓存个数或者总字节数超过限制时淘汰最久没有使用的响应
+"""
+
+import collections, struct, time
+import freenet.lib.dns_wire as dns_wire
+
+_TTL = struct.Struct("!I")
+
+
+class dns_cache(object):
+    # {(qname,qtype,qclass):(message,expire_time,store_time,ttl_offsets,ipv4s),...},按照使用的先后顺序排列
+    __cache = None
+    __max_entries = 4096
+    __max_bytes = 0
+    __max_ttl = 3600
+    __max_neg_ttl = 300
+    # 缓存的报文的总字节数
+    __bytes = 0
+
+    __stats = None
+
+    def __init__(self, max_entries=4096, max_bytes=4 * 1024 * 1024, max_ttl=3600, max_neg_ttl=300):
+        """
+        :param max_entries: 最多缓存的响应个数
+        :param max_bytes: 缓存的响应的最大总字节数,0表示不限制
+        :param max_ttl: 最长缓存时间,单位为秒
+        :param max_neg_ttl: 否定响应的最长缓存时间,单位为秒
+        """
+        if max_entries < 1: raise ValueError("the max_entries must be more than 0")
+
+        self.__cache = collections.OrderedDict()
+        self.__max_entries = max_entries
+        self.__max_bytes = max_bytes
+        self.__max_ttl = max_ttl
+        self.__max_neg_ttl = max_neg_ttl
+        self.__bytes = 0
+        self.__stats = {"hits": 0, "misses": 0, "stored": 0, "expired": 0, "evicted": 0, }
+
+    def __delete(self, key):
+        message = self.__cache.pop(key)[0]
+        self.__bytes -= len(message)
+
+    def get(self, qname, qtype, qclass, dns_id):
+        """获取缓存的响应
+        :param qname: dns_wire.parse_query返回的域名
+        :param dns_id: 请求的DNS ID
+        :return tuple: (message,ipv4s),没有缓存时返回None
+        """
+        key = (qname.lower(), qtype, qclass,)
+        entry = self.__cache.get(key, None)
+
+        if not entry:
+            self.__stats["misses"] += 1
+            return None
+
+        message, expire_time, store_time, ttl_offsets, ipv4s = entry
+        now = time.monotonic()
+
+        if now >= expire_time:
+            self.__delete(key)
+            self.__stats["expired"] += 1
+            self.__stats["misses"] += 1
+            return None
+
+        self.__cache.move_to_end(key)
+        self.__stats["hits"] += 1
+
+        response = bytearray(message)
+        response[0] = (dns_id & 0xff00) >> 8
+        response[1] = dns_id & 0x00ff
+
+        elapsed = int(now - store_time)
+        if elapsed:
+            for offset in ttl_offsets:
+                ttl, = _TTL.unpack_from(message, offset)
+                _TTL.pack_into(response, offset, ttl - elapsed if ttl > elapsed else 0)
+            ''''''
+
+        return (bytes(response), ipv4s,)
+
+    def put(self, message, key):
+        """缓存DNS响应,不能缓存的响应会被忽略
+        :param key: 发送的请求的 (qname,qtype,qclass),qname为小写,响应的问题与请求不同时不缓存
+        :return bool: 是否被缓存
+        """
+        info = dns_wire.parse_cache_info(message)
+        if not info: return False
+
+        qname, qtype, qclass, rcode, tc, ttl, neg_ttl, ttl_offsets, ipv4s = info
+        if (qname, qtype, qclass,) != key: return False
+
+        # 截断的响应需要客户端使用TCP重新请求,不能缓存
+        if tc: return False
+
+        if rcode == dns_wire.RCODE_NOERROR and ttl is not None:
+            ttl = min(ttl, self.__max_ttl)
+        elif rcode in (dns_wire.RCODE_NOERROR, dns_wire.RCODE_NXDOMAIN,) and neg_ttl is not None:
+            ttl = min(neg_ttl, self.__max_neg_ttl)
+        else:
+            return False
+
+        if ttl < 1: return False
+
+        if key in self.__cache: self.__delete(key)
+
+        now = time.monotonic()
+        message = bytes(message)
+
+        self.__cache[key] = (message, now + ttl, now, ttl_offsets, ipv4s,)
+        self.__bytes += len(message)
+        self.__stats["stored"] += 1
+
+        while len(self.__cache) > self.__max_entries or (self.__max_bytes and self.__bytes > self.__max_bytes):
+            self.__delete(next(iter(self.__cache)))
+            self.__stats["evicted"] += 1
+        ''''''
+
+        return True
+
+    def clear(self):
+        self.__cache.clear()
+        self.__bytes = 0
+
+    def get_stats(self):
+        """获取缓存统计信息"""
+        stats = self.__stats.copy()
+        stats["entries"] = len(self.__cache)
+        stats["bytes"] = self.__bytes
+
+        return stats
+
+
+if __name__ == "__main__":
+    # 测试以及性能测试,python3 -m freenet.lib.dns_cache
+    import random, string
+    import dns.message, dns.rrset
+
+    query = dns.message.make_query("www.Example.com", "A", use_edns=0)
+    response = dns.message.make_response(query)
+    response.answer.append(dns.rrset.from_text("www.example.com.", 300, "IN", "CNAME", "cdn.example.com."))
+    response.answer.append(dns.rrset.from_text("cdn.example.com.", 60, "IN", "A", "1.2.3.4"))
+
+    cache = dns_cache()
+    # 问题与请求不同的响应不缓存
+    if cache.put(response.to_wire(), ("www.example.net", 1, 1,)): raise SystemExit("the key should be checked")
+    if not cache.put(response.to_wire(), ("www.example.com", 1, 1,)): raise SystemExit(
+        "the response should be cached")
+
+    _, _, qname, qtype, qclass = dns_wire.parse_query(query.to_wire())
+    rs = cache.get(qname, qtype, qclass, 0x1234)
+    if not rs or rs[1] != ["1.2.3.4"]: raise SystemExit("wrong cache result")
+
+    msg = dns.message.from_wire(rs[0])
+    if msg.id != 0x1234 or [rrset.ttl for rrset in msg.answer] != [300, 60] or len(msg.opt or []) != 1:
+        raise SystemExit("wrong cached message")
+
+    # 模拟经过的时间,TTL需要减去缓存的时间
+    for key in list(cache._dns_cache__cache):
+        entry = cache._dns_cache__cache[key]
+        cache._dns_cache__cache[key] = (entry[0], entry[1] - 20, entry[2] - 20,) + entry[3:]
+    msg = dns.message.from_wire(cache.get(qname, qtype, qclass, 1)[0])
+    if [rrset.ttl for rrset in msg.answer] != [280, 40]: raise SystemExit("wrong ttl")
+
+    # 否定响应
+    query = dns.message.make_query("none.example.com", "A")
+    response = dns.message.make_response(query)
+    response.set_rcode(3)
+    response.authority.append(dns.rrset.from_text("example.com.", 3600, "IN", "SOA",
+                                                  "ns.example.com. admin.example.com. 1 7200 900 1209600 600"))
+    if not cache.put(response.to_wire(), ("none.example.com", 1, 1,)): raise SystemExit(
+        "the negative response should be cached")
+    entry = cache._dns_cache__cache[("none.example.com", 1, 1,)]
+    if round(entry[1] - entry[2]) != 300: raise SystemExit("wrong negative ttl")
+
+    # 没有SOA的否定响应不缓存
+    response.authority = []
+    if cache.put(response.to_wire(), ("none.example.com", 1, 1,)): raise SystemExit(
+        "the response should not be cached")
+
+    # LRU淘汰
+    cache = dns_cache(max_entries=1000)
+    names = ["".join(random.choice(string.ascii_lowercase) for i in range(10)) + ".com" for j in range(2000)]
+    messages = []
+    for name in names:
+        query = dns.message.make_query(name, "A")
+        response = dns.message.make_response(query)
+        response.answer.append(dns.rrset.from_text(name + ".", 300, "IN", "A", "1.2.3.4"))
+        messages.append(response.to_wire())
+    ''''''
+    for i in range(2000): cache.put(messages[i], (names[i], 1, 1,))
+    if cache.get(names[0], 1, 1, 0) or not cache.get(names[-1], 1, 1, 0): raise SystemExit("wrong lru")
+    print(cache.get_stats())
+
+    n = 200000
+    t = time.time()
+    for i in range(n): cache.get(names[1000 + i % 1000], 1, 1, i & 0xffff)
+    print("%d cached lookups/s" % (n / (time.time() - t)))
+
+    t = time.time()
+    for i in range(n): cache.put(messages[i % 2000], (names[i % 2000], 1, 1,))
+    print("%d stores/s" % (n / (time.time() - t)))
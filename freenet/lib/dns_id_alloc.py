@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""DNS ID分配
+所有空闲的ID保存在数组中,分配时随机选择一个并与最后一个交换后弹出,回收时放到数组末尾,分配与回收都是O(1)
+随机的ID可以避免不同客户端的ID冲突,也使得上游DNS的响应更难被伪造
+每个ID都有超时时间,超时之后由recycle一次回收
+"""
+
+import array, random
+import pywind.lib.timer as timer
+
+
+class dns_id_alloc(object):
+    # 空闲的DNS ID
+    __free_ids = None
+    # {dns_id:value,...}
+    __values = None
+    __timer = None
+    # 最大的同时进行的请求个数
+    __max_inflight = 65536
+
+    def __init__(self, max_inflight=65536):
+        self.__free_ids = array.array("H", range(65536))
+        self.__values = {}
+        self.__timer = timer.timer()
+        self.set_max_inflight(max_inflight)
+
+    def set_max_inflight(self, n):
+        if n < 1 or n > 65536: raise ValueError("the max_inflight must be between 1 and 65536")
+        self.__max_inflight = n
+
+    def get(self, value, timeout):
+        """分配DNS ID
+        :param value: ID对应的值
+        :param timeout: 超时时间,单位为秒
+        :return int: 没有可用的ID时返回None
+        """
+        if len(self.__values) >= self.__max_inflight: return None
+
+        free_ids = self.__free_ids
+        i = random.randrange(len(free_ids))
+        dns_id = free_ids[i]
+        free_ids[i] = free_ids[-1]
+        free_ids.pop()
+
+        self.__values[dns_id] = value
+        self.__timer.set_timeout(dns_id, timeout)
+
+        return dns_id
+
+    def put(self, dns_id):
+        """回收DNS ID
+        :return: ID对应的值,ID没有被分配时返回None
+        """
+        value = self.__values.pop(dns_id, None)
+        if value is None: return None
+
+        self.__timer.drop(dns_id)
+        self.__free_ids.append(dns_id)
+
+        return value
+
+    def get_value(self, dns_id):
+        return self.__values.get(dns_id, None)
+
+    def recycle(self):
+        """回收所有超时的ID
+        :return list: 超时的ID对应的值
+        """
+        results = []
+        for dns_id in self.__timer.get_timeout_names():
+            value = self.put(dns_id)
+            if value is not None: results.append(value)
+        ''''''
+        return results
+
+    @property
+    def inflight(self):
+        return len(self.__values)
+
+
+if __name__ == "__main__":
+    # 压力测试,python3 -m freenet.lib.dns_id_alloc
+    import time
+
+    alloc = dns_id_alloc()
+
+    # 60000个同时进行的请求,一半正常响应,其余超时
+    t = time.time()
+    ids = [alloc.get(i, 0.5) for i in range(60000)]
+    cost = time.time() - t
+    if len(set(ids)) != 60000 or None in ids: raise SystemExit("duplicate dns id")
+    print("alloc 60000 ids: %.1f ms" % (cost * 1000))
+
+    t = time.time()
+    for i in range(0, 60000, 2):
+        if alloc.put(ids[i]) != i: raise SystemExit("wrong value")
+    print("put 30000 ids: %.1f ms" % ((time.time() - t) * 1000))
+    if alloc.put(ids[0]) is not None: raise SystemExit("the dns id has been released")
+
+    # 剩余的ID加上新分配的ID不能重复
+    new_ids = [alloc.get(i, 10) for i in range(35537)]
+    if new_ids[-1] is not None or None in new_ids[0:35536]: raise SystemExit("wrong capacity")
+    if len(set(ids[1::2]) | set(new_ids[0:35536])) != 65536: raise SystemExit("duplicate dns id")
+
+    time.sleep(0.6)
+    t = time.time()
+    expired = alloc.recycle()
+    print("recycle %d expired ids: %.1f ms" % (len(expired), (time.time() - t) * 1000))
+    if sorted(expired) != list(range(1, 60000, 2)) or alloc.inflight != 35536: raise SystemExit("wrong recycle")
+
+    alloc = dns_id_alloc(max_inflight=2000)
+    if None in [alloc.get(i, 10) for i in range(2000)] or alloc.get(0, 10) is not None:
+        raise SystemExit("wrong max_inflight")
+
+    # 持续的请求,每次分配之后回收最早的请求
+    alloc = dns_id_alloc()
+    inflight = [alloc.get(i, 10) for i in range(60000)]
+    n = 500000
+    t = time.time()
+    for i in range(n):
+        alloc.put(inflight[i % 60000])
+        inflight[i % 60000] = alloc.get(i, 10)
+    print("%d get/put per second with 60000 in-flight queries" % (n / (time.time() - t)))
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""上游DNS服务器的选择与健康状态
+支持两种策略:
+    race 同时向前两个可用的服务器发送请求,使用最快的响应
+    rtt  按照测量的响应时间加权随机选择一个服务器,响应越快被选中的概率越大
+响应时间按照RFC 6298的方法计算平滑值与偏差,重传超时时间为 srtt + 4 * rttvar
+连续超时达到一定次数的服务器被降级,降级期间只有在没有其他可用服务器时才使用,降级时间每次加倍
+"""
+
+import random, socket, time
+
+STRATEGY_RACE = "race"
+STRATEGY_RTT = "rtt"
+
+
+class upstreams(object):
+    # [(ip,port),...]
+    __servers = None
+    # {(ip,port):index,...}
+    __indexes = None
+    # 每个服务器的状态,格式为 {"sent":0,"answered":0,"timeouts":0,"srtt":None,"rttvar":0,"failures":0,...}
+    __states = None
+    __strategy = STRATEGY_RACE
+    __max_failures = 3
+
+    # 还没有测量到响应时间时的重传超时时间
+    __INIT_RTO = 1.0
+    __MIN_RTO = 0.2
+    __MAX_RTO = 2.0
+
+    # 降级时间,单位为秒
+    __MIN_DEMOTE_TIME = 30
+    __MAX_DEMOTE_TIME = 300
+
+    def __init__(self, servers, strategy=STRATEGY_RACE, max_failures=3):
+        """
+        :param servers: 服务器列表,每个服务器为地址或者(地址,端口),也可以只有一个地址
+        :param strategy: race或者rtt
+        :param max_failures: 连续超时多少次之后降级服务器
+        """
+        # 兼容只有一个服务器的配置
+        if isinstance(servers, str) or (isinstance(servers, tuple) and len(servers) == 2 and isinstance(servers[1], int)):
+            servers = [servers]
+        if strategy not in (STRATEGY_RACE, STRATEGY_RTT,): raise ValueError("the strategy must be race or rtt")
+        if not servers: raise ValueError("no dns server")
+
+        self.__servers = []
+        self.__indexes = {}
+        self.__states = []
+        self.__strategy = strategy
+        self.__max_failures = max_failures
+
+        for server in servers:
+            if isinstance(server, str): server = (server, 53,)
+            host, port = server
+            address = (socket.gethostbyname(host), int(port),)
+
+            self.__indexes[address] = len(self.__servers)
+            self.__servers.append(address)
+            self.__states.append({"sent": 0, "answered": 0, "timeouts": 0, "srtt": None, "rttvar": 0,
+                                  "failures": 0, "demotions": 0, "demoted_until": 0, })
+        ''''''
+
+    def __is_demoted(self, state, now):
+        return state["demoted_until"] > now
+
+    def __select_rtt(self, candidates):
+        weights = []
+        for i in candidates:
+            srtt = self.__states[i]["srtt"]
+            if srtt is None: srtt = self.__INIT_RTO / 4
+            weights.append(1 / max(srtt, 0.001))
+        ''''''
+        return random.choices(candidates, weights=weights)
+
+    def select(self, exclude=()):
+        """选择发送请求的服务器
+        :param exclude: 已经发送过请求的服务器序号,在有其他服务器时不选择
+        :return list: 服务器序号列表
+        """
+        now = time.monotonic()
+        candidates = [i for i in range(len(self.__servers)) if i not in exclude]
+        # 所有服务器都发送过的时候重新使用所有服务器
+        if not candidates: candidates = list(range(len(self.__servers)))
+
+        healthy = [i for i in candidates if not self.__is_demoted(self.__states[i], now)]
+        if healthy: candidates = healthy
+
+        if self.__strategy == STRATEGY_RACE: return candidates[0:2]
+
+        return self.__select_rtt(candidates)
+
+    def get_address(self, i):
+        return self.__servers[i]
+
+    def get_index(self, address):
+        """:return int: 服务器序号,不是上游服务器时返回None"""
+        return self.__indexes.get(address, None)
+
+    def on_send(self, i):
+        self.__states[i]["sent"] += 1
+
+    def on_answer(self, i, rtt=None):
+        """收到服务器的响应
+        :param rtt: 响应时间,单位为秒,为None时不测量响应时间
+        """
+        state = self.__states[i]
+        state["answered"] += 1
+        state["failures"] = 0
+        state["demoted_until"] = 0
+        state["demotions"] = 0
+
+        if rtt is None: return
+
+        if state["srtt"] is None:
+            state["srtt"] = rtt
+            state["rttvar"] = rtt / 2
+        else:
+            state["rttvar"] = 0.75 * state["rttvar"] + 0.25 * abs(state["srtt"] - rtt)
+            state["srtt"] = 0.875 * state["srtt"] + 0.125 * rtt
+        return
+
+    def on_timeout(self, i):
+        """服务器没有在重传超时时间内响应"""
+        state = self.__states[i]
+        state["timeouts"] += 1
+        state["failures"] += 1
+
+        if state["failures"] < self.__max_failures: return
+
+        # 降级之后重新计数,降级结束之后再次连续超时则降级时间加倍
+        demote_time = min(self.__MIN_DEMOTE_TIME << state["demotions"], self.__MAX_DEMOTE_TIME)
+        state["demoted_until"] = time.monotonic() + demote_time
+        state["demotions"] += 1
+        state["failures"] = 0
+
+    def get_rto(self, i):
+        """获取服务器的重传超时时间,单位为秒"""
+        state = self.__states[i]
+        if state["srtt"] is None: return self.__INIT_RTO
+
+        rto = state["srtt"] + 4 * state["rttvar"]
+
+        return min(max(rto, self.__MIN_RTO), self.__MAX_RTO)
+
+    def get_stats(self):
+        """获取每个服务器的统计信息"""
+        now = time.monotonic()
+        results = []
+        for i in range(len(self.__servers)):
+            state = self.__states[i]
+            srtt = state["srtt"]
+            results.append({
+                "server": "%s:%s" % self.__servers[i],
+                "sent": state["sent"],
+                "answered": state["answered"],
+                "timeouts": state["timeouts"],
+                "srtt_ms": None if srtt is None else round(srtt * 1000, 1),
+                "rto_ms": round(self.get_rto(i) * 1000, 1),
+                "demoted": self.__is_demoted(state, now),
+            })
+        ''''''
+        return results
+
+
+if __name__ == "__main__":
+    # 模拟测试,python3 -m freenet.lib.dns_upstream
+    ups = upstreams(["127.0.0.1", ("127.0.0.2", 5353,), "127.0.0.3"], strategy=STRATEGY_RACE)
+    if ups.select() != [0, 1] or ups.get_index(("127.0.0.2", 5353,)) != 1: raise SystemExit("wrong race selection")
+
+    # 第一个服务器连续超时之后被降级
+    for i in range(3): ups.on_timeout(0)
+    if ups.select() != [1, 2] or not ups.get_stats()[0]["demoted"]: raise SystemExit("the server should be demoted")
+    if ups.select(exclude=(1, 2,)) != [0]: raise SystemExit("the demoted server should be used as last resort")
+    ups.on_answer(0, 0.01)
+    if ups.select() != [0, 1]: raise SystemExit("the server should be promoted")
+
+    ups = upstreams(["127.0.0.1", "127.0.0.2"], strategy=STRATEGY_RTT)
+    for i in range(20):
+        ups.on_answer(0, 0.010)
+        ups.on_answer(1, 0.100)
+    counts = [0, 0]
+    for i in range(10000): counts[ups.select()[0]] += 1
+    print("rtt selection: %s" % counts)
+    if counts[0] < counts[1] * 5: raise SystemExit("the faster server should be selected more often")
+    if ups.select(exclude=(0,)) != [1]: raise SystemExit("wrong exclude")
+    print(ups.get_stats())
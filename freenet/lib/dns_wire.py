@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""DNS报文解析
+直接从报文中读取请求的问题以及响应中的A与AAAA记录,不创建完整的报文对象
+不能解析的报文使用dnspython解析,仍然失败时返回None
+"""
+
+import socket, struct
+
+try:
+    import dns.message
+except ImportError:
+    dns = None
+
+HEADER_SIZE = 12
+
+TYPE_A = 1
+TYPE_SOA = 6
+TYPE_AAAA = 28
+TYPE_OPT = 41
+CLASS_IN = 1
+
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+
+# 一个域名最多跟随的压缩指针个数,防止循环指针
+__MAX_POINTERS = 32
+
+_HEADER = struct.Struct("!HHHHHH")
+_QUESTION = struct.Struct("!HH")
+_RR = struct.Struct("!HHIH")
+
+
+class DnsWireErr(Exception): pass
+
+
+def set_id(message, dns_id):
+    """修改报文的DNS ID
+    :return bytes:
+    """
+    return b"".join((bytes(((dns_id & 0xff00) >> 8, dns_id & 0x00ff,)), message[2:],))
+
+
+def __read_name(message, pos):
+    """读取域名,支持压缩指针
+    :return tuple: (标签列表,域名之后的位置)
+    """
+    labels = []
+    end = -1
+    pointers = 0
+    size = len(message)
+
+    while 1:
+        n = message[pos]
+        if n & 0xc0 == 0xc0:
+            pointers += 1
+            if pointers > __MAX_POINTERS: raise DnsWireErr("too many compression pointers")
+            if end < 0: end = pos + 2
+            pos = ((n & 0x3f) << 8) | message[pos + 1]
+            continue
+        # 不支持扩展标签类型
+        if n & 0xc0: raise DnsWireErr("unsupported label type")
+
+        pos += 1
+        if n == 0: break
+        if pos + n > size: raise DnsWireErr("the label is too long")
+
+        labels.append(message[pos:pos + n])
+        pos += n
+
+    if end < 0: end = pos
+
+    return (labels, end,)
+
+
+def __parse_query(message):
+    if len(message) < HEADER_SIZE: raise DnsWireErr("the message is too short")
+
+    _, flags, qdcount, _, _, _ = _HEADER.unpack_from(message, 0)
+    opcode = (flags >> 11) & 0x0f
+
+    if qdcount < 1: return (opcode, qdcount, None, 0, 0,)
+
+    labels, pos = __read_name(message, HEADER_SIZE)
+    qtype, qclass = _QUESTION.unpack_from(message, pos)
+
+    return (opcode, qdcount, b".".join(labels).decode("iso-8859-1"), qtype, qclass,)
+
+
+def __parse_query_slow(message):
+    if not dns: return None
+
+    # dnspython在报文格式错误时可能抛出多种异常
+    try:
+        msg = dns.message.from_wire(message)
+    except Exception:
+        return None
+
+    if not msg.question: return (msg.opcode(), 0, None, 0, 0,)
+
+    q = msg.question[0]
+    qname = b".".join(q.name[0:-1]).decode("iso-8859-1")
+
+    return (msg.opcode(), len(msg.question), qname, q.rdtype, q.rdclass,)
+
+
+def parse_query(message):
+    """解析DNS请求
+    :return tuple: (opcode,qdcount,qname,qtype,qclass),没有问题时qname为None,报文格式错误时返回None
+    qname为不带最后一个点的域名
+    """
+    try:
+        return __parse_query(message)
+    except (DnsWireErr, IndexError, struct.error):
+        return __parse_query_slow(message)
+
+
+def __parse_response(message):
+    if len(message) < HEADER_SIZE: raise DnsWireErr("the message is too short")
+
+    _, _, qdcount, ancount, _, _ = _HEADER.unpack_from(message, 0)
+    pos = HEADER_SIZE
+    size = len(message)
+    ipv4s = []
+    ipv6s = []
+
+    for i in range(qdcount):
+        _, pos = __read_name(message, pos)
+        pos += 4
+
+    for i in range(ancount):
+        _, pos = __read_name(message, pos)
+        rtype, rclass, _, rdlength = _RR.unpack_from(message, pos)
+        pos += 10
+        if pos + rdlength > size: raise DnsWireErr("the rdata is too long")
+
+        if rtype == TYPE_A and rdlength == 4:
+            ipv4s.append(socket.inet_ntoa(message[pos:pos + 4]))
+        elif rtype == TYPE_AAAA and rdlength == 16:
+            ipv6s.append(socket.inet_ntop(socket.AF_INET6, message[pos:pos + 16]))
+        pos += rdlength
+
+    return (ipv4s, ipv6s,)
+
+
+def __parse_response_slow(message):
+    if not dns: return None
+
+    try:
+        msg = dns.message.from_wire(message)
+    except Exception:
+        return None
+
+    ipv4s = []
+    ipv6s = []
+
+    for rrset in msg.answer:
+        if rrset.rdtype == TYPE_A: ipv4s += [rdata.address for rdata in rrset]
+        if rrset.rdtype == TYPE_AAAA: ipv6s += [rdata.address for rdata in rrset]
+
+    return (ipv4s, ipv6s,)
+
+
+def parse_response(message):
+    """获取DNS响应中的A与AAAA记录
+    :return tuple: ([ipv4,...],[ipv6,...]),报文格式错误时返回None
+    """
+    try:
+        return __parse_response(message)
+    except (DnsWireErr, IndexError, struct.error):
+        return __parse_response_slow(message)
+
+
+def __parse_cache_info(message):
+    if len(message) < HEADER_SIZE: raise DnsWireErr("the message is too short")
+
+    _, flags, qdcount, ancount, nscount, arcount = _HEADER.unpack_from(message, 0)
+    if qdcount != 1: raise DnsWireErr("only support one question")
+
+    labels, pos = __read_name(message, HEADER_SIZE)
+    qtype, qclass = _QUESTION.unpack_from(message, pos)
+    pos += 4
+
+    size = len(message)
+    ttl = None
+    neg_ttl = None
+    ttl_offsets = []
+    ipv4s = []
+
+    for i in range(ancount + nscount + arcount):
+        _, pos = __read_name(message, pos)
+        rtype, rclass, rttl, rdlength = _RR.unpack_from(message, pos)
+        rdata = pos + 10
+        if rdata + rdlength > size: raise DnsWireErr("the rdata is too long")
+
+        # OPT记录的TTL字段为EDNS标志
+        if rtype != TYPE_OPT: ttl_offsets.append(pos + 4)
+
+        if i < ancount:
+            if ttl is None or rttl < ttl: ttl = rttl
+            if rtype == TYPE_A and rdlength == 4: ipv4s.append(socket.inet_ntoa(message[rdata:rdata + 4]))
+        elif i < ancount + nscount and rtype == TYPE_SOA:
+            # 否定响应的缓存时间为SOA记录的TTL与MINIMUM字段中较小的一个,见RFC 2308
+            _, soa = __read_name(message, rdata)
+            _, soa = __read_name(message, soa)
+            minimum, = struct.unpack_from("!I", message, soa + 16)
+            neg_ttl = min(rttl, minimum)
+
+        pos = rdata + rdlength
+
+    rcode = flags & 0x0f
+    tc = (flags >> 9) & 0x01
+
+    return (b".".join(labels).decode("iso-8859-1").lower(), qtype, qclass, rcode, tc, ttl, neg_ttl, ttl_offsets,
+            ipv4s,)
+
+
+def parse_cache_info(message):
+    """获取缓存DNS响应需要的信息
+    :return tuple: (qname,qtype,qclass,rcode,tc,ttl,neg_ttl,ttl_offsets,ipv4s),报文格式错误时返回None
+    qname为小写的域名,ttl为回答中最小的TTL,没有回答时为None
+    neg_ttl为授权部分中SOA记录决定的否定缓存时间,没有SOA记录时为None
+    ttl_offsets为所有资源记录(OPT记录除外)的TTL字段的位置
+    """
+    try:
+        return __parse_cache_info(message)
+    except (DnsWireErr, IndexError, struct.error):
+        return None
+
+
+if __name__ == "__main__":
+    # 与dnspython的比较,python3 -m freenet.lib.dns_wire
+    import random, string, time
+    import dns.rrset
+    import freenet.lib.host_match as host_match
+
+
+    def rand_name():
+        labels = ["".join(random.choice(string.ascii_lowercase) for i in range(random.randint(3, 10)))
+                  for j in range(random.randint(2, 4))]
+        return ".".join(labels)
+
+
+    names = [rand_name() for i in range(2000)]
+    queries = []
+    responses = []
+
+    for name in names:
+        query = dns.message.make_query(name, random.choice(("A", "AAAA",)))
+        queries.append(query.to_wire())
+
+        # 带有CNAME的响应,使用压缩指针
+        response = dns.message.make_response(query)
+        response.answer.append(dns.rrset.from_text(name + ".", 300, "IN", "CNAME", "cdn." + name + "."))
+        response.answer.append(dns.rrset.from_text("cdn." + name + ".", 300, "IN", "A", "1.2.3.4", "5.6.7.8"))
+        response.answer.append(dns.rrset.from_text("cdn." + name + ".", 300, "IN", "AAAA", "::1"))
+        responses.append(response.to_wire())
+    ''''''
+
+    for i in range(len(names)):
+        if __parse_query(queries[i])[0:3] != (0, 1, names[i],): raise SystemExit("wrong query parse result")
+        # rrset中的记录没有固定的顺序
+        ipv4s, ipv6s = __parse_response(responses[i])
+        if sorted(ipv4s) != ["1.2.3.4", "5.6.7.8"] or ipv6s != ["::1"]: raise SystemExit("wrong response parse result")
+        if __parse_query_slow(queries[i]) != __parse_query(queries[i]): raise SystemExit("not same as dnspython")
+        if __parse_response_slow(responses[i]) != __parse_response(responses[i]): raise SystemExit(
+            "not same as dnspython")
+    ''''''
+
+    # 循环指针与截断的报文
+    loop = queries[0][0:HEADER_SIZE] + b"\xc0\x0c"
+    if parse_query(loop) is not None or parse_query(queries[0][0:20]) is not None: raise SystemExit(
+        "malformed message should return None")
+    if parse_response(responses[0][0:-3]) is not None: raise SystemExit("malformed message should return None")
+
+    # 代理处理请求时需要解析问题并匹配规则,处理响应时需要获取A记录
+    match = host_match.host_match()
+    for name in names[0:1000]: match.add_rule(("*." + name.split(".", 1)[1], 1,))
+
+
+    def old_query(message):
+        msg = dns.message.from_wire(message)
+        q = msg.question[0]
+        return match.match(b".".join(q.name[0:-1]).decode("iso-8859-1"))
+
+
+    def old_response(message):
+        msg = dns.message.from_wire(message)
+        ips = []
+        for rrset in msg.answer:
+            for cname in rrset:
+                ip = cname.__str__()
+                if len(ip.split(".")) == 4: ips.append(ip)
+            ''''''
+        return ips
+
+
+    def new_query(message):
+        return match.match(parse_query(message)[2])
+
+
+    def new_response(message):
+        return parse_response(message)[0]
+
+
+    n = 5
+    for name, query_func, response_func in (("dnspython", old_query, old_response,),
+                                            ("dns_wire", new_query, new_response,)):
+        t = time.time()
+        for i in range(n):
+            for query in queries: query_func(query)
+        query_rate = n * len(queries) / (time.time() - t)
+
+        t = time.time()
+        for i in range(n):
+            for response in responses: response_func(response)
+        response_rate = n * len(responses) / (time.time() - t)
+
+        print("%-9s queries: %6d/s, responses: %6d/s" % (name, query_rate, response_rate,))
+    ''''''
@@ -1,3 +1,5 @@
+#define _GNU_SOURCE
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
 #include <fcntl.h>
 #include <sys/socket.h>
@@ -14,6 +16,9 @@
 
 #define TUN_DEV_NAME "fdslight"
 
+/* recvmmsg与sendmmsg一次最多处理的数据包个数 */
+#define MMSG_MAX_NUM 1024
+
 /* 增量式校检和 */
 static unsigned short csum_incremental_update_modified(unsigned short old_csum,
                 unsigned short old_field,
@@ -199,7 +204,8 @@ tuntap_interface_up(PyObject *self, PyObject *args)
 
 	ret = interface_up(interface);
 
-	return ret < 0 ? Py_False : Py_True;
+	if (ret < 0) Py_RETURN_FALSE;
+	Py_RETURN_TRUE;
 }
 
 static PyObject *
@@ -212,7 +218,8 @@ tuntap_set_ipaddr(PyObject *self, PyObject *args)
 		return NULL;
 
 	ret = set_ipaddr(interface_name, ip);
-	return ret < 0 ? Py_False : Py_True;
+	if (ret < 0) Py_RETURN_FALSE;
+	Py_RETURN_TRUE;
 }
 
 static PyObject *
@@ -225,7 +232,7 @@ tuntap_delete(PyObject *self, PyObject *args)
 
 	close(fd);
 
-	return Py_None;
+	Py_RETURN_NONE;
 }
 
 
@@ -245,14 +252,130 @@ calc_incre_csum(PyObject *self,PyObject *args)
 static PyObject *
 calc_csum(PyObject *self,PyObject *args)
 {
-    const char *sts;
+    Py_buffer view;
     int size=0;
     unsigned short int csum;
-    if(!PyArg_ParseTuple(args,"y#i",&sts,&size)) return NULL;
+    if(!PyArg_ParseTuple(args,"y*i",&view,&size)) return NULL;
+
+    /* 不能超出缓冲区 */
+    if(size<0 || size>view.len) size=(int)view.len;
+
+    csum=calc_checksum((unsigned short *)view.buf,size);
+    PyBuffer_Release(&view);
+
+    /* 按照本机字节序累加,需要转换为网络字节序的值 */
+    return PyLong_FromLong(ntohs(csum));
+}
+
+/* 累加16位字段的变化量,用于增量式校检和,见RFC1624 */
+static unsigned long
+csum_diff16(unsigned long sum, const unsigned char *old_field, const unsigned char *new_field)
+{
+    sum += (~((old_field[0] << 8) | old_field[1])) & 0xffff;
+    sum += (new_field[0] << 8) | new_field[1];
+
+    return sum;
+}
+
+/* 使用累加的变化量更新校检和,并把结果写入到p中 */
+static void
+csum_update(unsigned char *p, unsigned long sum, int is_udp)
+{
+    unsigned short csum = (p[0] << 8) | p[1];
+
+    sum += (~csum) & 0xffff;
+    while (sum >> 16) sum = (sum & 0xffff) + (sum >> 16);
+    csum = (~sum) & 0xffff;
 
-    csum=calc_checksum((unsigned short *)sts,size);
+    /* UDP校检和为0表示不计算校检和,因此计算结果为0时使用0xffff */
+    if (is_udp && csum == 0) csum = 0xffff;
 
-    return PyLong_FromLong(csum);
+    p[0] = (csum & 0xff00) >> 8;
+    p[1] = csum & 0x00ff;
+}
+
+/**
+ * 直接在bytearray中修改IPv4数据包的地址,同时修正IP以及TCP/UDP校检和
+ * 参数为 (ip_packet,new_addr,flags[,new_port])
+ * flags为0表示修改源地址与源端口,为1表示修改目的地址与目的端口,new_port小于0表示不修改端口
+ * 端口只对TCP与UDP的第一个分片有效,UDP校检和为0时保持为0
+ */
+static PyObject *
+modify_ip4_address(PyObject *self, PyObject *args)
+{
+    Py_buffer pkt, addr;
+    int flags, new_port = -1;
+    int ihl, protocol, frag_off, addr_pos, port_pos, csum_pos;
+    unsigned char *p, port[2];
+    unsigned long sum = 0, l4_sum;
+
+    if (!PyArg_ParseTuple(args, "w*y*i|i", &pkt, &addr, &flags, &new_port)) return NULL;
+
+    p = pkt.buf;
+
+    if (addr.len != 4) {
+        PyErr_SetString(PyExc_ValueError, "the size of address must be 4");
+        goto error;
+    }
+
+    if (new_port > 0xffff) {
+        PyErr_SetString(PyExc_ValueError, "wrong port value");
+        goto error;
+    }
+
+    if (pkt.len < 20 || (p[0] & 0xf0) != 0x40) {
+        PyErr_SetString(PyExc_ValueError, "wrong ipv4 packet");
+        goto error;
+    }
+
+    ihl = (p[0] & 0x0f) * 4;
+    if (ihl < 20 || ihl > pkt.len) {
+        PyErr_SetString(PyExc_ValueError, "wrong ipv4 header length");
+        goto error;
+    }
+
+    addr_pos = flags ? 16 : 12;
+    port_pos = flags ? ihl + 2 : ihl;
+
+    sum = csum_diff16(sum, p + addr_pos, addr.buf);
+    sum = csum_diff16(sum, p + addr_pos + 2, (unsigned char *)addr.buf + 2);
+
+    csum_update(p + 10, sum, 0);
+
+    protocol = p[9];
+    frag_off = ((p[6] & 0x1f) << 8) | p[7];
+
+    /* 只有第一个分片才有TCP或者UDP头部 */
+    if (frag_off == 0 && (protocol == 6 || protocol == 17)) {
+        csum_pos = protocol == 6 ? ihl + 16 : ihl + 6;
+
+        if (csum_pos + 2 <= pkt.len) {
+            l4_sum = sum;
+
+            if (new_port >= 0) {
+                port[0] = (new_port & 0xff00) >> 8;
+                port[1] = new_port & 0x00ff;
+                l4_sum = csum_diff16(l4_sum, p + port_pos, port);
+                memcpy(p + port_pos, port, 2);
+            }
+
+            /* TCP与UDP的伪头部包含IP地址,UDP校检和为0时不需要计算 */
+            if (protocol == 6 || p[csum_pos] || p[csum_pos + 1]) csum_update(p + csum_pos, l4_sum, protocol == 17);
+        }
+    }
+
+    memcpy(p + addr_pos, addr.buf, 4);
+
+    PyBuffer_Release(&pkt);
+    PyBuffer_Release(&addr);
+
+    Py_RETURN_NONE;
+
+error:
+    PyBuffer_Release(&pkt);
+    PyBuffer_Release(&addr);
+
+    return NULL;
 }
 
 static PyObject *
@@ -263,11 +386,268 @@ get_netcard_ip(PyObject *self,PyObject *args)
     int err;
     if (!PyArg_ParseTuple(args, "s", &eth_name)) return NULL;
     err=get_nc_ip(eth_name,eth_ip);
-    if(err) return Py_None;
+    if(err) Py_RETURN_NONE;
 
     return Py_BuildValue("s",eth_ip);
 }
 
+/* 把python的地址元组转换为sockaddr,只支持数字形式的IP地址 */
+static int
+build_sockaddr(PyObject *address, struct sockaddr_storage *addr, socklen_t *addrlen)
+{
+    const char *host;
+    int port;
+    unsigned int flowinfo = 0, scope_id = 0;
+    struct sockaddr_in *addr4 = (struct sockaddr_in *)addr;
+    struct sockaddr_in6 *addr6 = (struct sockaddr_in6 *)addr;
+
+    if (!PyTuple_Check(address)) {
+        PyErr_SetString(PyExc_TypeError, "the address must be a tuple");
+        return -1;
+    }
+
+    if (!PyArg_ParseTuple(address, "si|II", &host, &port, &flowinfo, &scope_id)) return -1;
+
+    memset(addr, 0, sizeof(struct sockaddr_storage));
+
+    if (inet_pton(AF_INET, host, &addr4->sin_addr) == 1) {
+        addr4->sin_family = AF_INET;
+        addr4->sin_port = htons(port);
+        *addrlen = sizeof(struct sockaddr_in);
+        return 0;
+    }
+
+    if (inet_pton(AF_INET6, host, &addr6->sin6_addr) == 1) {
+        addr6->sin6_family = AF_INET6;
+        addr6->sin6_port = htons(port);
+        addr6->sin6_flowinfo = htonl(flowinfo);
+        addr6->sin6_scope_id = scope_id;
+        *addrlen = sizeof(struct sockaddr_in6);
+        return 0;
+    }
+
+    PyErr_SetString(PyExc_ValueError, "the host must be a numeric ip address");
+    return -1;
+}
+
+/* 把sockaddr转换为与socket.recvfrom相同格式的地址元组 */
+static PyObject *
+build_address(struct sockaddr_storage *addr, socklen_t addrlen)
+{
+    char host[INET6_ADDRSTRLEN];
+    struct sockaddr_in *addr4 = (struct sockaddr_in *)addr;
+    struct sockaddr_in6 *addr6 = (struct sockaddr_in6 *)addr;
+
+    if (addrlen == 0) Py_RETURN_NONE;
+
+    if (addr->ss_family == AF_INET) {
+        inet_ntop(AF_INET, &addr4->sin_addr, host, sizeof(host));
+        return Py_BuildValue("(si)", host, ntohs(addr4->sin_port));
+    }
+
+    if (addr->ss_family == AF_INET6) {
+        inet_ntop(AF_INET6, &addr6->sin6_addr, host, sizeof(host));
+        return Py_BuildValue("(siII)", host, ntohs(addr6->sin6_port),
+                             ntohl(addr6->sin6_flowinfo), addr6->sin6_scope_id);
+    }
+
+    Py_RETURN_NONE;
+}
+
+/* udp_recvmmsg使用的预分配缓冲区,只有在需要更大空间时才重新分配 */
+static struct mmsghdr *mmsg_recv_msgs = NULL;
+static struct iovec *mmsg_recv_iovecs = NULL;
+static struct sockaddr_storage *mmsg_recv_addrs = NULL;
+static char *mmsg_recv_bufs = NULL;
+static int mmsg_recv_count = 0;
+static int mmsg_recv_bufsize = 0;
+
+static int
+mmsg_recv_reserve(int count, int bufsize)
+{
+    struct mmsghdr *msgs;
+    struct iovec *iovecs;
+    struct sockaddr_storage *addrs;
+    char *bufs;
+
+    if (count <= mmsg_recv_count && bufsize <= mmsg_recv_bufsize) return 0;
+
+    if (count < mmsg_recv_count) count = mmsg_recv_count;
+    if (bufsize < mmsg_recv_bufsize) bufsize = mmsg_recv_bufsize;
+
+    msgs = PyMem_Realloc(mmsg_recv_msgs, sizeof(struct mmsghdr) * count);
+    if (NULL == msgs) return -1;
+    mmsg_recv_msgs = msgs;
+
+    iovecs = PyMem_Realloc(mmsg_recv_iovecs, sizeof(struct iovec) * count);
+    if (NULL == iovecs) return -1;
+    mmsg_recv_iovecs = iovecs;
+
+    addrs = PyMem_Realloc(mmsg_recv_addrs, sizeof(struct sockaddr_storage) * count);
+    if (NULL == addrs) return -1;
+    mmsg_recv_addrs = addrs;
+
+    bufs = PyMem_Realloc(mmsg_recv_bufs, (size_t)count * bufsize);
+    if (NULL == bufs) return -1;
+    mmsg_recv_bufs = bufs;
+
+    mmsg_recv_count = count;
+    mmsg_recv_bufsize = bufsize;
+
+    return 0;
+}
+
+/**
+ * 一次系统调用读取多个UDP数据包
+ * 参数为 (fd,count,bufsize),返回 [(message,address),...],没有数据时返回空列表
+ * 使用MSG_DONTWAIT不会阻塞,因此不释放GIL,可以安全地共用预分配缓冲区
+ */
+static PyObject *
+udp_recvmmsg(PyObject *self, PyObject *args)
+{
+    int fd, count, bufsize, n, i;
+    struct mmsghdr *msgs;
+    PyObject *results, *message, *address, *item;
+
+    if (!PyArg_ParseTuple(args, "iii", &fd, &count, &bufsize)) return NULL;
+
+    if (count < 1 || count > MMSG_MAX_NUM || bufsize < 1 || bufsize > 65536) {
+        PyErr_SetString(PyExc_ValueError, "wrong count or bufsize value");
+        return NULL;
+    }
+
+    if (mmsg_recv_reserve(count, bufsize) < 0) return PyErr_NoMemory();
+
+    msgs = mmsg_recv_msgs;
+    memset(msgs, 0, sizeof(struct mmsghdr) * count);
+
+    for (i = 0; i < count; i++) {
+        mmsg_recv_iovecs[i].iov_base = mmsg_recv_bufs + (size_t)i * bufsize;
+        mmsg_recv_iovecs[i].iov_len = bufsize;
+        msgs[i].msg_hdr.msg_iov = &mmsg_recv_iovecs[i];
+        msgs[i].msg_hdr.msg_iovlen = 1;
+        msgs[i].msg_hdr.msg_name = &mmsg_recv_addrs[i];
+        msgs[i].msg_hdr.msg_namelen = sizeof(struct sockaddr_storage);
+    }
+
+    n = recvmmsg(fd, msgs, count, MSG_DONTWAIT, NULL);
+
+    if (n < 0) {
+        if (errno == EAGAIN || errno == EWOULDBLOCK) return PyList_New(0);
+        return PyErr_SetFromErrno(PyExc_OSError);
+    }
+
+    results = PyList_New(n);
+    if (NULL == results) return NULL;
+
+    for (i = 0; i < n; i++) {
+        message = PyBytes_FromStringAndSize(mmsg_recv_iovecs[i].iov_base, msgs[i].msg_len);
+        address = build_address(&mmsg_recv_addrs[i], msgs[i].msg_hdr.msg_namelen);
+
+        if (NULL == message || NULL == address) {
+            Py_XDECREF(message);
+            Py_XDECREF(address);
+            Py_DECREF(results);
+            return NULL;
+        }
+
+        item = PyTuple_Pack(2, message, address);
+        Py_DECREF(message);
+        Py_DECREF(address);
+
+        if (NULL == item) {
+            Py_DECREF(results);
+            return NULL;
+        }
+        PyList_SET_ITEM(results, i, item);
+    }
+
+    return results;
+}
+
+/**
+ * 一次系统调用发送多个UDP数据包
+ * 参数为 (fd,[(message,address),...]),address为None表示使用已连接的地址
+ * 返回发送成功的数据包个数,缓冲区满时返回0
+ */
+static PyObject *
+udp_sendmmsg(PyObject *self, PyObject *args)
+{
+    int fd, n = -1, i, count, nviews = 0;
+    PyObject *seq, *fast, *item, *address;
+    struct mmsghdr *msgs = NULL;
+    struct iovec *iovecs = NULL;
+    struct sockaddr_storage *addrs = NULL;
+    Py_buffer *views = NULL;
+
+    if (!PyArg_ParseTuple(args, "iO", &fd, &seq)) return NULL;
+
+    fast = PySequence_Fast(seq, "the messages must be a sequence");
+    if (NULL == fast) return NULL;
+
+    count = (int)(PySequence_Fast_GET_SIZE(fast) > MMSG_MAX_NUM ? MMSG_MAX_NUM : PySequence_Fast_GET_SIZE(fast));
+
+    if (count == 0) {
+        Py_DECREF(fast);
+        return PyLong_FromLong(0);
+    }
+
+    msgs = PyMem_Calloc(count, sizeof(struct mmsghdr));
+    iovecs = PyMem_Calloc(count, sizeof(struct iovec));
+    addrs = PyMem_Calloc(count, sizeof(struct sockaddr_storage));
+    views = PyMem_Calloc(count, sizeof(Py_buffer));
+
+    if (NULL == msgs || NULL == iovecs || NULL == addrs || NULL == views) {
+        PyErr_NoMemory();
+        goto done;
+    }
+
+    for (i = 0; i < count; i++) {
+        item = PySequence_Fast_GET_ITEM(fast, i);
+
+        if (!PyTuple_Check(item) || PyTuple_GET_SIZE(item) != 2) {
+            PyErr_SetString(PyExc_TypeError, "the message must be a tuple of (data,address)");
+            goto done;
+        }
+
+        if (PyObject_GetBuffer(PyTuple_GET_ITEM(item, 0), &views[i], PyBUF_SIMPLE) < 0) goto done;
+        nviews++;
+
+        iovecs[i].iov_base = views[i].buf;
+        iovecs[i].iov_len = views[i].len;
+        msgs[i].msg_hdr.msg_iov = &iovecs[i];
+        msgs[i].msg_hdr.msg_iovlen = 1;
+
+        address = PyTuple_GET_ITEM(item, 1);
+        if (address == Py_None) continue;
+
+        if (build_sockaddr(address, &addrs[i], &msgs[i].msg_hdr.msg_namelen) < 0) goto done;
+        msgs[i].msg_hdr.msg_name = &addrs[i];
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    n = sendmmsg(fd, msgs, count, MSG_DONTWAIT);
+    Py_END_ALLOW_THREADS
+
+    if (n < 0) {
+        if (errno == EAGAIN || errno == EWOULDBLOCK) n = 0;
+        else PyErr_SetFromErrno(PyExc_OSError);
+    }
+
+done:
+    for (i = 0; i < nviews; i++) PyBuffer_Release(&views[i]);
+
+    PyMem_Free(msgs);
+    PyMem_Free(iovecs);
+    PyMem_Free(addrs);
+    PyMem_Free(views);
+    Py_DECREF(fast);
+
+    if (PyErr_Occurred()) return NULL;
+
+    return PyLong_FromLong(n);
+}
+
 static PyMethodDef UtilsMethods[] = {
 	{"tuntap_create",tuntap_create,METH_VARARGS,"create tuntap device"},
 	{"interface_up",tuntap_interface_up,METH_VARARGS,"interface up tuntap "},
@@ -275,7 +655,10 @@ static PyMethodDef UtilsMethods[] = {
 	{"tuntap_delete",tuntap_delete,METH_VARARGS,"delete tuntap device ,it equals close"},
 	{"calc_incre_csum",calc_incre_csum,METH_VARARGS,"calculate incremental checksum"},
 	{"calc_csum",calc_csum,METH_VARARGS,"calculate checksum"},
+	{"modify_ip4_address",modify_ip4_address,METH_VARARGS,"modify ipv4 packet address in place and fix checksum"},
 	{"get_nc_ip",get_netcard_ip,METH_VARARGS,"get netcard ip address"},
+	{"udp_recvmmsg",udp_recvmmsg,METH_VARARGS,"receive multiple udp messages with one system call"},
+	{"udp_sendmmsg",udp_sendmmsg,METH_VARARGS,"send multiple udp messages with one system call"},
 	{NULL,NULL,0,NULL}
 };
 
@@ -297,6 +680,7 @@ PyInit_fn_utils(void)
 		"IFF_TUN",
 		"IFF_TAP",
 		"IFF_NO_PI",
+		"IFF_MULTI_QUEUE",
 
 		"TUN_PI_SIZE",
 		"TUN_PI_FLAGS_SIZE",
@@ -307,6 +691,7 @@ PyInit_fn_utils(void)
 		IFF_TUN,
 		IFF_TAP,
 		IFF_NO_PI,
+		IFF_MULTI_QUEUE,
 
 		sizeof(struct tun_pi),
 		sizeof(__u16),
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""域名规则匹配
+规则格式为 (host,flags),host的格式如下:
+    example.com   匹配example.com以及它的所有子域名
+    *.example.com 与example.com相同
+    =example.com  只匹配example.com
+    *             匹配所有域名
+规则分别保存在精确匹配与后缀匹配两个字典中,匹配时先查找精确规则,再从最长的后缀开始逐个标签查找后缀规则
+因此精确规则优先于后缀规则,更长的后缀规则优先于更短的后缀规则
+"""
+
+import functools, threading, traceback
+import freenet.lib.file_parser as file_parser
+
+
+class host_match(object):
+    # 精确匹配的规则 {host:flags,...}
+    __exact = None
+    # 后缀规则 {suffix:flags,...},规则"*"的后缀为""
+    __wildcard = None
+    # 带有LRU缓存的__match
+    __cached_match = None
+
+    def __init__(self, cache_size=4096):
+        """
+        :param cache_size: 缓存最近查询结果的个数
+        """
+        self.__exact = {}
+        self.__wildcard = {}
+        self.__cached_match = functools.lru_cache(maxsize=cache_size)(self.__match)
+
+    def add_rule(self, host_rule):
+        host, flags = host_rule
+        host = host.strip().lower().rstrip(".")
+
+        if host == "*":
+            self.__wildcard[""] = flags
+            self.__cached_match.cache_clear()
+            return
+
+        exact = host[0:1] == "="
+        if exact: host = host[1:]
+        elif host[0:2] == "*.": host = host[2:]
+
+        # 不支持其他位置的通配符
+        if "*" in host or not host: return
+
+        if exact:
+            self.__exact[host] = flags
+        else:
+            self.__wildcard[host] = flags
+
+        self.__cached_match.cache_clear()
+
+    def __match(self, host):
+        host = host.lower().rstrip(".")
+
+        flags = self.__exact.get(host, None)
+        if flags is not None: return (True, flags,)
+
+        wildcard = self.__wildcard
+        if not wildcard: return (False, 0,)
+
+        suffix = host
+        while suffix:
+            flags = wildcard.get(suffix, None)
+            if flags is not None: return (True, flags,)
+            pos = suffix.find(".")
+            if pos < 0: break
+            suffix = suffix[pos + 1:]
+        ''''''
+        flags = wildcard.get("", None)
+        if flags is not None: return (True, flags,)
+
+        return (False, 0,)
+
+    def match(self, host):
+        """
+        :return tuple: (is_match,flags)
+        """
+        return self.__cached_match(host)
+
+    def clear(self):
+        self.__exact = {}
+        self.__wildcard = {}
+        self.__cached_match.cache_clear()
+
+    @property
+    def rules_count(self):
+        return len(self.__exact) + len(self.__wildcard)
+
+
+class rules_reloader(object):
+    """在后台线程中重新加载规则文件,避免规则很多时阻塞事件循环
+    加载期间再次请求加载时,当前加载完成之后再加载一次
+    """
+    __fpath = None
+    __update_func = None
+    # 正在运行的加载线程,线程退出之前在锁内设置为None
+    __thread = None
+    __pending = False
+    # reload可能在信号处理函数中嵌套调用,因此使用可重入锁
+    __lock = None
+
+    def __init__(self, fpath, update_func):
+        """
+        :param fpath: 规则文件路径
+        :param update_func: 在后台线程中调用,参数为解析之后的规则列表,需要先构建新的规则再替换旧的规则
+        """
+        self.__fpath = fpath
+        self.__update_func = update_func
+        self.__lock = threading.RLock()
+
+    def __run(self):
+        while 1:
+            # 检查与退出在同一个锁内完成,不会丢失加载期间的请求
+            with self.__lock:
+                if not self.__pending:
+                    self.__thread = None
+                    return
+                self.__pending = False
+            try:
+                self.__update_func(file_parser.parse_host_file(self.__fpath))
+            except Exception:
+                traceback.print_exc()
+            ''''''
+
+    def reload(self):
+        """请求重新加载,可以在信号处理函数中调用"""
+        with self.__lock:
+            self.__pending = True
+            if self.__thread: return
+
+            self.__thread = threading.Thread(target=self.__run, daemon=True)
+            self.__thread.start()
+
+
+if __name__ == "__main__":
+    # 性能测试,python3 -m freenet.lib.host_match
+    import os, random, string, time, tracemalloc
+
+    m = host_match()
+    for rule in (("*.google.com", 1,), ("=mail.google.com", 0,), ("*.mail.google.com", 2,), ("a.example.com", 1,),
+                 ("=b.example.com", 0,), ("example.org", 1,),):
+        m.add_rule(rule)
+    ''''''
+    for host, rs in (("google.com", (True, 1,),), ("www.google.com", (True, 1,),), ("mail.google.com", (True, 0,),),
+                     ("x.mail.google.com", (True, 2,),), ("a.example.com", (True, 1,),),
+                     ("b.example.com", (True, 0,),), ("c.example.com", (False, 0,),), ("WWW.Google.COM.", (True, 1,),),
+                     ("oogle.com", (False, 0,),), ("www.a.example.com", (True, 1,),),
+                     ("www.b.example.com", (False, 0,),), ("www.example.org", (True, 1,),)):
+        if m.match(host) != rs: raise SystemExit("wrong match result for %s" % host)
+    ''''''
+    m.add_rule(("*", 3,))
+    if m.match("c.example.com") != (True, 3,): raise SystemExit("wrong match result for *")
+
+    # 在加载线程退出的同时请求加载,最后一次请求之后必须还有一次加载
+    import tempfile
+
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f: f.write("example.com:1\n")
+    requests = [0]
+    loaded = [0]
+
+
+    def update_rules(rules):
+        loaded[0] = requests[0]
+
+
+    reloader = rules_reloader(f.name, update_rules)
+    for i in range(2000):
+        requests[0] += 1
+        reloader.reload()
+        time.sleep(random.random() / 10000)
+        for j in range(1000):
+            if loaded[0] == requests[0]: break
+            time.sleep(0.001)
+        if loaded[0] != requests[0]: raise SystemExit("the reload request was lost")
+    ''''''
+    os.remove(f.name)
+
+    tlds = ("com", "net", "org", "cn", "io", "co.uk", "com.hk",)
+
+
+    def rand_name():
+        return "".join(random.choice(string.ascii_lowercase) for i in range(random.randint(4, 12)))
+
+
+    for n in (10000, 100000, 1000000,):
+        rules = []
+        for i in range(n):
+            domain = "%s.%s" % (rand_name(), random.choice(tlds),)
+            rules.append(("*.%s" % domain if i % 4 else "=" + domain, 1,))
+        ''''''
+        # 一半的查询是规则中域名的子域名,一半不匹配
+        queries = []
+        for i in range(100000):
+            domain = random.choice(rules)[0].replace("*.", "").lstrip("=")
+            if i % 2: domain = "%s.%s" % (rand_name(), random.choice(tlds),)
+            queries.append("www.%s" % domain if i % 3 else domain)
+        ''''''
+
+        tracemalloc.start()
+        t = time.time()
+        m = host_match()
+        for rule in rules: m.add_rule(rule)
+        build_cost = time.time() - t
+        mem = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        m = host_match()
+        for rule in rules: m.add_rule(rule)
+
+        # 不同的域名,缓存不命中
+        t = time.time()
+        for host in queries: m.match(host)
+        miss_rate = len(queries) / (time.time() - t)
+
+        # 重复查询少量的热门域名
+        hot = queries[0:1000]
+        t = time.time()
+        for i in range(100): [m.match(host) for host in hot]
+        hit_rate = len(hot) * 100 / (time.time() - t)
+
+        print("%7d rules: build %.2fs, memory %.1f MB, uncached %d lookups/s, cached %d lookups/s" % (
+            n, build_cost, mem / 1024 / 1024, miss_rate, hit_rate,))
+    ''''''
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 """
 分配与释放IP地址
+先按顺序分配从未使用过的地址,回收的地址放在有序字典中,分配与回收都是O(1)
+sticky模式下记住每个客户端上次使用的地址,只要这个地址还没有被其他客户端使用,客户端重新连接之后仍然分配这个地址
 """
 
-import socket
+import socket, collections
 
 
 class IpaddrNoEnoughErr(Exception):
@@ -12,68 +14,203 @@ class IpaddrNoEnoughErr(Exception):
     pass
 
 
-class ip4addr(object):
-    __base_ipaddr = 0
-    __mask = 0
+class _ipaddr_base(object):
+    __family = socket.AF_INET
+    __addr_size = 4
+    # 第一个与最后一个可以分配的地址
+    __first_ipaddr = 0
+    __last_ipaddr = 0
+    # 下一个从未分配过的地址
+    __next_ipaddr = 0
+    # 已经分配的地址
+    __used_ips = None
+    # 回收的地址,按照回收的先后顺序排列
     __recycle_ips = None
-    # 当前最大IP地址
-    __current_max_ipaddr = 0
 
-    def __init__(self, ipaddr, mask_size):
+    __sticky = False
+    # 客户端到上次分配的地址的映射
+    __key2addr = None
+    __addr2key = None
+
+    # 回收的地址超过这个个数才重新使用,避免地址马上分配给其他客户端
+    __RECYCLE_DELAY = 20
+
+    def __init__(self, family, ipaddr, prefix, sticky=False):
         """
-        :param ipaddr:192.168.1.0
-        :param mask:25
-        :return:
+        :param family: socket.AF_INET或者socket.AF_INET6
+        :param ipaddr: 网络地址,主机位不为0时自动清零
+        :param prefix: 前缀长度
+        :param sticky: 是否尽可能给同一个客户端分配相同的地址
         """
-        self.__recycle_ips = []
+        self.__family = family
+        self.__addr_size = 4 if family == socket.AF_INET else 16
 
-        if mask_size < 1:
-            raise ValueError("the mask_size must be number and the value must be more than 0")
+        bits = self.__addr_size * 8
+        host_bits = bits - prefix
 
-        if mask_size > 31:
-            raise ValueError("the mask_size must be number and the value must be less than 32")
+        network = int.from_bytes(socket.inet_pton(family, ipaddr), "big")
+        network = network >> host_bits << host_bits
 
-        for i in range(mask_size):
-            n = 32 - i
-            self.__mask |= 1 << n
+        # 不分配网络地址,IPv4也不分配广播地址
+        self.__first_ipaddr = network + 1
+        self.__last_ipaddr = network + (1 << host_bits) - 1
+        if family == socket.AF_INET: self.__last_ipaddr -= 1
 
-        self.__base_ipaddr = self.__get_int_ipaddr_from_sIpaddr(ipaddr)
+        # 点对点链路没有网络地址与广播地址,两个地址都可以分配,见RFC 3021与RFC 6164
+        if host_bits == 1:
+            self.__first_ipaddr = network
+            self.__last_ipaddr = network + 1
 
-        return
+        self.__next_ipaddr = self.__first_ipaddr
+        self.__used_ips = set()
+        self.__recycle_ips = collections.OrderedDict()
 
-    def __get_int_ipaddr_from_sIpaddr(self, ipaddr):
-        nbytes = socket.inet_aton(ipaddr)
+        self.__sticky = sticky
+        self.__key2addr = {}
+        self.__addr2key = {}
 
-        return (nbytes[0] << 24) | (nbytes[1] << 16) | (nbytes[2] << 8) | nbytes[3]
+    def __to_bytes(self, n):
+        return n.to_bytes(self.__addr_size, "big")
 
-    def get_addr(self):
-        """获取IP地址
-        :param addr:
-        :return:
-        """
-        if len(self.__recycle_ips) > 20:
-            return self.__recycle_ips.pop(0)
+    def __bind(self, key, n):
+        """记录客户端使用的地址"""
+        old_key = self.__addr2key.get(n, None)
+        if old_key is not None and self.__key2addr.get(old_key, None) == n: del self.__key2addr[old_key]
+
+        self.__key2addr[key] = n
+        self.__addr2key[n] = key
+
+    def __alloc(self):
+        no_new_ips = self.__next_ipaddr > self.__last_ipaddr
+
+        # sticky模式下先使用从未分配过的地址,回收的地址尽量保留给原来的客户端
+        if no_new_ips or (not self.__sticky and len(self.__recycle_ips) > self.__RECYCLE_DELAY):
+            if self.__recycle_ips: return self.__recycle_ips.popitem(last=False)[0]
 
-        n = self.__current_max_ipaddr + 1
-        host_n = self.__base_ipaddr & self.__mask
+        if no_new_ips: raise IpaddrNoEnoughErr
 
-        if host_n < n:
-            if self.__recycle_ips: return self.__recycle_ips.pop(0)
-            raise IpaddrNoEnoughErr
+        n = self.__next_ipaddr
+        self.__next_ipaddr += 1
 
-        new_int_ip = self.__base_ipaddr + n
-        self.__current_max_ipaddr = n
+        return n
 
-        a = (new_int_ip & 0xff000000) >> 24
-        b = (new_int_ip & 0x00ff0000) >> 16
-        c = (new_int_ip & 0x0000ff00) >> 8
-        d = new_int_ip & 0x000000ff
+    def get_addr(self, key=None):
+        """获取IP地址
+        :param key: 客户端标识,sticky模式下有效
+        :return bytes:
+        """
+        sticky = self.__sticky and key is not None
+
+        if sticky:
+            n = self.__key2addr.get(key, None)
+            if n is not None and n in self.__recycle_ips:
+                del self.__recycle_ips[n]
+                self.__used_ips.add(n)
+                return self.__to_bytes(n)
+            ''''''
 
-        return bytes([a, b, c, d])
+        n = self.__alloc()
+        self.__used_ips.add(n)
+        if sticky: self.__bind(key, n)
+
+        return self.__to_bytes(n)
 
     def put_addr(self, ipaddr):
         """回收IP资源
         :param ipaddr:
         :return:
         """
-        if ipaddr not in self.__recycle_ips: self.__recycle_ips.append(ipaddr)
+        n = int.from_bytes(ipaddr, "big")
+        # 忽略没有分配的地址
+        if n not in self.__used_ips: return
+
+        self.__used_ips.remove(n)
+        self.__recycle_ips[n] = None
+
+    @property
+    def free_count(self):
+        """还可以分配的地址个数"""
+        return self.__last_ipaddr - self.__next_ipaddr + 1 + len(self.__recycle_ips)
+
+
+class ip4addr(_ipaddr_base):
+    def __init__(self, ipaddr, mask_size, sticky=False):
+        """
+        :param ipaddr:192.168.1.0
+        :param mask:25
+        :param sticky: 是否尽可能给同一个客户端分配相同的地址
+        :return:
+        """
+        if mask_size < 1:
+            raise ValueError("the mask_size must be number and the value must be more than 0")
+
+        if mask_size > 31:
+            raise ValueError("the mask_size must be number and the value must be less than 32")
+
+        super(ip4addr, self).__init__(socket.AF_INET, ipaddr, mask_size, sticky=sticky)
+
+
+class ip6addr(_ipaddr_base):
+    def __init__(self, ipaddr, prefix, sticky=False):
+        """
+        :param ipaddr:fd00::
+        :param prefix:64
+        :param sticky: 是否尽可能给同一个客户端分配相同的地址
+        :return:
+        """
+        if prefix < 1:
+            raise ValueError("the prefix must be number and the value must be more than 0")
+
+        if prefix > 127:
+            raise ValueError("the prefix must be number and the value must be less than 128")
+
+        super(ip6addr, self).__init__(socket.AF_INET6, ipaddr, prefix, sticky=sticky)
+
+
+if __name__ == "__main__":
+    # 分配与回收的测试,python3 -m freenet.lib.ipaddr
+    import time
+
+    alloc = ip4addr("10.10.10.5", 24)
+    ips = [alloc.get_addr() for i in range(254)]
+    if ips[0] != socket.inet_aton("10.10.10.1") or ips[-1] != socket.inet_aton("10.10.10.254"):
+        raise SystemExit("wrong address range")
+    try:
+        alloc.get_addr()
+        raise SystemExit("the subnet should be exhausted")
+    except IpaddrNoEnoughErr:
+        pass
+
+    alloc.put_addr(ips[3])
+    alloc.put_addr(ips[3])
+    if alloc.get_addr() != ips[3] or alloc.free_count != 0: raise SystemExit("wrong recycle")
+
+    # sticky模式
+    alloc = ip4addr("10.10.0.0", 16, sticky=True)
+    a = alloc.get_addr("client_a")
+    b = alloc.get_addr("client_b")
+    alloc.put_addr(a)
+    alloc.put_addr(b)
+    for i in range(100): alloc.get_addr()
+    if alloc.get_addr("client_b") != b or alloc.get_addr("client_a") != a: raise SystemExit("wrong sticky address")
+
+    # /31点对点子网的两个地址都可以分配
+    alloc = ip4addr("10.10.10.4", 31)
+    if [alloc.get_addr(), alloc.get_addr()] != [socket.inet_aton("10.10.10.4"), socket.inet_aton("10.10.10.5")]:
+        raise SystemExit("wrong /31 address range")
+
+    alloc = ip6addr("fd00::", 64)
+    if alloc.get_addr() != socket.inet_pton(socket.AF_INET6, "fd00::1"): raise SystemExit("wrong ipv6 address")
+
+    # /16子网分配所有地址,全部回收之后再次分配
+    for sticky in (False, True,):
+        alloc = ip4addr("10.10.0.0", 16, sticky=sticky)
+        t = time.time()
+        ips = [alloc.get_addr(i) for i in range(65534)]
+        for ip in ips: alloc.put_addr(ip)
+        ips = [alloc.get_addr(i) for i in range(65534)]
+        cost = time.time() - t
+        if len(set(ips)) != 65534: raise SystemExit("duplicate address")
+        print("sticky=%s: %d get/put per second" % (sticky, 65534 * 3 / cost))
+    ''''''
+    print("ok")
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import socket, collections
 import freenet.lib.checksum as checksum
 import freenet.lib.ipaddr as ipaddr
 import pywind.lib.timer as timer
@@ -74,9 +75,13 @@ class nat(_nat_base):
     # 映射IP的有效时间
     __VALID_TIME = 900
 
-    def __init__(self, subnet):
+    def __init__(self, subnet, sticky=False):
+        """
+        :param subnet: 虚拟局域网,格式为 (ipaddr,mask_size)
+        :param sticky: 客户端重新连接之后是否尽可能分配相同的虚拟局域网地址
+        """
         super(nat, self).__init__()
-        self.__ip_alloc = ipaddr.ip4addr(*subnet)
+        self.__ip_alloc = ipaddr.ip4addr(*subnet, sticky=sticky)
         self.__timer = timer.timer()
 
     def get_ippkt2sLan_from_cLan(self, session_id, ippkt):
@@ -84,14 +89,14 @@ class nat(_nat_base):
         slan_saddr = self.find_sLanAddr_by_cLanAddr(session_id, clan_saddr)
 
         if not slan_saddr:
-            slan_saddr = self.__ip_alloc.get_addr()
+            slan_saddr = self.__ip_alloc.get_addr((session_id, clan_saddr,))
             self.add2Lan(session_id, clan_saddr, slan_saddr)
 
-        data_list = list(ippkt)
-        checksum.modify_address(slan_saddr, data_list, checksum.FLAG_MODIFY_SRC_IP)
+        data = bytearray(ippkt)
+        checksum.modify_address_in_place(slan_saddr, data, checksum.FLAG_MODIFY_SRC_IP)
         self.__timer.set_timeout(slan_saddr, self.__VALID_TIME)
 
-        return bytes(data_list)
+        return bytes(data)
 
     def get_ippkt2cLan_from_sLan(self, ippkt):
         slan_daddr = ippkt[16:20]
@@ -99,11 +104,11 @@ class nat(_nat_base):
 
         if not rs: return None
 
-        data_list = list(ippkt)
-        checksum.modify_address(rs["clan_addr"], data_list, checksum.FLAG_MODIFY_DST_IP)
+        data = bytearray(ippkt)
+        checksum.modify_address_in_place(rs["clan_addr"], data, checksum.FLAG_MODIFY_DST_IP)
         self.__timer.set_timeout(slan_daddr, self.__VALID_TIME)
 
-        return (rs["session_id"], bytes(data_list),)
+        return (rs["session_id"], bytes(data),)
 
     def recycle(self):
         names = self.__timer.get_timeout_names()
@@ -115,3 +120,477 @@ class nat(_nat_base):
 
 
 class nat6(_nat_base): pass
+
+
+class _port_pool(object):
+    """NAPT使用的地址与端口
+    一个地址的端口用完之后才使用下一个地址,地址与端口编码为一个整数 n = 地址序号 * 端口个数 + 端口序号
+    """
+    __PORT_MIN = 1024
+    __PORT_COUNT = 65536 - 1024
+    # 回收的端口超过这个个数才重新使用,避免迟到的数据包被转发给新的连接
+    __RECYCLE_DELAY = 1024
+
+    __first_addr = 0
+    __next = 0
+    __total = 0
+    __recycle = None
+
+    def __init__(self, first_addr, addr_count):
+        self.__first_addr = first_addr
+        self.__total = addr_count * self.__PORT_COUNT
+        self.__next = 0
+        self.__recycle = collections.deque()
+
+    def get(self):
+        """获取地址与端口
+        :return tuple: (n,addr,port),没有可用的端口时返回None
+        """
+        if self.__recycle and (self.__next >= self.__total or len(self.__recycle) > self.__RECYCLE_DELAY):
+            n = self.__recycle.popleft()
+        elif self.__next < self.__total:
+            n = self.__next
+            self.__next += 1
+        else:
+            return None
+
+        addr = (self.__first_addr + n // self.__PORT_COUNT).to_bytes(4, "big")
+
+        return (n, addr, self.__PORT_MIN + n % self.__PORT_COUNT,)
+
+    def put(self, n):
+        self.__recycle.append(n)
+
+
+class napt(object):
+    """按照连接进行地址与端口转换,多个客户端主机共用虚拟局域网中的少量地址
+    只支持TCP,UDP以及ICMP echo,ICMP echo使用标识符作为端口,其他数据包与非第一个分片的数据包会被丢弃
+    对端发送的ICMP目的不可达与超时报文根据其中携带的原始数据包找到连接,同时转换外层与原始数据包的地址
+    连接记录格式为 [nat_addr,nat_port,session_id,clan_addr,clan_port,remote_addr,remote_port,key,rev_key,n,closing]
+    """
+    # (session_id,protocol,clan_addr,clan_port,remote_addr,remote_port) -> 连接记录
+    __flows = None
+    # (protocol,nat_addr,nat_port) -> 连接记录
+    __rev_flows = None
+    __ports = None
+    __timer = None
+    # {protocol:timeout,...}
+    __timeouts = None
+    # TCP连接收到FIN或者RST之后的超时时间,需要覆盖TIME_WAIT期间迟到的数据包
+    __closing_timeout = 120
+    __stats = None
+
+    # ICMP差错报文类型,目的不可达与超时
+    __ICMP_ERRORS = (3, 11,)
+
+    def __init__(self, subnet, timeouts=None):
+        """
+        :param subnet: 虚拟局域网,格式为 (ipaddr,mask_size)
+        :param timeouts: 各个协议的空闲超时时间,格式为 {"tcp":900,"tcp_closing":120,"udp":180,"icmp":30}
+        """
+        ip, mask_size = subnet
+        if mask_size < 1 or mask_size > 30: raise ValueError("the mask_size must be between 1 and 30")
+
+        host_bits = 32 - mask_size
+        network = int.from_bytes(socket.inet_aton(ip), "big") >> host_bits << host_bits
+
+        if not timeouts: timeouts = {}
+        self.__timeouts = {
+            1: timeouts.get("icmp", 30),
+            6: timeouts.get("tcp", 900),
+            17: timeouts.get("udp", 180),
+        }
+        self.__closing_timeout = timeouts.get("tcp_closing", 120)
+
+        self.__flows = {}
+        self.__rev_flows = {}
+        # 不使用网络地址与广播地址
+        self.__ports = _port_pool(network + 1, (1 << host_bits) - 2)
+        self.__timer = timer.timer()
+        self.__stats = {"created": 0, "expired": 0, "out": 0, "in": 0, "dropped": 0, "no_port": 0}
+
+    def __parse(self, ippkt, is_out):
+        """获取协议与端口,ICMP echo的标识符作为端口
+        :return tuple: (protocol,ihl,sport,dport),不支持的数据包返回None
+        """
+        protocol = ippkt[9]
+        if protocol not in self.__timeouts: return None
+        # 非第一个分片没有端口信息
+        if ((ippkt[6] & 0x1f) << 8) | ippkt[7]: return None
+
+        ihl = (ippkt[0] & 0x0f) * 4
+        if len(ippkt) < ihl + 8: return None
+
+        if protocol == 1:
+            # 客户端发送echo请求,对端回复echo应答
+            if ippkt[ihl] != (8 if is_out else 0): return None
+            port = (ippkt[ihl + 4] << 8) | ippkt[ihl + 5]
+            if is_out: return (protocol, ihl, port, 0,)
+            return (protocol, ihl, 0, port,)
+
+        if protocol == 6 and len(ippkt) < ihl + 20: return None
+
+        sport = (ippkt[ihl] << 8) | ippkt[ihl + 1]
+        dport = (ippkt[ihl + 2] << 8) | ippkt[ihl + 3]
+
+        return (protocol, ihl, sport, dport,)
+
+    def __find_icmp_error_flow(self, ippkt, ihl):
+        """根据ICMP差错报文中的原始数据包查找连接,原始数据包是经过转换之后发送给对端的数据包
+        :return tuple: (flow,inner_pos),找不到连接时返回None
+        """
+        # 差错报文至少携带原始数据包的IP头部以及之后的8个字节,见RFC 792
+        pos = ihl + 8
+        if len(ippkt) < pos + 20 or ippkt[pos] >> 4 != 4: return None
+
+        inner_ihl = (ippkt[pos] & 0x0f) * 4
+        l4 = pos + inner_ihl
+        if inner_ihl < 20 or len(ippkt) < l4 + 8: return None
+
+        protocol = ippkt[pos + 9]
+        if protocol not in self.__timeouts: return None
+        if ((ippkt[pos + 6] & 0x1f) << 8) | ippkt[pos + 7]: return None
+
+        if protocol == 1:
+            if ippkt[l4] != 8: return None
+            sport = (ippkt[l4 + 4] << 8) | ippkt[l4 + 5]
+            dport = 0
+        else:
+            sport = (ippkt[l4] << 8) | ippkt[l4 + 1]
+            dport = (ippkt[l4 + 2] << 8) | ippkt[l4 + 3]
+
+        nat_addr = ippkt[pos + 12:pos + 16]
+        if nat_addr != ippkt[16:20]: return None
+
+        flow = self.__rev_flows.get((protocol, nat_addr, sport,), None)
+        # 差错报文可以由中间的路由器发送,因此只检查原始数据包的目的地址与端口
+        if not flow or flow[5] != ippkt[pos + 16:pos + 20] or flow[6] != dport: return None
+
+        return (flow, pos,)
+
+    def __translate_icmp_error(self, data, ihl, pos, clan_addr, clan_port):
+        """把外层目的地址以及原始数据包的源地址与源端口转换为客户端的地址与端口"""
+        inner_ihl = (data[pos] & 0x0f) * 4
+        l4 = pos + inner_ihl
+        protocol = data[pos + 9]
+        old_addr = bytes(data[pos + 12:pos + 16])
+
+        if protocol == 1:
+            port_pos = l4 + 4
+            csum_pos = l4 + 2
+        else:
+            port_pos = l4
+            csum_pos = l4 + 16 if protocol == 6 else l4 + 6
+        old_port = (data[port_pos] << 8) | data[port_pos + 1]
+
+        # 原始数据包的TCP,UDP或者ICMP校检和,TCP校检和不在前8个字节中,差错报文可能没有携带
+        if csum_pos + 2 <= len(data):
+            csum = (data[csum_pos] << 8) | data[csum_pos + 1]
+            if protocol != 17 or csum:
+                # ICMP校检和不包含伪头部
+                if protocol != 1: csum = checksum.calc_checksum_for_ip_change(old_addr, clan_addr, csum)
+                csum = checksum.calc_incre_checksum(csum, old_port, clan_port)
+                if protocol == 17 and csum == 0: csum = 0xffff
+                data[csum_pos:csum_pos + 2] = csum.to_bytes(2, "big")
+            ''''''
+
+        data[port_pos:port_pos + 2] = clan_port.to_bytes(2, "big")
+
+        csum = (data[pos + 10] << 8) | data[pos + 11]
+        csum = checksum.calc_checksum_for_ip_change(old_addr, clan_addr, csum)
+        data[pos + 10:pos + 12] = csum.to_bytes(2, "big")
+        data[pos + 12:pos + 16] = clan_addr
+
+        checksum.modify_address_in_place(clan_addr, data, checksum.FLAG_MODIFY_DST_IP)
+
+        # 原始数据包的内容改变之后重新计算整个ICMP报文的校检和
+        data[ihl + 2:ihl + 4] = b"\0\0"
+        data[ihl + 2:ihl + 4] = checksum.calc_checksum(data[ihl:], len(data) - ihl).to_bytes(2, "big")
+
+    def __get_icmp_error2cLan(self, ippkt, ihl):
+        rs = self.__find_icmp_error_flow(ippkt, ihl)
+        if not rs:
+            self.__stats["dropped"] += 1
+            return None
+
+        flow, pos = rs
+        data = bytearray(ippkt)
+        self.__translate_icmp_error(data, ihl, pos, flow[3], flow[4])
+        self.__stats["in"] += 1
+
+        return (flow[2], bytes(data),)
+
+    def __modify_icmp_id(self, data, ihl, new_id):
+        """修改ICMP echo的标识符,同时修正ICMP校检和"""
+        old_id = (data[ihl + 4] << 8) | data[ihl + 5]
+        csum = (data[ihl + 2] << 8) | data[ihl + 3]
+        csum = checksum.calc_incre_checksum(csum, old_id, new_id)
+
+        data[ihl + 2:ihl + 4] = csum.to_bytes(2, "big")
+        data[ihl + 4:ihl + 6] = new_id.to_bytes(2, "big")
+
+    def __translate(self, data, ihl, protocol, flags, addr, port):
+        if protocol == 1:
+            checksum.modify_address_in_place(addr, data, flags)
+            self.__modify_icmp_id(data, ihl, port)
+        else:
+            checksum.modify_address_in_place(addr, data, flags, port)
+
+    def __update_timeout(self, flow, data, ihl, protocol):
+        # TCP的FIN或者RST标志
+        if protocol == 6 and data[ihl + 13] & 0x05: flow[10] = True
+
+        if flow[10]:
+            self.__timer.set_timeout(flow[8], self.__closing_timeout)
+        else:
+            self.__timer.set_timeout(flow[8], self.__timeouts[protocol])
+
+    def __new_flow(self, key):
+        rs = self.__ports.get()
+        if not rs:
+            self.__stats["no_port"] += 1
+            return None
+
+        n, nat_addr, nat_port = rs
+        session_id, protocol, clan_addr, clan_port, remote_addr, remote_port = key
+        rev_key = (protocol, nat_addr, nat_port,)
+
+        flow = [nat_addr, nat_port, session_id, clan_addr, clan_port, remote_addr, remote_port, key, rev_key, n,
+                False]
+        self.__flows[key] = flow
+        self.__rev_flows[rev_key] = flow
+        self.__stats["created"] += 1
+
+        return flow
+
+    def get_ippkt2sLan_from_cLan(self, session_id, ippkt):
+        """把客户端局域网中的数据包转换成服务器虚拟局域网的包
+        :return bytes: 不支持的数据包或者没有可用的端口时返回None
+        """
+        rs = self.__parse(ippkt, True)
+        if not rs:
+            self.__stats["dropped"] += 1
+            return None
+
+        protocol, ihl, sport, dport = rs
+        key = (session_id, protocol, ippkt[12:16], sport, ippkt[16:20], dport,)
+
+        flow = self.__flows.get(key, None)
+        if not flow: flow = self.__new_flow(key)
+        if not flow: return None
+
+        data = bytearray(ippkt)
+        self.__translate(data, ihl, protocol, checksum.FLAG_MODIFY_SRC_IP, flow[0], flow[1])
+        self.__update_timeout(flow, data, ihl, protocol)
+        self.__stats["out"] += 1
+
+        return bytes(data)
+
+    def get_ippkt2cLan_from_sLan(self, ippkt):
+        """把服务端虚拟局域网中的包转换为客户端局域网中的数据包
+        :return tuple: (session_id,ippkt),找不到连接时返回None
+        """
+        ihl = (ippkt[0] & 0x0f) * 4
+        if ippkt[9] == 1 and len(ippkt) > ihl and ippkt[ihl] in self.__ICMP_ERRORS and not (
+                ((ippkt[6] & 0x1f) << 8) | ippkt[7]):
+            return self.__get_icmp_error2cLan(ippkt, ihl)
+
+        rs = self.__parse(ippkt, False)
+        if not rs: return None
+
+        protocol, ihl, sport, dport = rs
+        flow = self.__rev_flows.get((protocol, ippkt[16:20], dport,), None)
+
+        # 只接受连接对端发送的数据包
+        if not flow or flow[6] != sport or flow[5] != ippkt[12:16]:
+            self.__stats["dropped"] += 1
+            return None
+
+        data = bytearray(ippkt)
+        self.__translate(data, ihl, protocol, checksum.FLAG_MODIFY_DST_IP, flow[3], flow[4])
+        self.__update_timeout(flow, data, ihl, protocol)
+        self.__stats["in"] += 1
+
+        return (flow[2], bytes(data),)
+
+    def get_stats(self):
+        """获取连接统计信息"""
+        stats = self.__stats.copy()
+        stats["flows"] = len(self.__flows)
+
+        return stats
+
+    def recycle(self):
+        for rev_key in self.__timer.get_timeout_names():
+            if self.__timer.exists(rev_key): self.__timer.drop(rev_key)
+            flow = self.__rev_flows.pop(rev_key, None)
+            if not flow: continue
+
+            del self.__flows[flow[7]]
+            self.__ports.put(flow[9])
+            self.__stats["expired"] += 1
+        return
+
+
+if __name__ == "__main__":
+    # 性能测试,python3 -m freenet.lib.static_nat
+    # 旧的转换方式为 list(ippkt) -> checksum.modify_address -> bytes()
+    import os, random, time, socket
+
+    session_id = os.urandom(16)
+
+
+    def build_pkt(protocol, size, saddr, daddr):
+        l4_hdr_size = 20 if protocol == 6 else 8
+        payload = os.urandom(size - 20 - l4_hdr_size)
+        l4_size = l4_hdr_size + len(payload)
+
+        ip_hdr = bytearray(b"\x45\x00" + size.to_bytes(2, "big") + b"\x00\x01\x40\x00\x40" + bytes((protocol,)) + b"\x00\x00")
+        ip_hdr += saddr + daddr
+        ip_hdr[10:12] = checksum.calc_checksum(ip_hdr, 20).to_bytes(2, "big")
+
+        l4 = bytearray(os.urandom(4) + (bytes(l4_hdr_size - 4) if protocol == 6 else l4_size.to_bytes(2, "big") + bytes(2)))
+        if protocol == 6: l4[12] = 0x50
+        l4 += payload
+        csum_pos = 16 if protocol == 6 else 6
+        l4[csum_pos:csum_pos + 2] = calc_l4_checksum(protocol, saddr, daddr, l4).to_bytes(2, "big")
+
+        return bytes(ip_hdr + l4)
+
+
+    def calc_l4_checksum(protocol, saddr, daddr, l4):
+        pseudo_hdr = saddr + daddr + bytes((0, protocol,)) + len(l4).to_bytes(2, "big")
+        data = pseudo_hdr + l4
+        return checksum.calc_checksum(data, len(data))
+
+
+    def check_pkt(pkt):
+        ihl = (pkt[0] & 0x0f) * 4
+        if checksum.calc_checksum(pkt, ihl) != 0: return False
+        l4 = pkt[ihl:]
+        return calc_l4_checksum(pkt[9], pkt[12:16], pkt[16:20], l4) in (0, 0xffff,)
+
+
+    def old_translate(slan_saddr, ippkt):
+        data_list = list(ippkt)
+        checksum.modify_address(slan_saddr, data_list, checksum.FLAG_MODIFY_SRC_IP)
+        return bytes(data_list)
+
+
+    pkts = []
+    remote_addr = socket.inet_aton("8.8.8.8")
+    for i in range(1000):
+        clan_addr = socket.inet_aton("192.168.1.%d" % random.randint(2, 250))
+        pkts.append(build_pkt(random.choice((6, 17,)), random.choice((60, 576, 1400,)), clan_addr, remote_addr))
+    if not all([check_pkt(pkt) for pkt in pkts]): raise SystemExit("wrong test packets")
+
+    nat_obj = nat(("10.10.0.0", 16,))
+    for pkt in pkts:
+        new_pkt = nat_obj.get_ippkt2sLan_from_cLan(session_id, pkt)
+        if not check_pkt(new_pkt): raise SystemExit("wrong checksum after translation")
+        if new_pkt != old_translate(new_pkt[12:16], pkt): raise SystemExit("not same as the old translation")
+
+        reply = build_pkt(pkt[9], len(pkt), remote_addr, new_pkt[12:16])
+        _, new_reply = nat_obj.get_ippkt2cLan_from_sLan(reply)
+        if not check_pkt(new_reply) or new_reply[16:20] != pkt[12:16]: raise SystemExit("wrong reply translation")
+    ''''''
+
+    n = 50
+    slan_saddr = socket.inet_aton("10.10.0.2")
+
+    t = time.time()
+    for i in range(n):
+        for pkt in pkts: old_translate(slan_saddr, pkt)
+    old_rate = n * len(pkts) / (time.time() - t)
+
+    t = time.time()
+    for i in range(n):
+        for pkt in pkts: nat_obj.get_ippkt2sLan_from_cLan(session_id, pkt)
+    new_rate = n * len(pkts) / (time.time() - t)
+
+    print("old list translation: %d pkts/s" % old_rate)
+    print("nat translation: %d pkts/s" % new_rate)
+
+    # napt模式,100k个活动连接
+    n_flows = 100000
+    napt_obj = napt(("10.10.0.0", 24,))
+    sessions = [os.urandom(16) for i in range(100)]
+    pkts = []
+    for i in range(n_flows):
+        clan_addr = socket.inet_aton("192.168.%d.%d" % (i // 250 % 250, i % 250 + 1,))
+        pkts.append(bytearray(build_pkt(random.choice((6, 17,)), 60, clan_addr, remote_addr)))
+        pkts[-1][20:22] = (1024 + i % 60000).to_bytes(2, "big")
+        checksum.fill_tcpudp_checksum_in_place(pkts[-1])
+        pkts[-1] = bytes(pkts[-1])
+    ''''''
+
+    t = time.time()
+    out_pkts = [napt_obj.get_ippkt2sLan_from_cLan(sessions[i % 100], pkts[i]) for i in range(n_flows)]
+    create_rate = n_flows / (time.time() - t)
+
+    t = time.time()
+    for i in range(n_flows): napt_obj.get_ippkt2sLan_from_cLan(sessions[i % 100], pkts[i])
+    out_rate = n_flows / (time.time() - t)
+
+    # 交换地址与端口作为对端的回复,校检和不变
+    replies = []
+    for pkt in out_pkts:
+        data = bytearray(pkt)
+        data[12:16], data[16:20] = pkt[16:20], pkt[12:16]
+        data[20:22], data[22:24] = pkt[22:24], pkt[20:22]
+        replies.append(bytes(data))
+    ''''''
+
+    t = time.time()
+    in_pkts = [napt_obj.get_ippkt2cLan_from_sLan(reply) for reply in replies]
+    in_rate = n_flows / (time.time() - t)
+
+    for i in range(n_flows):
+        _session_id, in_pkt = in_pkts[i]
+        if _session_id != sessions[i % 100] or not check_pkt(out_pkts[i]) or not check_pkt(in_pkt):
+            raise SystemExit("wrong napt translation")
+        if in_pkt[16:20] != pkts[i][12:16] or in_pkt[22:24] != pkts[i][20:22]: raise SystemExit("wrong napt reply")
+    ''''''
+
+    print("napt %s flows: create %d flows/s, out %d pkts/s, in %d pkts/s" % (
+        n_flows, create_rate, out_rate, in_rate,))
+    print(napt_obj.get_stats())
+
+    # ICMP差错报文,UDP携带完整的原始数据包,TCP与ICMP echo只携带IP头部与之后的8个字节
+    def build_icmp(icmp_type, saddr, daddr, body):
+        icmp = bytearray(bytes((icmp_type, 0, 0, 0,)) + body)
+        icmp[2:4] = checksum.calc_checksum(icmp, len(icmp)).to_bytes(2, "big")
+        size = 20 + len(icmp)
+        ip_hdr = bytearray(b"\x45\x00" + size.to_bytes(2, "big") + b"\x00\x01\x40\x00\x40\x01\x00\x00" + saddr + daddr)
+        ip_hdr[10:12] = checksum.calc_checksum(ip_hdr, 20).to_bytes(2, "big")
+
+        return bytes(ip_hdr + icmp)
+
+
+    napt_obj = napt(("10.10.0.0", 24,))
+    clan_addr = socket.inet_aton("192.168.1.2")
+    router_addr = socket.inet_aton("172.16.0.1")
+    echo = build_icmp(8, clan_addr, remote_addr, b"\x12\x34\x00\x01" + os.urandom(32))
+
+    for pkt, icmp_type, size in ((build_pkt(17, 60, clan_addr, remote_addr), 3, 60,),
+                                 (build_pkt(6, 60, clan_addr, remote_addr), 3, 28,), (echo, 11, 28,),):
+        out_pkt = napt_obj.get_ippkt2sLan_from_cLan(session_id, pkt)
+        err = build_icmp(icmp_type, router_addr, out_pkt[12:16], bytes(4) + out_pkt[0:size])
+        _session_id, in_pkt = napt_obj.get_ippkt2cLan_from_sLan(err)
+        inner = in_pkt[28:]
+
+        if _session_id != session_id or in_pkt[16:20] != clan_addr or checksum.calc_checksum(in_pkt, 20) != 0:
+            raise SystemExit("wrong icmp error translation")
+        if checksum.calc_checksum(in_pkt[20:], len(in_pkt) - 20) != 0: raise SystemExit("wrong icmp checksum")
+        if checksum.calc_checksum(inner, 20) != 0 or inner[12:16] != clan_addr: raise SystemExit("wrong inner header")
+        port_pos = 24 if pkt[9] == 1 else 20
+        if inner[port_pos:port_pos + 2] != pkt[port_pos:port_pos + 2]: raise SystemExit("wrong inner port")
+        # 携带完整的UDP数据包时可以检查UDP校检和
+        if size == 60 and inner != pkt: raise SystemExit("wrong inner packet")
+        if pkt[9] == 1 and inner[20:28] != pkt[20:28]: raise SystemExit("wrong inner icmp checksum")
+
+        # 原始数据包的目的地址与连接不同时丢弃
+        err = build_icmp(icmp_type, router_addr, out_pkt[12:16], bytes(4) + out_pkt[0:16] + router_addr + out_pkt[20:size])
+        if napt_obj.get_ippkt2cLan_from_sLan(err) is not None: raise SystemExit("the icmp error should be dropped")
+    ''''''
+    print("icmp error translation ok")
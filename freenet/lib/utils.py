@@ -2,7 +2,6 @@
 
 import socket, random
 import freenet.lib.checksum as checksum
-import freenet.lib.fn_utils as fn_utils
 import hashlib
 
 __IP_HDR_SIZE = 20
@@ -36,30 +35,30 @@ def build_ip_packet(pkt_len, protocol, saddr, daddr, message, pkt_id=1, flags_df
     # 修改包长度
     old_v = (L[2] << 8) | L[3]
     new_v = pkt_len
-    csum = fn_utils.calc_incre_csum(csum, old_v, new_v)
+    csum = checksum.calc_incre_checksum(csum, old_v, new_v)
     L[2:4] = ((pkt_len & 0xff00) >> 8, pkt_len & 0x00ff,)
 
     # 修改包ID
     old_v = (L[4] << 8) | L[5]
     new_v = pkt_id
-    csum = fn_utils.calc_incre_csum(csum, old_v, new_v)
+    csum = checksum.calc_incre_checksum(csum, old_v, new_v)
     L[4:6] = ((pkt_id & 0xff00) >> 8, pkt_id & 0x00ff,)
 
     # 修改flags以及offset
     old_v = (L[6] << 8) | L[7]
     new_v = (flags_df << 14) | (flags_mf << 13) | offset
-    csum = fn_utils.calc_incre_csum(csum, old_v, new_v)
+    csum = checksum.calc_incre_checksum(csum, old_v, new_v)
     L[6:8] = ((new_v & 0xff00) >> 8, new_v & 0x00ff,)
 
     # 修改协议
     old_v = L[9]
     new_v = protocol
-    csum = fn_utils.calc_incre_csum(csum, old_v, new_v)
+    csum = checksum.calc_incre_checksum(csum, old_v, new_v)
     L[9] = protocol
 
     # 修改校检和
     # L[10:12] = (0, 0,)
-    # csum = fn_utils.calc_csum(bytes(L), 20)
+    # csum = checksum.calc_checksum(bytes(L), 20)
     L[10:12] = ((csum & 0xff00) >> 8, csum & 0x00ff,)
 
     return b"".join((bytes(L), message,))
@@ -28,6 +28,13 @@ def main():
         print("can not python3 include file")
         return
 
+    # 加密模块依赖pycryptodome
+    try:
+        import Crypto.Cipher
+    except ImportError:
+        print("please install pycryptodome first: pip3 install pycryptodome")
+        return
+
     paths = [(src_path_1, dst_path_1), (src_path_2, dst_path_2,)]
 
     for src, dst in paths:
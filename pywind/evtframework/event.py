@@ -2,10 +2,11 @@
 import select, time
 import sys
 
+# 事件值与epoll保持一致,epoll模式下内核返回的事件无需转换
 EV_TYPE_READ = 1
-EV_TYPE_WRITE = 2
-EV_TYPE_ERR = 4
-EV_TYPE_HUP = 8
+EV_TYPE_WRITE = 4
+EV_TYPE_ERR = 8
+EV_TYPE_HUP = 16
 EV_TYPE_NO_EV = 0
 
 
@@ -14,7 +15,15 @@ class event(object):
     some descriptions:
     about standard events:
         epoll,kqueue,select will be converted standard events,the format is:
-            [(fd,event_type,user_data),...]
+            [(fd,event_type),...]
+        the epoll events are returned as they are,without any conversion
+    about epoll:
+        the changes of event mask are cached and committed to the kernel on the next poll,
+        so toggling a event many times in one loop costs at most one epoll_ctl call
+    about edge triggered mode(linux only):
+        the handler must read until EAGAIN,otherwise it will not be notified again,
+        a handler that stops early(for example,reads a bounded batch for fairness) must call rearm(fd),
+        the fd is modified again on the next poll and the kernel reports it again if it is still ready
     """
     __wlist = []
     __rlist = []
@@ -28,8 +37,14 @@ class event(object):
     # the data for changed event
     __kqueue_change_event_map = {}
 
-    # {fd1:value1,fd2,value2,...}
+    # 已经提交给内核的事件掩码 {fd1:value1,fd2,value2,...}
     __epoll_register_info = {}
+    # 等待提交给内核的事件掩码 {fd1:value1,fd2,value2,...}
+    __epoll_change_info = {}
+    # 边沿触发模式下需要重新激活的文件描述符
+    __epoll_rearm_fds = None
+    # EPOLLET 或者 0
+    __epoll_flags = 0
 
     # {fd1:True | False,...}
     __is_register = {}
@@ -39,7 +54,10 @@ class event(object):
 
     __users_data = {}
 
-    def __init__(self):
+    def __init__(self, edge_triggered=False):
+        """
+        :param edge_triggered:是否使用边沿触发模式,只对epoll有效
+        """
         platform = sys.platform
 
         if platform.find("win32") > -1 or platform.find("cygwin") > -1:
@@ -54,8 +72,13 @@ class event(object):
         if platform.find("linux") > -1:
             self.__async_mode = "epoll"
             self.__epoll_object = select.epoll()
+            self.__epoll_register_info = {}
+            self.__epoll_change_info = {}
+            self.__epoll_rearm_fds = set()
             self.__iowait_func = self.__epoll_iowait
 
+            if edge_triggered: self.__epoll_flags = select.EPOLLET
+
         return
 
     def __del_ev_write(self, fileno):
@@ -63,14 +86,9 @@ class event(object):
             self.__wlist.remove(fileno)
 
         if self.__async_mode == "epoll":
-            if fileno not in self.__epoll_register_info:
-                return
-            eventmask = self.__epoll_register_info[fileno]
-            eventmask = eventmask & (~select.EPOLLOUT)
-
-            self.__epoll_object.modify(fileno, eventmask)
-            self.__epoll_register_info[fileno] = eventmask
-            ''''''
+            eventmask = self.__epoll_get_mask(fileno)
+            if eventmask is None: return
+            self.__epoll_set_mask(fileno, eventmask & (~EV_TYPE_WRITE))
 
         if self.__async_mode == "kqueue":
             if fileno not in self.__kqueue_event_map:
@@ -97,14 +115,9 @@ class event(object):
             self.__rlist.remove(fileno)
 
         if self.__async_mode == "epoll":
-            if fileno not in self.__epoll_register_info:
-                return
-
-            eventmask = self.__epoll_register_info[fileno]
-            eventmask = eventmask & (~select.EPOLLIN)
-
-            self.__epoll_object.modify(fileno, eventmask)
-            self.__epoll_register_info[fileno] = eventmask
+            eventmask = self.__epoll_get_mask(fileno)
+            if eventmask is None: return
+            self.__epoll_set_mask(fileno, eventmask & (~EV_TYPE_READ))
 
         if self.__async_mode == "kqueue":
             if fileno not in self.__kqueue_event_map:
@@ -133,6 +146,12 @@ class event(object):
         if event_fd in self.__wlist:
             self.__wlist.remove(event_fd)
 
+        if event_fd in self.__epoll_change_info:
+            del self.__epoll_change_info[event_fd]
+
+        if self.__epoll_rearm_fds and event_fd in self.__epoll_rearm_fds:
+            self.__epoll_rearm_fds.remove(event_fd)
+
         if event_fd in self.__epoll_register_info:
             self.__epoll_object.unregister(event_fd)
 
@@ -149,32 +168,46 @@ class event(object):
 
         return
 
-    def __convert_epoll_events(self, events):
-        """
-        Convert epoll events to standard events
-        """
-        std_events = []
-
-        for fileno, event in events:
-            is_read = (event & select.EPOLLIN) == select.EPOLLIN
-            is_write = (event & select.EPOLLOUT) == select.EPOLLOUT
-            is_hup = (event & select.EPOLLHUP) == select.EPOLLHUP
-            is_err = (event & select.EPOLLERR) == select.EPOLLERR
-
-            std_event = 0
-
-            if is_read: std_event |= EV_TYPE_READ
-            if is_write: std_event |= EV_TYPE_WRITE
-            if is_hup: std_event |= EV_TYPE_HUP
-            if is_err: std_event |= EV_TYPE_ERR
-
-            std_events.append(
-                (
-                    fileno, std_event, self.__users_data.get(fileno, None)
-                )
-            )
+    def __epoll_get_mask(self, fileno):
+        """获取文件描述符最新的事件掩码,没有注册返回None"""
+        eventmask = self.__epoll_change_info.get(fileno, None)
+        if eventmask is None: eventmask = self.__epoll_register_info.get(fileno, None)
+
+        return eventmask
+
+    def __epoll_set_mask(self, fileno, eventmask):
+        """修改事件掩码,掩码没有改变时不做任何事情"""
+        if eventmask == self.__epoll_register_info.get(fileno, None):
+            if fileno in self.__epoll_change_info: del self.__epoll_change_info[fileno]
+            return
+
+        self.__epoll_change_info[fileno] = eventmask
+
+    def __epoll_commit(self):
+        """把缓存的事件掩码一次性提交给内核"""
+        if self.__epoll_rearm_fds:
+            for fileno in self.__epoll_rearm_fds:
+                if fileno in self.__epoll_change_info: continue
+                if fileno not in self.__epoll_register_info: continue
+                self.__epoll_change_info[fileno] = self.__epoll_register_info[fileno]
+            self.__epoll_rearm_fds.clear()
+
+        if not self.__epoll_change_info: return
+
+        flags = self.__epoll_flags
+        for fileno, eventmask in self.__epoll_change_info.items():
+            try:
+                if fileno in self.__epoll_register_info:
+                    self.__epoll_object.modify(fileno, eventmask | flags)
+                else:
+                    self.__epoll_object.register(fileno, eventmask | flags)
+            except OSError:
+                # 文件描述符可能已经被关闭
+                if fileno in self.__epoll_register_info: del self.__epoll_register_info[fileno]
+                continue
+            self.__epoll_register_info[fileno] = eventmask
 
-        return std_events
+        self.__epoll_change_info.clear()
 
     def __convert_kqueue_events(self, events):
         """
@@ -202,13 +235,7 @@ class event(object):
 
             self.__kqueue_event_map[ident] = kevent
 
-            std_events.append(
-                (
-                    ident,
-                    std_event,
-                    self.__users_data.get(ident, None)
-                )
-            )
+            std_events.append((ident, std_event,))
 
         return std_events
 
@@ -237,18 +264,14 @@ class event(object):
             events_map[fd] |= EV_TYPE_ERR
 
         for key in events_map:
-            udata = self.__users_data.get(key, None)
-            std_events.append((key, events_map[key], udata))
+            std_events.append((key, events_map[key],))
 
         return std_events
 
-    def __handle_epoll_events(self, events):
-        return self.__convert_epoll_events(events)
-
     def __epoll_iowait(self):
-        events = self.__epoll_object.poll(10)
+        self.__epoll_commit()
 
-        return self.__handle_epoll_events(events)
+        return self.__epoll_object.poll(self.__poll_timeout)
 
     def __handle_kqueue_events(self, events):
         for kevent in events:
@@ -288,25 +311,9 @@ class event(object):
             self.__rlist.append(fileno)
 
         if self.__async_mode == "epoll":
-            if fileno not in self.__epoll_register_info:
-                self.__epoll_register_info[fileno] = None
-
-            eventmask = self.__epoll_register_info[fileno]
-            event = select.EPOLLIN
-
-            if eventmask == None:
-                eventmask = event
-
-                self.__epoll_object.register(fileno, eventmask)
-                self.__epoll_register_info[fileno] = eventmask
-
-                return
-
-            is_register_read = (eventmask & select.EPOLLIN) == select.EPOLLIN
-
-            if is_register_read == False:
-                eventmask = event | eventmask
-                self.__epoll_object.modify(fileno, eventmask)
+            eventmask = self.__epoll_get_mask(fileno)
+            if eventmask is None: eventmask = 0
+            self.__epoll_set_mask(fileno, eventmask | EV_TYPE_READ)
 
         if self.__async_mode == "kqueue":
             filter_ = select.KQ_FILTER_READ
@@ -338,25 +345,11 @@ class event(object):
             self.__wlist.append(fileno)
 
         if self.__async_mode == "epoll":
-            if fileno not in self.__epoll_register_info:
-                self.__epoll_register_info[fileno] = None
-
-            eventmask = self.__epoll_register_info[fileno]
-            event = select.EPOLLOUT
-
-            if eventmask == None:
-                eventmask = event
-
-                self.__epoll_object.register(fileno, eventmask)
-                self.__epoll_register_info[fileno] = eventmask
-
-                return
-
-            is_register_write = (eventmask & select.EPOLLOUT) == select.EPOLLOUT
-
-            if is_register_write == False:
-                eventmask = event | eventmask
-                self.__epoll_object.modify(fileno, eventmask)
+            eventmask = self.__epoll_get_mask(fileno)
+            if eventmask is None: eventmask = 0
+            self.__epoll_set_mask(fileno, eventmask | EV_TYPE_WRITE)
+            # 边沿触发模式下,描述符可能已经可写,需要重新激活才能收到通知
+            if self.__epoll_flags: self.__epoll_rearm_fds.add(fileno)
 
         if self.__async_mode == "kqueue":
             filter_ = select.KQ_FILTER_WRITE
@@ -421,6 +414,15 @@ class event(object):
 
         return
 
+    def rearm(self, fd):
+        """
+        Note:only for edge triggered mode,otherwise it will not do anything
+        """
+        if not self.__epoll_flags: return
+        if not self.__is_register.get(fd, False): return
+
+        self.__epoll_rearm_fds.add(fd)
+
     def set_udata(self, fd, udata):
         """
         get user self-define data
@@ -450,3 +452,84 @@ class event(object):
 
     def dbg_print_register_fds(self):
         print(self.dbg_get_register_fds())
+
+
+if __name__ == "__main__":
+    # 性能测试,python3 -m pywind.evtframework.event [sockets] [seconds]
+    # 每次循环向一部分套接字发送数据,另外有一部分套接字一直关注写事件(例如发送缓冲区还有数据的连接)
+    # 处理者每次事件最多读取一批数据包,边沿触发模式下没有读取到EAGAIN时调用rearm
+    import random, resource, socket
+
+    if not sys.platform.startswith("linux"): raise SystemExit("the edge triggered mode only supports linux")
+
+    n_socks = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 3
+    # 每次循环有数据的套接字个数,每个套接字的数据包个数以及每次事件最多读取的数据包个数
+    active, burst, batch = 100, 4, 2
+    writers = n_socks // 10
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < n_socks + 64: resource.setrlimit(resource.RLIMIT_NOFILE, (min(n_socks + 64, hard), hard,))
+
+    socks = []
+    peers = {}
+    for i in range(n_socks // 2):
+        a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        a.setblocking(False)
+        b.setblocking(False)
+        socks += [a, b]
+        peers[a.fileno()] = b
+        peers[b.fileno()] = a
+    ''''''
+    fd_map = dict([(s.fileno(), s,) for s in socks])
+
+
+    def run(edge_triggered):
+        ev = event(edge_triggered=edge_triggered)
+        for s in socks: ev.register(s.fileno(), EV_TYPE_READ)
+        for s in socks[0:writers]: ev.add_event(s.fileno(), EV_TYPE_WRITE)
+
+        sent = received = events = polls = 0
+        begin = time.time()
+
+        while time.time() - begin < seconds:
+            for s in random.sample(socks, active):
+                for i in range(burst): peers[s.fileno()].send(b"x")
+                sent += burst
+            ''''''
+            # 处理到读取不到数据为止
+            while 1:
+                polls += 1
+                n = 0
+                for fd, evt in ev.poll(0):
+                    events += 1
+                    if not evt & EV_TYPE_READ: continue
+                    s = fd_map[fd]
+                    k = 0
+                    while k < batch:
+                        try:
+                            s.recv(64)
+                        except BlockingIOError:
+                            break
+                        k += 1
+                    ''''''
+                    n += k
+                    # 读取满一批时套接字可能还有数据
+                    if k == batch: ev.rearm(fd)
+                ''''''
+                received += n
+                if not n: break
+            ''''''
+        cost = time.time() - begin
+
+        for s in socks: ev.unregister(s.fileno())
+        if received != sent: raise SystemExit("lost %d messages" % (sent - received))
+
+        print("%-15s events: %8d/s, messages: %7d/s, polls: %6d/s, events per message: %.2f" % (
+            "edge triggered" if edge_triggered else "level triggered", events / cost, received / cost,
+            polls / cost, events / received,))
+
+
+    print("sockets: %d, active: %d, writers: %d, batch: %d" % (n_socks, active, writers, batch,))
+    run(False)
+    run(True)
@@ -63,6 +63,10 @@ class dispatcher(object):
     def remove_evt_write(self, fd):
         self.__poll.remove_event(fd, evt_notify.EV_TYPE_WRITE)
 
+    def rearm(self, fd):
+        """边沿触发模式下没有读取到EAGAIN就返回时调用,下次poll时如果仍然可读会再次收到事件"""
+        self.__poll.rearm(fd)
+
     def unregister(self, fd):
         self.__poll.unregister(fd)
 
@@ -81,8 +85,12 @@ class dispatcher(object):
         self.init_func(*args, **kwargs)
 
         while 1:
-            wait_time = self.__timer.get_min_time()
-            if wait_time < 1: wait_time = 10
+            if self.__timer.is_empty():
+                wait_time = 10
+            else:
+                wait_time = self.__timer.get_min_time()
+                if wait_time < 0: wait_time = 0
+                if wait_time > 10: wait_time = 10
 
             event_set = self.__poll.poll(wait_time)
 
@@ -121,8 +129,11 @@ class dispatcher(object):
     def handler_exists(self, fd):
         return fd in self.__handlers
 
-    def create_poll(self):
-        self.__poll = evt_notify.event()
+    def create_poll(self, edge_triggered=False):
+        """
+        :param edge_triggered:是否使用边沿触发模式,只对linux有效
+        """
+        self.__poll = evt_notify.event(edge_triggered=edge_triggered)
 
     def __handle_timeout(self):
         fd_set = self.__timer.get_timeout_names()
@@ -136,21 +147,20 @@ class dispatcher(object):
         return
 
     def __handle_events(self, evt_set):
-        for fd, evt, udata in evt_set:
-            is_read = (evt & evt_notify.EV_TYPE_READ) == evt_notify.EV_TYPE_READ
-            is_write = (evt & evt_notify.EV_TYPE_WRITE) == evt_notify.EV_TYPE_WRITE
-            is_err = (evt & evt_notify.EV_TYPE_ERR) == evt_notify.EV_TYPE_ERR
+        handlers = self.__handlers
+        ev_read = evt_notify.EV_TYPE_READ
+        ev_write = evt_notify.EV_TYPE_WRITE
+        ev_err = evt_notify.EV_TYPE_ERR
 
+        for fd, evt in evt_set:
             # 别的handler可能删除这个handler,因此需要检查
-            if fd not in self.__handlers: continue
-            handler = self.__handlers[fd]
-            if not self.handler_exists(fd): continue
-            if is_err:
+            handler = handlers.get(fd, None)
+            if handler is None: continue
+            if evt & ev_err:
                 handler.error()
                 continue
-            if is_read: handler.evt_read()
-            if not self.handler_exists(fd): continue
-            if is_write: handler.evt_write()
+            if evt & ev_read: handler.evt_read()
+            if evt & ev_write and fd in handlers: handler.evt_write()
             ''''''
         return
 
@@ -95,6 +95,9 @@ class handler(object):
     def remove_evt_write(self, fd):
         self.dispatcher.remove_evt_write(fd)
 
+    def rearm(self, fd):
+        self.dispatcher.rearm(fd)
+
     def unregister(self, fd):
         self.dispatcher.unregister(fd)
 
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import socket
 import pywind.evtframework.handler.handler as handler
 import pywind.lib.reader as reader
 import pywind.lib.writer as writer
@@ -17,6 +18,10 @@ class tcp_handler(handler.handler):
     __is_listen_socket = False
     __delete_this_no_sent_data = False
 
+    # 每次recv的大小
+    __RECV_SIZE = 16 * 1024
+    __has_sendmsg = hasattr(socket.socket, "sendmsg")
+
     def __init__(self):
         super(tcp_handler, self).__init__()
         self.__reader = reader.reader()
@@ -75,9 +80,17 @@ class tcp_handler(handler.handler):
             self.__conn_ev_flag = 1
             return
 
+        # 没有重写handle_tcp_received_data时直接读取到缓冲区,避免复制
+        is_direct = type(self).handle_tcp_received_data is tcp_handler.handle_tcp_received_data
+
         while 1:
             try:
-                recv_data = self.socket.recv(4096)
+                if is_direct:
+                    if not self.reader.recv_into(self.socket, self.__RECV_SIZE):
+                        self.error()
+                        break
+                    continue
+                recv_data = self.socket.recv(self.__RECV_SIZE)
                 if not recv_data:
                     self.error()
                     break
@@ -102,20 +115,33 @@ class tcp_handler(handler.handler):
             self.__conn_ok = True
             self.connect_ok()
             return
-        sent_data = self.writer._getvalue()
-        if not sent_data: self.tcp_writable()
-        try:
-            sent_size = self.socket.send(sent_data)
-            rest = sent_data[sent_size:]
-            if rest:
-                self.writer.write(rest)
-                return
-            if self.__delete_this_no_sent_data and self.writer.size() == 0:
+        if self.writer.is_empty():
+            if self.__delete_this_no_sent_data:
                 self.delete_handler(self.fileno)
                 return
             self.tcp_writable()
-        except ConnectionError:
-            self.error()
+            return
+
+        # 一直发送到缓冲区为空或者EAGAIN,边沿触发模式下只有在套接字重新变为可写时才会再次收到事件
+        while not self.writer.is_empty():
+            buffers = self.writer.get_buffers()
+            try:
+                if len(buffers) == 1 or not self.__has_sendmsg:
+                    sent_size = self.socket.send(buffers[0])
+                else:
+                    sent_size = self.socket.sendmsg(buffers)
+            except BlockingIOError:
+                return
+            except ConnectionError:
+                self.error()
+                return
+
+            self.writer.consume(sent_size)
+        ''''''
+        if self.__delete_this_no_sent_data:
+            self.delete_handler(self.fileno)
+            return
+        self.tcp_writable()
 
     def timeout(self):
         if self.__is_async_socket_client and not self.is_conn_ok():
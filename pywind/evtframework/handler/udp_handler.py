@@ -1,25 +1,38 @@
 #!/usr/bin/env python3
+import collections, itertools
 import pywind.evtframework.handler.handler as handler
 import pywind.lib.timer as timer
 
 
 class udp_handler(handler.handler):
     # 需要发送的数据
+    # 连接模式为 deque([byte_data,...]),否则为 {address:deque([(byte_data,flags),...]),...}
     __sent = None
     __socket = None
     __is_connect = False
     __peer_address = None
 
-    # 接收缓冲队列大小
+    # 接收缓冲队列大小,批量模式下同时也是一次系统调用收发的最大数据包个数
     __recv_buff_size = 20
+    __RECV_SIZE = 16384
+
+    # 批量收发函数,为None表示不使用批量模式
+    __recvmmsg = None
+    __sendmmsg = None
+
+    # 收发统计,格式为 [系统调用次数,数据包个数],发送统计另外记录因为错误丢弃的数据包个数
+    __recv_stats = None
+    __send_stats = None
 
     def __init__(self):
         super(udp_handler, self).__init__()
         self.__timer = timer.timer()
+        self.__recv_stats = [0, 0]
+        self.__send_stats = [0, 0, 0]
 
     def connect(self, address):
         self.__is_connect = True
-        self.__sent = []
+        self.__sent = collections.deque()
         self.socket.connect(address)
         self.__peer_address = self.socket.getpeername()
 
@@ -27,6 +40,32 @@ class udp_handler(handler.handler):
         """设置接收缓冲队列大小"""
         self.__recv_buff_size = size
 
+    def set_io_batch(self, size, recvmmsg=None, sendmmsg=None):
+        """设置批量收发
+        :param size: 一次系统调用最多收发的数据包个数
+        :param recvmmsg: 批量接收函数,格式为 recvmmsg(fd,count,bufsize) -> [(message,address),...]
+        :param sendmmsg: 批量发送函数,格式为 sendmmsg(fd,[(message,address),...]) -> 发送成功的个数
+        :return:
+        """
+        self.__recv_buff_size = size
+        self.__recvmmsg = recvmmsg
+        self.__sendmmsg = sendmmsg
+
+    def get_io_stats(self):
+        """获取收发统计信息"""
+        recv_calls, recv_msgs = self.__recv_stats
+        send_calls, send_msgs, send_errors = self.__send_stats
+
+        return {
+            "recv_calls": recv_calls,
+            "recv_msgs": recv_msgs,
+            "recv_msgs_per_call": recv_msgs / recv_calls if recv_calls else 0,
+            "send_calls": send_calls,
+            "send_msgs": send_msgs,
+            "send_msgs_per_call": send_msgs / send_calls if send_calls else 0,
+            "send_errors": send_errors,
+        }
+
     def get_id(self, address):
         """根据地址生成唯一id"""
         return "%s-%s" % address
@@ -58,90 +97,182 @@ class udp_handler(handler.handler):
     def sendto(self, byte_data, address, flags=0):
         if self.__is_connect: return False
 
-        name = self.get_id(address)
-        if name not in self.__sent: self.__sent[name] = []
+        if address not in self.__sent: self.__sent[address] = collections.deque()
 
-        self.__sent[name].append((byte_data, flags, address,))
+        self.__sent[address].append((byte_data, flags,))
         return True
 
     def send(self, byte_data):
         if not self.__is_connect: return False
-        if None == self.__sent: self.__sent = []
+        if None == self.__sent: self.__sent = collections.deque()
 
         self.__sent.append(byte_data)
 
         return
 
-    def evt_read(self):
+    def __recv(self):
         recv_buf_q = []
+        stats = self.__recv_stats
+
+        if self.__recvmmsg:
+            try:
+                recv_buf_q = self.__recvmmsg(self.fileno, self.__recv_buff_size, self.__RECV_SIZE)
+            except OSError:
+                self.error()
+                return recv_buf_q
+            stats[0] += 1
+            stats[1] += len(recv_buf_q)
+            # 边沿触发模式下读取满一批时套接字可能还有数据
+            if len(recv_buf_q) == self.__recv_buff_size: self.rearm(self.fileno)
+            return recv_buf_q
 
         for i in range(self.__recv_buff_size):
             try:
                 if self.__is_connect:
-                    message = self.socket.recv(16384)
-                    address=self.__peer_address
+                    message = self.socket.recv(self.__RECV_SIZE)
+                    address = self.__peer_address
                 else:
-                    message, address = self.socket.recvfrom(16384)
+                    message, address = self.socket.recvfrom(self.__RECV_SIZE)
             except BlockingIOError:
                 break
             except:
                 self.error()
                 break
+            stats[0] += 1
+            stats[1] += 1
             recv_buf_q.append((message, address,))
-        while 1:
-            try:
-                message, address = recv_buf_q.pop(0)
-            except IndexError:
-                break
+
+        if len(recv_buf_q) == self.__recv_buff_size: self.rearm(self.fileno)
+
+        return recv_buf_q
+
+    def evt_read(self):
+        peer_address = self.__peer_address
+
+        for message, address in self.__recv():
+            if address is None: address = peer_address
             self.udp_readable(message, address)
 
         return
 
-    def evt_write(self):
-        if self.__is_connect:
-            while 1:
-                if not self.__sent:
-                    self.udp_writable()
-                    return
-                byte_data = self.__sent.pop(0)
-                sent_size = self.socket.send(byte_data)
-                remain = byte_data[sent_size:]
-                if remain:
-                    self.__sent.insert(0, byte_data)
-                    return
+    def __send_connected(self):
+        """发送连接模式下的数据
+        :return Boolean: True表示数据已经全部发送
+        """
+        sent = self.__sent
+        stats = self.__send_stats
+
+        while sent:
+            try:
+                if self.__sendmmsg:
+                    batch = [(byte_data, None,) for byte_data in itertools.islice(sent, self.__recv_buff_size)]
+                    n = self.__sendmmsg(self.fileno, batch)
+                else:
+                    self.socket.send(sent[0])
+                    n = 1
+            except BlockingIOError:
+                return False
+            except OSError:
+                # 第一个数据包发送失败,例如对端不可达或者数据包过大,丢弃这个数据包之后继续发送
+                sent.popleft()
+                stats[2] += 1
                 continue
-            ''''''
-        ''''''
-        del_names = []
-        for name in self.__sent:
-            data_queue = self.__sent[name]
-            break_loop = False
-
-            while 1:
-                try:
-                    byte_data, flags, address = data_queue.pop(0)
-                except IndexError:
-                    break
-                sent_size = self.socket.sendto(byte_data, flags, address)
-                slice_data = byte_data[sent_size:]
-
-                if slice_data:
-                    break_loop = True
-                    self.__sent[name].insert(0, (slice_data, flags, address,))
-                    break
+            stats[0] += 1
+            stats[1] += n
+
+            for i in range(n): sent.popleft()
+            if n == 0: return False
+
+        return True
+
+    def __sendto_batch(self):
+        """批量发送非连接模式下的数据,带有flags的数据单独发送
+        :return Boolean: True表示数据已经全部发送
+        """
+        sent = self.__sent
+        stats = self.__send_stats
+        size = self.__recv_buff_size
+
+        while sent:
+            batch = []
+            for address, queue in sent.items():
+                for byte_data, flags in queue:
+                    if flags or len(batch) == size: break
+                    batch.append((byte_data, address,))
+                if len(batch) == size: break
+
+            single = not batch
+            if single:
+                # 所有队列的第一个数据都带有flags
+                byte_data, flags = queue[0]
+                batch = [(byte_data, address,)]
+
+            try:
+                if single:
+                    self.socket.sendto(byte_data, flags, address)
+                    n = 1
+                else:
+                    n = self.__sendmmsg(self.fileno, batch)
+            except BlockingIOError:
+                return False
+            except OSError:
+                # 第一个数据包发送失败,丢弃这个数据包之后继续发送
+                address = batch[0][1]
+                queue = sent[address]
+                queue.popleft()
+                if not queue: del sent[address]
+                stats[2] += 1
                 continue
+            stats[0] += 1
+            stats[1] += n
 
-            if break_loop: break
+            for byte_data, address in batch[0:n]:
+                queue = sent[address]
+                queue.popleft()
+                if not queue: del sent[address]
 
-            if not self.__sent[name]:
-                del_names.append(name)
-            ''''''
+            if n < len(batch): return False
 
-        for name in del_names:
-            del self.__sent[name]
+        return True
+
+    def __sendto(self):
+        """发送非连接模式下的数据
+        :return Boolean: True表示数据已经全部发送
+        """
+        sent = self.__sent
+        stats = self.__send_stats
+
+        while sent:
+            address, queue = next(iter(sent.items()))
+
+            while queue:
+                byte_data, flags = queue[0]
+                try:
+                    self.socket.sendto(byte_data, flags, address)
+                except BlockingIOError:
+                    return False
+                except OSError:
+                    # 发送失败的数据包被丢弃
+                    queue.popleft()
+                    stats[2] += 1
+                    continue
+                stats[0] += 1
+                stats[1] += 1
+                queue.popleft()
+
+            del sent[address]
+
+        return True
+
+    def evt_write(self):
+        if self.__is_connect:
+            is_empty = self.__send_connected()
+        elif self.__sendmmsg:
+            is_empty = self.__sendto_batch()
+        else:
+            is_empty = self.__sendto()
 
-        if not self.__sent:
-            self.udp_writable()
+        if is_empty: self.udp_writable()
 
         return
 
@@ -1,66 +1,79 @@
 #!/usr/bin/env python3
-
-import io, queue
+"""基于bytearray的读缓冲区,数据保存在一块连续内存中
+读取位置和写入位置只会向后移动,当空间不够时才会把剩余数据移到缓冲区开头
+"""
 
 
 class reader(object):
-    __size = 0
-    __data_list = []
-    __lifo_queue = None
+    __buff = None
+    # 数据开始位置
+    __begin = 0
+    # 数据结束位置
+    __end = 0
+    # 缓冲区为空时保留的最大内存
+    __MAX_IDLE_SIZE = 256 * 1024
 
     def __init__(self):
-        self.__size = 0
-        self.__data_list = []
-        self.__lifo_queue = queue.LifoQueue()
+        self.__buff = bytearray()
+        self.__begin = 0
+        self.__end = 0
 
-    def read(self, n=-1):
-        if n == 0:
-            return b""
+    def __reserve(self, n):
+        """确保缓冲区尾部至少有n个字节的空间"""
+        buff = self.__buff
+        if len(buff) - self.__end >= n: return
 
-        byte_io = io.BytesIO()
+        size = self.__end - self.__begin
 
-        remainN = n
-        while 1:
-            try:
-                try:
-                    byte_data = self.__lifo_queue.get_nowait()
-                except queue.Empty:
-                    byte_data = self.__data_list.pop(0)
+        # 把剩余数据移到缓冲区开头
+        if self.__begin:
+            buff[0:size] = buff[self.__begin:self.__end]
+            self.__begin = 0
+            self.__end = size
 
-                size = len(byte_data)
+        need = size + n - len(buff)
+        if need > 0: buff.extend(bytes(max(need, len(buff))))
 
-                if n < 0:
-                    byte_io.write(byte_data)
-                    continue
+    def read(self, n=-1):
+        if n == 0:
+            return b""
 
-                if size < 1:
-                    break
+        size = self.__end - self.__begin
+        if n < 0 or n > size: n = size
 
-                read = b""
-                if remainN >= size:
-                    remainN -= size
-                    read = byte_data
-                    byte_io.write(read)
-                    continue
+        b = self.__begin
+        e = b + n
 
-                read = byte_data[0:remainN]
-                remain = byte_data[remainN:]
+        with memoryview(self.__buff) as view:
+            ret = bytes(view[b:e])
 
-                byte_io.write(read)
+        self.consume(n)
 
-                self.__lifo_queue.put(remain)
-                break
+        return ret
 
+    def peek(self, n=-1):
+        """获取数据但不移动读取位置,返回的是只读的memoryview,不复制数据
+        注意:写入数据之前必须调用memoryview.release()
+        """
+        size = self.__end - self.__begin
+        if n < 0 or n > size: n = size
 
-            except IndexError:
-                break
+        b = self.__begin
 
-        ret = byte_io.getvalue()
-        byte_io.close()
+        return memoryview(self.__buff)[b:b + n].toreadonly()
 
-        self.__size -= len(ret)
+    def consume(self, n):
+        """丢弃n个字节的数据"""
+        size = self.__end - self.__begin
+        if n > size: n = size
 
-        return ret
+        self.__begin += n
+        if self.__begin == self.__end:
+            self.__begin = 0
+            self.__end = 0
+            # 释放突发流量占用的过多内存
+            if len(self.__buff) > self.__MAX_IDLE_SIZE: self.__buff = bytearray()
+        return
 
     def readlines(self, hint=None):
         seq = []
@@ -84,65 +97,29 @@ class reader(object):
         if limit == 0:
             return b""
 
-        if limit > 0:
-            byte_data = self.read(limit)
-            find_pos = byte_data.find(b"\n")
-            ret = byte_data
-
-            if find_pos > -1:
-                end = find_pos + 1
-                ret = byte_data[0:end]
-                begin = end
-                remain = byte_data[begin:]
-
-                self.__lifo_queue.put(remain)
-
-            self.__size -= len(ret)
-            return ret
-
-        byte_io = io.BytesIO()
-        while 1:
-            try:
-                try:
-                    byte_data = self.__lifo_queue.get_nowait()
-                except queue.Empty:
-                    byte_data = self.__data_list.pop(0)
+        end = self.__end
+        if limit > 0 and self.__begin + limit < end: end = self.__begin + limit
 
-                size = len(byte_data)
+        find_pos = self.__buff.find(b"\n", self.__begin, end)
 
-                if size < 1:
-                    break
+        if find_pos < 0: return self.read(end - self.__begin)
 
-                find_pos = byte_data.find(b"\n")
-
-                if find_pos > -1:
-                    end = find_pos + 1
-                    read = byte_data[0:end]
-                    begin = end
-                    remain = byte_data[begin:]
-                    self.__lifo_queue.put(remain)
-                    byte_io.write(read)
-                    break
-
-                byte_io.write(byte_data)
-
-            except IndexError:
-                break
-
-        ret = byte_io.getvalue()
-        byte_io.close()
-        self.__size-=len(ret)
-
-        return ret
+        return self.read(find_pos + 1 - self.__begin)
 
     def push(self, byte_data):
+        """把数据放回到缓冲区开头"""
         if byte_data == b"":
             return
 
         size = len(byte_data)
 
-        self.__size += size
-        self.__lifo_queue.put(byte_data)
+        if self.__begin >= size:
+            self.__begin -= size
+            self.__buff[self.__begin:self.__begin + size] = byte_data
+            return
+
+        self.__buff[self.__begin:self.__begin] = byte_data
+        self.__end += size
 
     def _putvalue(self, byte_data):
         # cut down empty list data
@@ -152,11 +129,29 @@ class reader(object):
 
         size = len(byte_data)
 
-        self.__data_list.append(byte_data)
-        self.__size += size
+        self.__reserve(size)
+        e = self.__end + size
+        self.__buff[self.__end:e] = byte_data
+        self.__end = e
+
+    def recv_into(self, s, bufsize):
+        """直接从socket读取数据到缓冲区,避免复制
+        :param s: socket对象
+        :param bufsize: 最大读取大小
+        :return: 读取的字节数,0表示连接关闭
+        """
+        self.__reserve(bufsize)
+        e = self.__end
+
+        with memoryview(self.__buff) as view:
+            n = s.recv_into(view[e:e + bufsize], bufsize)
+
+        self.__end += n
+
+        return n
 
     def size(self):
-        return self.__size
+        return self.__end - self.__begin
 
     def flush(self):
-        _ = self.read()
+        self.consume(self.size())
@@ -1,75 +1,96 @@
 #!/usr/bin/env python3
+"""定时器,基于最小堆实现,支持毫秒级超时
+插入与更新的复杂度为O(log n),延长超时时间的复杂度为O(1)
+"""
 
-import time
+import heapq, time
 
 
 class timer(object):
+    # {name:[timeout_time,seq],...},seq为堆中有效节点的序号,为None表示已经超时但未被删除
     __timeout_info = None
-    __timeout_info_reverse = None
-    __time_list = None
+    # 堆元素格式为 (timeout_time,seq,name)
+    __heap = None
+    __seq = 0
 
     def __init__(self):
         self.__timeout_info = {}
-        self.__timeout_info_reverse = {}
-        self.__time_list = []
+        self.__heap = []
+        self.__seq = 0
+
+    def __push(self, name, t):
+        self.__seq += 1
+        heapq.heappush(self.__heap, (t, self.__seq, name,))
+
+        return self.__seq
+
+    def __compact(self):
+        """清除堆中过多的无效节点,防止内存过度消耗"""
+        heap = []
+        for name, info in self.__timeout_info.items():
+            if info[1] is None: continue
+            heap.append((info[0], info[1], name,))
+        heapq.heapify(heap)
+        self.__heap = heap
+
+    def __pop_invalid(self):
+        """删除堆顶的无效节点"""
+        heap = self.__heap
+        while heap:
+            t, seq, name = heap[0]
+            info = self.__timeout_info.get(name, None)
+            if info and info[1] == seq: break
+            heapq.heappop(heap)
+        return
 
     def get_timeout_names(self):
-        cur_t = int(time.time())
-        names = []
-
-        while 1:
-            try:
-                t = self.__time_list.pop(0)
-            except IndexError:
-                break
-            if t - cur_t > 0:
-                self.__time_list.insert(0, t)
-                break
-
-            if t not in self.__timeout_info_reverse: continue
-            pydict = self.__timeout_info_reverse[t]
-            for k in pydict: names.append(k)
-
-        tmpdict = {}
-        for name in names:
-            if name in tmpdict: continue
-            tmpdict[name] = None
-
+        cur_t = time.monotonic()
+        heap = self.__heap
         results = []
-        for k in tmpdict: results.append(k)
+
+        while heap:
+            t, seq, name = heap[0]
+            if t > cur_t: break
+            heapq.heappop(heap)
+
+            info = self.__timeout_info.get(name, None)
+            if not info or info[1] != seq: continue
+            # 超时时间被延长,那么重新加入到堆中
+            if info[0] > cur_t:
+                info[1] = self.__push(name, info[0])
+                continue
+            info[1] = None
+            results.append(name)
 
         return results
 
     def set_timeout(self, name, seconds=1):
-        t = int(time.time()) + seconds
-        old_t = 0
-        if seconds < 1: return
-        if name in self.__timeout_info:
-            old_t = self.__timeout_info[name]
-            del self.__timeout_info_reverse[old_t][name]
-            if not self.__timeout_info_reverse[old_t]: del self.__timeout_info_reverse[old_t]
+        if seconds <= 0: return
+        t = time.monotonic() + seconds
+        info = self.__timeout_info.get(name, None)
 
-        self.__timeout_info[name] = t
+        # 延长超时时间只更新记录,等到堆中节点到期时再重新插入
+        if info and info[1] is not None and t >= info[0]:
+            info[0] = t
+            return
 
-        if t not in self.__timeout_info_reverse:
-            self.__timeout_info_reverse[t] = {}
-
-        self.__timeout_info_reverse[t][name] = None
-        # 防止过多的生成相同的timeout
-        if old_t != t: self.__time_list.append(t)
-        self.__time_list.sort()
+        self.__timeout_info[name] = [t, self.__push(name, t)]
+        if len(self.__heap) > 2 * len(self.__timeout_info) + 64: self.__compact()
 
     def exists(self, name):
         return (name in self.__timeout_info)
 
     def drop(self, name):
-        t = self.__timeout_info[name]
-        del self.__timeout_info_reverse[t][name]
         del self.__timeout_info[name]
-        if not self.__timeout_info_reverse[t]: del self.__timeout_info_reverse[t]
+
+    def is_empty(self):
+        return not self.__timeout_info
 
     def get_min_time(self):
-        cur_t = int(time.time())
-        if not self.__time_list: return 0
+        """获取最近超时的剩余时间,单位为秒,可能为小数
+        :return: 没有超时记录时返回0
+        """
+        self.__pop_invalid()
+        if not self.__heap: return 0
 
-        return self.__time_list[0] - cur_t
+        return self.__heap[0][0] - time.monotonic()
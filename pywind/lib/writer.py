@@ -1,17 +1,21 @@
 #!/usr/bin/env python3
-import queue, io
+"""写缓冲区,数据以块的形式保存,发送时可以使用sendmsg一次发送多个数据块
+事件循环是单线程的,因此不需要使用线程安全的队列
+"""
+import collections
 
 
 class writer(object):
     __buff_queue = None
     __size = 0
-    __lifo = None
+    # 第一个数据块已经发送的字节数
+    __offset = 0
 
     def __init__(self):
-        self.__buff_queue = queue.Queue()
-        self.__lifo = queue.LifoQueue()
+        self.__buff_queue = collections.deque()
         self.__closed = False
         self.__size = 0
+        self.__offset = 0
 
     def is_empty(self):
         if self.__size < 1:
@@ -20,48 +24,22 @@ class writer(object):
         return False
 
     def write(self, bdata):
-        slice_size = 8192
-        bsize = len(bdata)
-        end = 0
-        begin = 0
-
-        while 1:
-            if end >= bsize: break
-            if begin + slice_size > bsize:
-                end = bsize
-            else:
-                end = begin + slice_size
-            data = bdata[begin:end]
-            begin = end
-
-            self.__buff_queue.put(data)
-            self.__size += len(data)
+        if not bdata: return
 
-        return
+        self.__buff_queue.append(bdata)
+        self.__size += len(bdata)
 
     def writeline(self, bdata=b""):
-        byteio = io.BytesIO()
-        writes = [bdata, "\r\n".encode("utf-8")]
-
-        for v in writes:
-            byteio.write(v)
-
-        bdata = byteio.getvalue()
-        byteio.close()
-
-        self.write(bdata)
+        self.write(b"".join([bdata, b"\r\n"]))
 
     def writelines(self, byte_list):
-        byteio = io.BytesIO()
+        seq = []
 
         for v in byte_list:
-            byteio.write(v)
-            byteio.write("\r\n".encode("utf-8"))
-
-        bdata = byteio.getvalue()
-        byteio.close()
+            seq.append(v)
+            seq.append(b"\r\n")
 
-        self.write(bdata)
+        self.write(b"".join(seq))
 
     def push(self, byte_data):
         # cut down empty list data
@@ -69,32 +47,62 @@ class writer(object):
         if byte_data == b"":
             return
 
+        self.__merge_offset()
         self.__size += len(byte_data)
-        self.__lifo.put(byte_data)
+        self.__buff_queue.appendleft(byte_data)
 
-    def _getvalue(self):
-        byte_io = io.BytesIO()
+    def __merge_offset(self):
+        """把第一个数据块中已经发送的部分去掉"""
+        if not self.__offset: return
+
+        self.__buff_queue[0] = self.__buff_queue[0][self.__offset:]
+        self.__offset = 0
+
+    def get_buffers(self, max_num=64):
+        """获取要发送的数据块,用于sendmsg,不复制数据
+        :param max_num: 最多获取的数据块个数
+        :return list:
+        """
+        results = []
+        for v in self.__buff_queue:
+            if len(results) == max_num: break
+            results.append(v)
+
+        if results and self.__offset: results[0] = memoryview(results[0])[self.__offset:]
 
-        while 1:
-            try:
-                v = self.__lifo.get_nowait()
-            except queue.Empty:
-                try:
-                    v = self.__buff_queue.get_nowait()
-                except queue.Empty:
-                    break
-                ''''''
+        return results
 
-            byte_io.write(v)
-            self.__size -= len(v)
+    def consume(self, n):
+        """丢弃n个字节的数据,一般在数据发送之后调用"""
+        queue = self.__buff_queue
 
-        ret = byte_io.getvalue()
-        byte_io.close()
+        if n > self.__size: n = self.__size
+        self.__size -= n
+
+        while n > 0:
+            remain = len(queue[0]) - self.__offset
+            if n < remain:
+                self.__offset += n
+                break
+            n -= remain
+            queue.popleft()
+            self.__offset = 0
+
+        return
+
+    def _getvalue(self):
+        self.__merge_offset()
+        ret = b"".join(self.__buff_queue)
+
+        self.__buff_queue.clear()
+        self.__size = 0
 
         return ret
 
     def flush(self):
-        _ = self._getvalue()
+        self.__buff_queue.clear()
+        self.__size = 0
+        self.__offset = 0
 
     def size(self):
         return self.__size